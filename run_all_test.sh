@@ -5,6 +5,24 @@ set -x
 PYWIKIBOT_NO_USER_CONFIG=1 python -m antidox.wikiwatcher_test
 python -m antidox.perspective_test
 python -m wikiconv.ingest_revisions.ingester_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.html_strip_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.comment_clean_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.insert_utils_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.clean_cache_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.restoration_index_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.page_state_codec_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.tracing_test
+python -m wikiconv.conversation_reconstruction.construct_utils.utils.profiling_test
 python -m wikiconv.conversation_reconstruction.construct_utils.conversation_constructor_test
+python -m wikiconv.conversation_reconstruction.construct_utils.revision_loader_test
+python -m wikiconv.conversation_reconstruction.construct_utils.revision_pipeline_test
+python -m wikiconv.conversation_reconstruction.construct_utils.segments_test
+python -m wikiconv.conversation_reconstruction.construct_utils.synthetic_history_test
 python -m wikiconv.conversation_reconstruction.construct_utils.reconstruct_conversation_test
 python -m wikiconv.conversation_reconstruction.dataflow_test
+python -m wikiconv.conversation_reconstruction.state_store_test
+python -m wikiconv.conversation_reconstruction.job_summary_test
+python -m wikiconv.conversation_reconstruction.content_store_test
+python -m wikiconv.conversation_reconstruction.conversation_state_test
+python -m wikiconv.conversation_reconstruction.conversation_index_test
+python -m wikiconv.conversation_reconstruction.local_main_test
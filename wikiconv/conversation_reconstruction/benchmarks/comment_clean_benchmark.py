@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Measures per-comment cleaning latency of comment_clean against the pattern by
+pattern implementation it replaced, on the comments of the golden
+reconstruction output.
+
+Run from the repository root with:
+  python -m wikiconv.conversation_reconstruction.benchmarks.comment_clean_benchmark
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import timeit
+
+import bs4
+from wikiconv.conversation_reconstruction.construct_utils.utils import comment_clean
+
+default_conversations = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testdata',
+    'golden', 'conversations-00000-of-00001')
+
+# The substitutions as they were applied before comment_clean, one re.sub per
+# pattern.
+_LEGACY_LINK_PATTERNS = [(r'\[\[Image:.*?\]\]', ''), (r'\[\[File:.*?\]\]', ''),
+                         (r'\[\[User:.*?\]\]', ''), (r'\[\[user:.*?\]\]', ''),
+                         (r'\(?\[\[User talk:.*?\]\]\)?', ''),
+                         (r'\(?\[\[user talk:.*?\]\]\)?', ''),
+                         (r'\(?\[\[User Talk:.*?\]\]\)?', ''),
+                         (r'\(?\[\[User_talk:.*?\]\]\)?', ''),
+                         (r'\(?\[\[user_talk:.*?\]\]\)?', ''),
+                         (r'\(?\[\[User_Talk:.*?\]\]\)?', ''),
+                         (r'\(?\[\[Special:Contributions.*?\]\]\)?', '')]
+_LEGACY_CONTENT_PATTERNS = (
+    _LEGACY_LINK_PATTERNS[:1] +
+    [(r'<!-- {{blocked}} -->', '[BLOCKING_ACTION]')] + _LEGACY_LINK_PATTERNS[1:])
+_LEGACY_POST_PATTERNS = [('--', ''), (' :', ' '),
+                         ('—Preceding .* comment added by   •', '')]
+
+
+def _legacy_substitute(s, patterns):
+  for p, r in patterns:
+    s = re.sub(p, r, s)
+  return s
+
+
+def legacy_clean(rev):
+  ret = _legacy_substitute(rev, _LEGACY_LINK_PATTERNS)
+  return _legacy_substitute(ret, _LEGACY_POST_PATTERNS)
+
+
+def legacy_content_clean(rev):
+  ret = re.sub(comment_clean.date_p, lambda x: '', rev)
+  ret = _legacy_substitute(ret, _LEGACY_CONTENT_PATTERNS)
+  ret = comment_clean.strip_mw(ret)
+  try:
+    ret = bs4.BeautifulSoup(ret, 'html.parser').get_text()
+  except:  # pylint: disable=bare-except
+    pass
+  return _legacy_substitute(ret, _LEGACY_POST_PATTERNS)
+
+
+def load_comments(filename):
+  with io.open(filename, encoding='utf-8') as f:
+    return [json.loads(line)['content'] for line in f]
+
+
+def per_comment_microseconds(cleaner, comments, repeat):
+  seconds = min(
+      timeit.repeat(
+          lambda: [cleaner(c) for c in comments], number=1, repeat=repeat))
+  return seconds / len(comments) * 1e6
+
+
+def run(comments, repeat):
+  """Checks outputs agree and yields (name, before, after) latencies."""
+  for name, before, after in [('clean', legacy_clean, comment_clean.clean),
+                              ('content_clean', legacy_content_clean,
+                               comment_clean.content_clean)]:
+    mismatches = sum(1 for c in comments if before(c) != after(c))
+    if mismatches:
+      logging.warning('%s: %d comments cleaned differently.', name,
+                      mismatches)
+    yield (name, per_comment_microseconds(before, comments, repeat),
+           per_comment_microseconds(after, comments, repeat))
+  seconds = min(
+      timeit.repeat(
+          lambda: comment_clean.clean_batch(comments), number=1,
+          repeat=repeat))
+  yield ('clean_batch', None, seconds / len(comments) * 1e6)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-i', '--conversations', dest='conversations',
+      default=default_conversations)
+  parser.add_argument('-r', '--repeat', dest='repeat', default=10, type=int)
+  args = parser.parse_args()
+  all_comments = load_comments(args.conversations)
+  print('comments: %d' % len(all_comments))
+  for stage, before_us, after_us in run(all_comments, args.repeat):
+    if before_us is None:
+      print('%-14s %29.1f us/comment' % (stage, after_us))
+    else:
+      print('%-14s before %8.1f us/comment, after %8.1f us/comment (%.1fx)' %
+            (stage, before_us, after_us, before_us / after_us))
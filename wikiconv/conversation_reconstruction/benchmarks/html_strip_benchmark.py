@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Compares the streaming HTML stripper with BeautifulSoup on the equivalence
+corpus, checking that both produce the same text before timing them.
+
+Run from the repository root with:
+  python -m wikiconv.conversation_reconstruction.benchmarks.html_strip_benchmark
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import logging
+import os
+import timeit
+
+from wikiconv.conversation_reconstruction.construct_utils.utils import html_strip
+
+default_corpus = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'construct_utils', 'testdata', 'html_strip_corpus.json')
+
+
+def load_corpus(filename):
+  with io.open(filename, encoding='utf-8') as f:
+    return [json.loads(line)['text'] for line in f]
+
+
+def run(texts, repeat):
+  """Verifies equivalence on texts and returns (soup, stream) seconds."""
+  for text in texts:
+    assert html_strip.strip_html(text) == html_strip._soup_strip(text)  # pylint: disable=protected-access
+  soup_time = min(
+      timeit.repeat(
+          lambda: [html_strip._soup_strip(t) for t in texts],  # pylint: disable=protected-access
+          number=1,
+          repeat=repeat))
+  stream_time = min(
+      timeit.repeat(
+          lambda: [html_strip.strip_html(t) for t in texts],
+          number=1,
+          repeat=repeat))
+  return soup_time, stream_time
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-c', '--corpus', dest='corpus', default=default_corpus)
+  parser.add_argument(
+      '-r', '--repeat', dest='repeat', default=20, type=int)
+  args = parser.parse_args()
+  corpus = load_corpus(args.corpus)
+  fast = sum(1 for t in corpus if html_strip.fast_strip_html(t) is not None)
+  soup_seconds, stream_seconds = run(corpus, args.repeat)
+  print('texts: %d (%d on the streaming path), %d characters' %
+        (len(corpus), fast, sum(len(t) for t in corpus)))
+  print('BeautifulSoup: %.2f ms' % (soup_seconds * 1000))
+  print('html_strip:    %.2f ms' % (stream_seconds * 1000))
+  print('speedup:       %.1fx' % (soup_seconds / stream_seconds))
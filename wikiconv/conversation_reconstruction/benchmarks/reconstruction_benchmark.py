@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Replays the revisions of test pages through ConversationConstructor and
+reports, per page and in total, revisions and actions per second, the time
+spent in each stage of the reconstruction and the peak memory traced while
+reconstructing.
+
+The stages are the cleaning of the revisions, their diff with the previous
+revision, the insertion of the diff into the page and the post processing of
+the actions, which is the remainder of the time spent in
+ConversationConstructor.process.
+
+The pages replayed are the ones of the pipeline test data, the pages in
+construct_utils/testdata, and the long pages suggested in constructor_tester.py
+when they have been fetched with construct_utils/fetch_testdata.py. Missing
+pages are skipped, so the benchmark runs offline. Larger pages can be added
+with --synthetic_revisions, generated by construct_utils/synthetic_history.py.
+
+The results are compared with a JSON baseline, and the benchmark exits with an
+error when the throughput or the peak memory of a page regressed by more than
+a threshold. The baseline is written by the first run, and rewritten with
+--update_baseline.
+
+Run from the repository root with:
+  python -m wikiconv.conversation_reconstruction.benchmarks.reconstruction_benchmark
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import glob
+import io
+import json
+import logging
+import os
+import sys
+import timeit
+
+from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+from wikiconv.conversation_reconstruction.construct_utils import synthetic_history
+from wikiconv.conversation_reconstruction.construct_utils import testing
+
+try:
+  import tracemalloc  # pylint: disable=g-import-not-at-top
+except ImportError:
+  tracemalloc = None
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TESTDATA = os.path.join(_ROOT, 'construct_utils', 'testdata')
+
+# The long pages with long deletions suggested in constructor_tester.py, as
+# written by fetch_testdata.py and reversed by reverse_order.sh.
+LONG_PAGE_IDS = [14677358, 34948919, 15854766, 43758735, 22811813, 28031]
+
+default_inputs = ([
+    os.path.join(_ROOT, 'testdata', 'edgecases_28_convs', 'revs*'),
+    os.path.join(_TESTDATA, 'text'),
+    os.path.join(_TESTDATA, 'dummy_test.json')
+] + [
+    os.path.join(_TESTDATA, 'reversed_page_%d.json' % page_id)
+    for page_id in LONG_PAGE_IDS
+])
+default_baseline = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'reconstruction_baseline.json')
+
+SYNTHETIC_PAGE_ID = 1
+STAGES = ('clean', 'diff', 'insert', 'postprocess')
+# Metrics checked against the baseline, with whether higher is better.
+CHECKED_METRICS = (('revisions_per_sec', True), ('actions_per_sec', True),
+                   ('peak_traced_kb', False))
+# Pages reconstructed faster than this in the baseline are too noisy to check,
+# on their own or as part of the total.
+MIN_CHECKED_SECONDS = 0.05
+
+
+def load_pages(patterns):
+  """Reads the revisions of the pages in files matching patterns.
+
+  Args:
+    patterns: list of glob patterns of files of revisions, one JSON object per
+      line. Patterns matching no file are skipped.
+
+  Returns:
+    An OrderedDict of the revisions of each page id, in the order they are
+    reconstructed.
+  """
+  pages = collections.OrderedDict()
+  for pattern in patterns:
+    filenames = sorted(glob.glob(pattern))
+    if not filenames:
+      logging.info('Skipping %s: no such file.', pattern)
+    for filename in filenames:
+      with io.open(filename, encoding='utf-8') as f:
+        for line in f:
+          if line.strip():
+            rev = json.loads(line)
+            pages.setdefault(str(rev['page_id']), []).append(rev)
+  for revisions in pages.values():
+    revisions.sort(key=lambda rev: (rev['timestamp'], int(rev['rev_id'])))
+  return pages
+
+
+class StageTimer(object):
+  """Times the stages of ConversationConstructor.process while entered.
+
+  The module functions of conversation_constructor implementing the stages are
+  replaced by timed wrappers, and restored on exit.
+  """
+
+  _FUNCTIONS = (('clean', 'clean_revision'), ('diff', 'compute_diff'),
+                ('insert', 'insert'))
+
+  def __init__(self):
+    self.seconds = dict.fromkeys(STAGES, 0.0)
+    self._originals = {}
+
+  def _timed(self, stage, function):
+
+    def wrapper(*args, **kwargs):
+      start = timeit.default_timer()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        self.seconds[stage] += timeit.default_timer() - start
+
+    return wrapper
+
+  def __enter__(self):
+    for stage, name in self._FUNCTIONS:
+      function = getattr(conversation_constructor, name)
+      self._originals[name] = function
+      setattr(conversation_constructor, name, self._timed(stage, function))
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    for name, function in self._originals.items():
+      setattr(conversation_constructor, name, function)
+    self._originals = {}
+
+
+def replay(revisions):
+  """Reconstructs a page, returning its number of actions and total seconds."""
+  start = timeit.default_timer()
+  _, actions = testing.replay(revisions)
+  return len(actions), timeit.default_timer() - start
+
+
+def peak_traced_kb(revisions):
+  """Returns the peak memory traced while reconstructing a page, in KB."""
+  if tracemalloc is None:
+    return None
+  tracemalloc.start()
+  try:
+    replay(revisions)
+    return tracemalloc.get_traced_memory()[1] / 1024
+  finally:
+    tracemalloc.stop()
+
+
+def measure(revisions, repeat):
+  """Benchmarks the reconstruction of a page.
+
+  Args:
+    revisions: the revisions of the page, in order.
+    repeat: the number of timed reconstructions, the fastest of which is kept.
+
+  Returns:
+    A dictionary of the metrics of the page.
+  """
+  best = None
+  for _ in range(repeat):
+    with StageTimer() as timer:
+      actions, seconds = replay(revisions)
+    if best is None or seconds < best[1]:
+      best = (actions, seconds, timer.seconds)
+  actions, seconds, stages = best
+  stages['postprocess'] = max(
+      0.0, seconds - stages['clean'] - stages['diff'] - stages['insert'])
+  return {
+      'revisions': len(revisions),
+      'actions': actions,
+      'seconds': seconds,
+      'revisions_per_sec': len(revisions) / seconds if seconds else None,
+      'actions_per_sec': actions / seconds if seconds else None,
+      'stage_seconds': stages,
+      # Tracing slows the reconstruction down, so memory is measured apart.
+      'peak_traced_kb': peak_traced_kb(revisions)
+  }
+
+
+def run(pages, repeat):
+  """Benchmarks the reconstruction of pages.
+
+  Args:
+    pages: dictionary of the revisions of each page id.
+    repeat: the number of timed reconstructions of each page.
+
+  Returns:
+    A dictionary of the metrics of each page, and of all pages as 'total'.
+  """
+  results = collections.OrderedDict()
+  for page_id, revisions in pages.items():
+    results[page_id] = measure(revisions, repeat)
+    logging.info('Page %s: %d revisions in %.3f s.', page_id, len(revisions),
+                 results[page_id]['seconds'])
+  results['total'] = total(list(results.values()))
+  return results
+
+
+def total(pages):
+  """Returns the metrics of pages taken together."""
+  seconds = sum(page['seconds'] for page in pages)
+  revisions = sum(page['revisions'] for page in pages)
+  actions = sum(page['actions'] for page in pages)
+  peaks = [
+      page['peak_traced_kb']
+      for page in pages
+      if page['peak_traced_kb'] is not None
+  ]
+  return {
+      'revisions': revisions,
+      'actions': actions,
+      'seconds': seconds,
+      'revisions_per_sec': revisions / seconds if seconds else None,
+      'actions_per_sec': actions / seconds if seconds else None,
+      'stage_seconds': {
+          stage: sum(page['stage_seconds'][stage] for page in pages)
+          for stage in STAGES
+      },
+      'peak_traced_kb': max(peaks) if peaks else None
+  }
+
+
+def regressions(baseline, results, threshold):
+  """Lists the metrics that regressed from the baseline by over threshold.
+
+  Args:
+    baseline: the results of an earlier run.
+    results: the results of this run.
+    threshold: the tolerated relative regression, e.g. 0.2 for 20%.
+
+  Returns:
+    A list of messages, one per regressed metric. Pages missing from either
+    run, or reconstructed in less than MIN_CHECKED_SECONDS in the baseline,
+    are not compared. The total is compared over the pages that are, so that
+    the noise of the fastest pages does not add up in it.
+  """
+  checked = [
+      page_id for page_id in results
+      if page_id != 'total' and page_id in baseline and
+      baseline[page_id]['seconds'] >= MIN_CHECKED_SECONDS
+  ]
+  compared = [(page_id, baseline[page_id], results[page_id])
+              for page_id in checked]
+  if len(checked) > 1:
+    compared.append(('total', total([baseline[page_id] for page_id in checked]),
+                     total([results[page_id] for page_id in checked])))
+  ret = []
+  for page_id, before_metrics, after_metrics in compared:
+    for metric, higher_is_better in CHECKED_METRICS:
+      before = before_metrics.get(metric)
+      after = after_metrics.get(metric)
+      if not before or after is None:
+        continue
+      change = (after - before) / before
+      if (-change if higher_is_better else change) > threshold:
+        ret.append('%s %s: %.1f -> %.1f (%+.0f%%)' %
+                   (page_id, metric, before, after, change * 100))
+  return ret
+
+
+def print_results(results):
+  print('%-10s %6s %7s %10s %10s %s' %
+        ('page', 'revs', 'actions', 'revs/s', 'actions/s',
+         ' '.join('%11s' % stage for stage in STAGES) + '   peak KB'))
+  for page_id, metrics in results.items():
+    print('%-10s %6d %7d %10.1f %10.1f %s %9s' %
+          (page_id, metrics['revisions'], metrics['actions'],
+           metrics['revisions_per_sec'] or 0, metrics['actions_per_sec'] or 0,
+           ' '.join('%10.1f%%' % (100 * metrics['stage_seconds'][stage] /
+                                  metrics['seconds'] if metrics['seconds'] else 0)
+                    for stage in STAGES),
+           '-' if metrics['peak_traced_kb'] is None else
+           '%.0f' % metrics['peak_traced_kb']))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-i', '--input', dest='inputs', nargs='+', default=default_inputs,
+      help='Glob patterns of the files of revisions to replay.')
+  parser.add_argument(
+      '-n', '--synthetic_revisions', dest='synthetic_revisions', default=0,
+      type=int, help='Number of revisions of a synthetic page to add.')
+  parser.add_argument(
+      '-s', '--synthetic_seed', dest='synthetic_seed', default=0, type=int)
+  parser.add_argument(
+      '-r', '--repeat', dest='repeat', default=5, type=int,
+      help='Number of timed reconstructions of each page, the fastest of '
+      'which is kept.')
+  parser.add_argument(
+      '-b', '--baseline', dest='baseline', default=default_baseline)
+  parser.add_argument(
+      '-t', '--threshold', dest='threshold', default=0.2, type=float,
+      help='Relative regression from the baseline that fails the run.')
+  parser.add_argument(
+      '--update_baseline', dest='update_baseline', action='store_true',
+      help='Rewrite the baseline with the results of this run.')
+  args = parser.parse_args(argv)
+  pages = load_pages(args.inputs)
+  if args.synthetic_revisions:
+    generator = synthetic_history.HistoryGenerator(
+        SYNTHETIC_PAGE_ID, args.synthetic_seed)
+    pages['synthetic-%d' % args.synthetic_seed] = list(
+        generator.revisions(args.synthetic_revisions))
+  if not pages:
+    logging.error('No revisions found in %s.', args.inputs)
+    return 2
+  results = run(pages, args.repeat)
+  print_results(results)
+  failed = []
+  if os.path.exists(args.baseline):
+    with io.open(args.baseline, encoding='utf-8') as f:
+      failed = regressions(json.load(f), results, args.threshold)
+    for message in failed:
+      print('REGRESSION %s' % message)
+  if args.update_baseline or not os.path.exists(args.baseline):
+    with open(args.baseline, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    logging.info('Baseline written to %s.', args.baseline)
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  sys.exit(main())
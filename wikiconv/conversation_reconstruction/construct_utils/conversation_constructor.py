@@ -23,18 +23,29 @@ from __future__ import unicode_literals
 
 import collections
 import copy
-import json
-import logging
-import resource
 
 from wikiconv.conversation_reconstruction.construct_utils.utils import actions
+from wikiconv.conversation_reconstruction.construct_utils.utils import comment_clean
 from wikiconv.conversation_reconstruction.construct_utils.utils import insert_utils
-from wikiconv.conversation_reconstruction.construct_utils.utils.third_party import rev_clean
+from wikiconv.conversation_reconstruction.construct_utils.utils import profiling
+from wikiconv.conversation_reconstruction.construct_utils.utils import restoration_index
+from wikiconv.conversation_reconstruction.construct_utils.utils import tracing
 import diff_match_patch as dmp_module
-import noaho
 
+# Page state fields mapping action ids to metadata.
+METADATA_FIELDS = ('conversation_id', 'authors', 'ancestor_id')
+# Approximate bytes used by an action offset on the page state and by a
+# metadata entry: the dictionary slot, the id and the value.
+ACTION_ENTRY_BYTES = 150
+METADATA_ENTRY_BYTES = 250
+# Fraction of the memory budget to shrink to once it is exceeded.
+MEMORY_LOW_WATERMARK = 0.9
+# Number of recent revisions of a page whose cleaned text is kept by sha1, so
+# that reverts are not cleaned again.
+RECENT_REVISIONS = 16
 
-def insert(rev, page, previous_comments, comment_lowerbound):
+
+def insert(rev, page, previous_comments, comment_lowerbound, trace=None):
   """Insert a new page into page state.
 
   Given the current revision, page state and previously deleted comments.
@@ -53,6 +64,7 @@ def insert(rev, page, previous_comments, comment_lowerbound):
     page: the new page.
     previous_comments: the previously deleted comments.
     comment_lowerbound: the maximum length comments to process.
+    trace: an optional tracing.Trace the steps of the insertion are traced to.
 
   Returns:
     A tuple of the updated actions, and updated page.
@@ -74,7 +86,8 @@ def insert(rev, page, previous_comments, comment_lowerbound):
       content = ''.join(op['tokens'])
       if not content:
         continue
-      logging.debug('INSERT %s OFFSET (%d, %d)', content, op['b1'], op['b2'])
+      if trace:
+        trace.event('insert', content=content, b1=op['b1'], b2=op['b2'])
       if (op['tokens'][0] == '\n' or op['b1'] == 0 or
           (op['b1'] > 0 and rev_text[op['b1'] - 1] == '\n')) and (
               op['b2'] == len(rev_text) or op['tokens'][-1] == '\n'):
@@ -90,12 +103,11 @@ def insert(rev, page, previous_comments, comment_lowerbound):
           comment_additions.append(c)
       else:
         modification_diffs.append(op)
-  logging.debug('OLD ACTIONS: %s', json.dumps(old_actions))
-  logging.debug('OLD ACTION LENGTH: %d', len(old_actions))
+  if trace:
+    trace.event('old_actions', offsets=list(old_actions))
   old_actions = sorted(old_actions)
   for op in rev['diff']:
     if op['name'] == 'delete':
-      content = ''.join(op['tokens'])
       # Deletions may remove multiple comments at the same time
       # Here is to locate the boundary of the deletion in the old revision
       delete_start = op['a1']
@@ -103,39 +115,51 @@ def insert(rev, page, previous_comments, comment_lowerbound):
       deleted_action_start = insert_utils.find_pos(delete_start, old_actions)
       deleted_action_end = insert_utils.find_pos(delete_end, old_actions)
       deleted_action_end = deleted_action_end + 1
-      logging.debug('DELETE %d %d', op['a1'], op['a2'])
-      logging.debug('DELETED ACTION : (%d, %d)', deleted_action_start,
-                    deleted_action_end)
-      start_token = 0
-      # If the deletion removes/modifies multiple coments,
-      # divide the deletion into parts.
-      for ind, act in enumerate(
-          old_actions[deleted_action_start:deleted_action_end]):
-        if act == delete_end:
-          break
-        partial_op = {}
-        partial_op['a1'] = max(delete_start, act)
-        partial_op['a2'] = min(delete_end,
-                               old_actions[deleted_action_start + ind + 1])
-        partial_op['b1'] = op['b1']
-        partial_op['b2'] = op['b2']
-        partial_op['tokens'] = op['tokens'][start_token:partial_op['a2'] -
-                                            partial_op['a1'] + start_token]
-        start_token += partial_op['a2'] - partial_op['a1']
-        # Determine if the subset of the deletion is a comment removal
-        # or modification.
-        if delete_start > act or act == old_actions[deleted_action_end - 1]:
-          logging.debug('MODIFICATION ON %d', act)
-          modification_actions[act] = True
-          modification_diffs.append(op)
-        else:
-          comment_removals.append([page['actions'][act], partial_op])
-          removed_actions[act] = True
+      if trace:
+        trace.event(
+            'delete',
+            a1=op['a1'],
+            a2=op['a2'],
+            first_action=deleted_action_start,
+            last_action=deleted_action_end)
+      # If the deletion removes/modifies multiple coments, divide the deletion
+      # into parts. The actions it only covers in part, at its start and its
+      # end, are modified; the actions in between are removed as a block, such
+      # as the threads an archiving bot moves away.
+      last_covered = deleted_action_end - 1
+      first_removed = deleted_action_start
+      modified = []
+      if delete_start > old_actions[deleted_action_start]:
+        modified.append(deleted_action_start)
+        first_removed += 1
+      if (old_actions[last_covered] != delete_end and
+          last_covered not in modified):
+        modified.append(last_covered)
+      for ind in modified:
+        if trace:
+          trace.event('modification', offset=old_actions[ind])
+        modification_actions[old_actions[ind]] = True
+        modification_diffs.append(op)
+      tokens = op['tokens']
+      for ind in range(first_removed, last_covered):
+        act = old_actions[ind]
+        act_end = old_actions[ind + 1]
+        comment_removals.append([
+            page['actions'][act], {
+                'a1': act,
+                'a2': act_end,
+                'b1': op['b1'],
+                'b2': op['b2'],
+                'tokens': tokens[act - delete_start:act_end - delete_start]
+            }
+        ])
+        removed_actions[act] = True
   for op in modification_diffs:
     if op['name'] == 'insert':
       content = ''.join(op['tokens'])
-      logging.debug('MODIFICATION INSERT CONTENT : %s, OFFSET (%d, %d)',
-                    content, op['b1'], op['b2'])
+      if trace:
+        trace.event(
+            'modification_insert', content=content, b1=op['b1'], b2=op['b2'])
       # If the current insertion is modifying an existed comment
       old_action_start = insert_utils.get_action_start(old_actions, op['a1'])
       for ind, x in enumerate(old_actions):
@@ -165,8 +189,9 @@ def insert(rev, page, previous_comments, comment_lowerbound):
     if len(removal[1]['tokens']) <= comment_lowerbound:
       updated_removals.append(removal)
       continue
-    removed = ''.join(removal[1]['tokens'])
-    logging.debug('REMOVED: %s', removed)
+    removed = insert_utils.join_tokens(removal[1]['tokens'])
+    if trace:
+      trace.event('removed', content=removed)
     rearranged = False
     updated_additions = []
     for ind, insert_dict in enumerate(comment_additions):
@@ -180,8 +205,11 @@ def insert(rev, page, previous_comments, comment_lowerbound):
         end_tokens.append(
             (start_tok + insert_dict['b1'], end_tok + insert_dict['b1']))
         rearrangement[removal[1]['a1']] = start_tok + insert_dict['b1']
-        logging.debug('REARRANGEMENT FOUND: Offset (%d, %d).', removal[1]['a1'],
-                      start_tok + insert_dict['b1'])
+        if trace:
+          trace.event(
+              'rearrangement',
+              old_offset=removal[1]['a1'],
+              new_offset=start_tok + insert_dict['b1'])
         tmp_ins = []
         # Divide the comment addition
         if start_tok != 0:
@@ -216,14 +244,15 @@ def insert(rev, page, previous_comments, comment_lowerbound):
   updated_page['page_id'] = rev['page_id']
   updated_page['actions'] = {}
   updated_page['page_title'] = rev['page_title']
+  locator = insert_utils.TokenLocator(rev['diff'])
   for act in old_actions:
     if not (act in modification_actions or act in removed_actions):
       # If an action is modified, it will be located later.
       # If an action is removed, it will be ignored in the updated page state.
-      new_pos = insert_utils.locate_new_token_pos(act, rev['diff'])
+      new_pos = locator.locate(act)
       # Otherwise update action offsets for old actions.
-      if page['actions'][act] == (-1, -1):
-        logging.debug('DOCUMENT END: %d -> %d.', act, new_pos)
+      if trace and page['actions'][act] == (-1, -1):
+        trace.event('document_end', old_offset=act, new_offset=new_pos)
       updated_page['actions'][new_pos] = page['actions'][act]
     # If an action is in rearrangement(it will also be in the removed action
     # set). The updated action should be registered into its newly rearranged
@@ -241,8 +270,13 @@ def insert(rev, page, previous_comments, comment_lowerbound):
     new_action_end = insert_utils.locate_new_token_pos(old_action_end,
                                                        modification_diffs,
                                                        'right_bound')
-    logging.debug('OLD %d -> %d', old_action_end, new_action_end)
-    logging.debug('OLD %d -> %d', old_action_start, new_action_start)
+    if trace:
+      trace.event(
+          'modified_action',
+          old_start=old_action_start,
+          old_end=old_action_end,
+          new_start=new_action_start,
+          new_end=new_action_end)
     # Get the updated text
     tokens = rev['text'][new_action_start:new_action_end]
     # Create the action modification object and register the new action
@@ -303,10 +337,13 @@ def insert(rev, page, previous_comments, comment_lowerbound):
     if end_tok not in updated_page['actions']:
       tmp_lst = sorted(list(updated_page['actions'].keys()))
       last_rev = tmp_lst[insert_utils.find_pos(start_tok, tmp_lst) - 1]
-      logging.debug('ACTION OFFSETS: (%d, %d)', start_tok, end_tok)
+      if trace:
+        trace.event('action_offsets', start=start_tok, end=end_tok)
       updated_page['actions'][end_tok] = updated_page['actions'][last_rev]
-  logging.debug('ACTIONS FOUND : %s.',
-                ','.join([action['type'] for action in updated_actions]))
+  if trace:
+    trace.event(
+        'actions_found',
+        types=lambda: [action['type'] for action in updated_actions])
   # Sanity checks:
   # The page states must start with 0 and end with the last token.
   assert 0 in updated_page['actions']
@@ -323,15 +360,132 @@ def insert(rev, page, previous_comments, comment_lowerbound):
   return updated_actions, updated_page
 
 
+def convert_diff_format(x, a, b):
+  ret = x
+  if x['name'] == 'insert':
+    ret['tokens'] = b[x['b1']:x['b2']]
+  if x['name'] == 'delete':
+    ret['tokens'] = a[x['a1']:x['a2']]
+  return ret
+
+def mydiff_to_delta(diffs):
+  """Crush diff into a list of changes.
+
+  crush the diff into a list of dictionary indicating changes from
+  one document to another. Operations are dictionary record with name
+  (insert, delete, equal) and offsets (in original text and resulted
+  text).
+
+  Args:
+    diffs: Array of diff tuples.
+
+  Yields:
+    Deltas.
+  """
+  a = 0
+  b = 0
+  diff_delete = -1
+  diff_insert = 1
+  diff_equal = 0
+
+  for (op, data) in diffs:
+    if op == diff_insert:
+      yield ({
+          'name': 'insert',
+          'a1': a,
+          'a2': a,
+          'b1': b,
+          'b2': b + len(data)
+      })
+      b += len(data)
+    elif op == diff_delete:
+      yield ({
+          'name': 'delete',
+          'a1': a,
+          'a2': a + len(data),
+          'b1': b,
+          'b2': b
+      })
+      a += len(data)
+    elif op == diff_equal:
+      yield ({
+          'name': 'equal',
+          'a1': a,
+          'a2': a + len(data),
+          'b1': b,
+          'b2': b + len(data)
+      })
+      a += len(data)
+      b += len(data)
+
+
+def clean_revision(text):
+  """Cleans the HTML format of a revision's text."""
+  return comment_clean.clean_html(text)
+
+
+def compute_diff(latest_content, text):
+  """Computes the diff between the latest processed revision and a new one.
+
+  Args:
+    latest_content: the cleaned text of the latest processed revision.
+    text: the cleaned text of the new revision.
+
+  Returns:
+    The list of diff operations, sorted by offset in latest_content.
+  """
+  dmp = dmp_module.diff_match_patch()
+  diff = dmp.diff_main(latest_content, text, False)
+  dmp.diff_cleanupSemantic(diff)
+  delta = mydiff_to_delta(diff)
+  return sorted(
+      [convert_diff_format(x, latest_content, text) for x in delta],
+      key=lambda k: k['a1'])
+
+
 class ConversationConstructor(object):
   """Main class for processing wikipedia comments."""
 
-  def __init__(self):
+  def __init__(self,
+               retention=None,
+               memory_budget=None,
+               tracer=None,
+               profiler=None):
+    """Constructor.
+
+    Args:
+      retention: an optional restoration_index.RetentionPolicy bounding the
+        deleted comments kept for detecting restorations. By default they are
+        kept for the life of the page.
+      memory_budget: an optional number of bytes the per-page structures may
+        use. When it is exceeded, metadata of dead actions is dropped first and
+        then the least recently seen deleted comments are evicted.
+      tracer: an optional tracing.Tracer selecting the revisions to trace.
+      profiler: an optional profiling.Profiler selecting the pages to profile.
+    """
     self.comment_lowerbound = 10
     self.comment_upperbound = 1000
     # Deleted comments with less than this number of tokens will not be recorded
     # thus not considered in comment restoration actions to reduce confusion.
     self.deleted_records = {}
+    self.retention = retention
+    self.memory_budget = memory_budget
+    self.tracer = tracer
+    self.profiler = profiler
+    # The profiling.PageProfile of the page, once a revision of it is processed
+    # if it is profiled.
+    self.profile = None
+    # Ids of the actions on the page as of the last processed revision, or None
+    # when they are yet to be computed from a loaded page state.
+    self.alive_actions = None
+    self.previous_comments = restoration_index.RestorationIndex(
+        policy=retention)
+    # sha1 of a recent revision -> its cleaned text, least recently used first.
+    self.recent_texts = collections.OrderedDict()
+    # Revisions whose cleaning was reused from a recent revision, and revisions
+    # skipped because they did not change the cleaned text.
+    self.reused_cleanings = 0
+    self.skipped_revisions = 0
 
   def page_creation(self, rev):
     page = {}
@@ -341,76 +495,89 @@ class ConversationConstructor(object):
     page['actions'][0] = (-1, -1)
     return page
 
-  def load(self, deleted_comments):
+  def load(self, deleted_comments, timestamp=None):
     """Load the previous page state, deleted comments and other information.
 
     Args:
       deleted_comments: list of tuples.
+      timestamp: the timestamp of the page state, used as the last time seen of
+        deleted comments serialized without one.
     """
-    self.deleted_records = {}
-    self.previous_comments = noaho.NoAho()
-    for pair in deleted_comments:
-      self.previous_comments.add(pair[0], (pair[1], int(pair[2])))
-      self.deleted_records[pair[1]] = True
+    self.alive_actions = None
+    self.previous_comments = restoration_index.RestorationIndex.from_records(
+        deleted_comments,
+        policy=self.retention,
+        default_timestamp=(restoration_index.parse_timestamp(timestamp)
+                           if timestamp else None))
+    self.deleted_records = {pair[1]: True for pair in deleted_comments}
     return
 
-  def convert_diff_format(self, x, a, b):
-    ret = x
-    if x['name'] == 'insert':
-      ret['tokens'] = b[x['b1']:x['b2']]
-    if x['name'] == 'delete':
-      ret['tokens'] = a[x['a1']:x['a2']]
-    return ret
+  def memory_usage(self, page_state):
+    """Estimates the bytes used by the structures kept for a page.
+
+    Args:
+      page_state: dictionary.
 
-  def mydiff_to_delta(self, diffs):
-    """Crush diff into a list of changes.
+    Returns:
+      The estimate, in bytes.
+    """
+    entries = sum(
+        len(page_state[name]) for name in METADATA_FIELDS if name in page_state)
+    return (self.previous_comments.memory_usage() +
+            len(page_state['page_state']['actions']) * ACTION_ENTRY_BYTES +
+            entries * METADATA_ENTRY_BYTES)
 
-    crush the diff into a list of dictionary indicating changes from
-    one document to another. Operations are dictionary record with name
-    (insert, delete, equal) and offsets (in original text and resulted
-    text).
+  def enforce_memory_budget(self, page_state):
+    """Shrinks the page structures until they fit in the memory budget.
 
     Args:
-      diffs: Array of diff tuples.
+      page_state: dictionary, updated in place.
+
+    Returns:
+      The list of payloads of the deleted comments evicted.
+    """
+    if (self.memory_budget is None or
+        self.memory_usage(page_state) <= self.memory_budget):
+      return []
+    # Dropping the metadata of dead actions loses nothing.
+    self.compact(page_state)
+    # Free some headroom so that evictions happen in batches.
+    overflow = (
+        self.memory_usage(page_state) - self.memory_budget * MEMORY_LOW_WATERMARK)
+    if self.memory_usage(page_state) <= self.memory_budget or overflow <= 0:
+      return []
+    return self.previous_comments.shrink(
+        self.previous_comments.memory_usage() - overflow)
+
+  def compact(self, page_state):
+    """Drops the metadata of actions that are neither alive nor deleted."""
+    for name in METADATA_FIELDS:
+      page_state[name] = self.clean_dict(page_state['page_state'],
+                                         page_state[name])
+
+  def prune_metadata(self, page_state, updated_page, candidates):
+    """Drops the metadata of the candidate actions that are no longer alive.
+
+    Liveness is tracked incrementally: the metadata of an action can only
+    become stale once it leaves the page, is evicted from the deleted comments
+    or, for actions of the current revision, when it never made it to the
+    page. Only those candidates are looked at.
 
-    Yields:
-      Deltas.
+    Args:
+      page_state: dictionary, updated in place.
+      updated_page: the page after the current revision.
+      candidates: ids of the actions of the current revision and of the deleted
+        comments evicted while processing it.
     """
-    a = 0
-    b = 0
-    diff_delete = -1
-    diff_insert = 1
-    diff_equal = 0
-
-    for (op, data) in diffs:
-      if op == diff_insert:
-        yield ({
-            'name': 'insert',
-            'a1': a,
-            'a2': a,
-            'b1': b,
-            'b2': b + len(data)
-        })
-        b += len(data)
-      elif op == diff_delete:
-        yield ({
-            'name': 'delete',
-            'a1': a,
-            'a2': a + len(data),
-            'b1': b,
-            'b2': b
-        })
-        a += len(data)
-      elif op == diff_equal:
-        yield ({
-            'name': 'equal',
-            'a1': a,
-            'a2': a + len(data),
-            'b1': b,
-            'b2': b + len(data)
-        })
-        a += len(data)
-        b += len(data)
+    alive = set(action[0] for action in updated_page['actions'].values())
+    dead = self.alive_actions - alive
+    dead.update(candidates)
+    for action_id in dead:
+      if action_id in alive or action_id in self.deleted_records:
+        continue
+      for name in METADATA_FIELDS:
+        page_state[name].pop(action_id, None)
+    self.alive_actions = alive
 
   def clean_dict(self, page, the_dict):
     """Prune information stored in dictionary.
@@ -429,44 +596,96 @@ class ConversationConstructor(object):
     Returns:
       The resulting dictionary.
     """
-    keylist = the_dict.keys()
-    ret = the_dict.copy()
-    alive_actions = set([action[0] for action in page['actions'].values()])
-    for action in keylist:
-      if not (action in alive_actions or action in self.deleted_records):
-        del ret[action]
-    return ret
+    with profiling.stage(self.profile, 'clean_dict'):
+      keylist = the_dict.keys()
+      ret = the_dict.copy()
+      alive_actions = set([action[0] for action in page['actions'].values()])
+      for action in keylist:
+        if not (action in alive_actions or action in self.deleted_records):
+          del ret[action]
+      return ret
+
+  def clean_text(self, rev):
+    """Returns the cleaned text of a revision, reusing that of a revert.
+
+    Args:
+      rev: dictionary, with an optional 'sha1' of its text.
+
+    Returns:
+      The cleaned text.
+    """
+    sha1 = rev.get('sha1')
+    if not sha1:
+      return clean_revision(rev['text'])
+    text = self.recent_texts.pop(sha1, None)
+    if text is None:
+      text = clean_revision(rev['text'])
+    else:
+      self.reused_cleanings += 1
+    self.recent_texts[sha1] = text
+    if len(self.recent_texts) > RECENT_REVISIONS:
+      self.recent_texts.popitem(last=False)
+    return text
 
   def process(self, page_state, latest_content, rev):
     """Main process entrypoint.
 
     Args:
       page_state: dictionary.
-      latest_content: list.
-      rev: dictionary.
+      latest_content: the cleaned text of the latest processed revision.
+      rev: dictionary. When it has a 'diff', its text is taken to be cleaned
+        already and diff to be compute_diff(latest_content, rev['text']).
 
     Returns:
-      Tuple of page_state, actions, and text.
+      Tuple of page_state, actions, and text. A revision that leaves the
+      cleaned text unchanged only updates the revision id and timestamp of the
+      page state, and has no actions.
     """
-    logging.debug('DEBUGGING MODE on REVISION %s', rev['rev_id'])
-    memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-    logging.debug('MEMORY USAGE BEFORE ANYTHING: %d KB.', memory_usage)
-    # Clean the HTML format of the revision.
-    rev['text'] = rev_clean.clean_html(rev['text'])
-    # Compute the diff between the latest processed revision and the current
-    # one.
-    dmp = dmp_module.diff_match_patch()
-    logging.debug('LENGTH : %d -> %d', len(latest_content), len(rev['text']))
-    diff = dmp.diff_main(latest_content, rev['text'], False)
-    dmp.diff_cleanupSemantic(diff)
-    delta = self.mydiff_to_delta(diff)
-    rev['diff'] = sorted([
-        self.convert_diff_format(x, latest_content, rev['text']) for x in delta
-    ],
-                         key=lambda k: k['a1'])
+    if self.profiler and self.profile is None:
+      self.profile = self.profiler.profile(rev['page_id'])
+    if not self.profile:
+      return self.process_revision(page_state, latest_content, rev)
+    self.profile.start_revision()
+    try:
+      return self.process_revision(page_state, latest_content, rev)
+    finally:
+      self.profile.stop_revision()
+
+  def process_revision(self, page_state, latest_content, rev):
+    """Processes a revision, see process."""
+    profile = self.profile
+    trace = (
+        self.tracer.trace(rev['page_id'], rev['rev_id'])
+        if self.tracer else None)
+    if trace:
+      trace.event('revision', max_rss_kb=tracing.max_rss_kb)
+    # Revisions cleaned and diffed ahead of time already have a diff, see
+    # revision_pipeline.
+    if 'diff' not in rev:
+      with profiling.stage(profile, 'clean_html'):
+        rev['text'] = self.clean_text(rev)
+    if page_state and rev['text'] == latest_content:
+      # The revision does not change the cleaned page: no actions.
+      self.skipped_revisions += 1
+      page_state['rev_id'] = int(rev['rev_id'])
+      page_state['timestamp'] = rev['timestamp']
+      if trace:
+        trace.event('skipped', length=len(rev['text']))
+      return page_state, [], rev['text']
+    if 'diff' not in rev:
+      with profiling.stage(profile, 'diff'):
+        rev['diff'] = compute_diff(latest_content, rev['text'])
+    if trace:
+      trace.event(
+          'diffed',
+          old_length=len(latest_content),
+          length=len(rev['text']),
+          ops=len(rev['diff']))
     # Create a new page if this page was never processed before.
     if not page_state:
-      self.previous_comments = noaho.NoAho()
+      self.previous_comments = restoration_index.RestorationIndex(
+          policy=self.retention)
+      self.alive_actions = set()
       old_page = self.page_creation(rev)
       page_state = {
           'rev_id': int(rev['rev_id']),
@@ -481,79 +700,98 @@ class ConversationConstructor(object):
       page_state['rev_id'] = int(rev['rev_id'])
       page_state['timestamp'] = rev['timestamp']
       old_page = page_state['page_state']
-    memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-    logging.debug('MOMERY USAGE BEFORE PROCESSING: %d KB.', memory_usage)
+    if self.alive_actions is None:
+      # Metadata of dead actions may have been kept by older page states.
+      self.compact(page_state)
+      self.alive_actions = set(
+          action[0] for action in old_page['actions'].values())
     # Process the revision to get the actions and update page state
-    new_actions, updated_page = insert(rev, old_page, self.previous_comments,
-                                       self.comment_lowerbound)
-    page_state['page_state'] = updated_page
-    # Post process of the actions:
-    for action in new_actions:
-      # If the action is adding new content
-      # - locate which conversation does it belong to
-      # - record the name of the author into the author list of the comment
-      if action['type'] == 'ADDITION' or action[
-          'type'] == 'MODIFICATION' or action['type'] == 'CREATION':
-        if action['replyTo_id'] is None:
-          page_state['conversation_id'][action['id']] = action['id']
+    with profiling.stage(profile, 'insert'):
+      new_actions, updated_page = insert(rev, old_page, self.previous_comments,
+                                         self.comment_lowerbound, trace)
+    with profiling.stage(profile, 'postprocess'):
+      page_state['page_state'] = updated_page
+      timestamp = restoration_index.parse_timestamp(rev['timestamp'])
+      cleaned_contents = comment_clean.clean_batch(
+          [action['content'] for action in new_actions],
+          cache=comment_clean.cache)
+      # Post process of the actions:
+      for action, cleaned_content in zip(new_actions, cleaned_contents):
+        # If the action is adding new content
+        # - locate which conversation does it belong to
+        # - record the name of the author into the author list of the comment
+        if action['type'] == 'ADDITION' or action[
+            'type'] == 'MODIFICATION' or action['type'] == 'CREATION':
+          if action['replyTo_id'] is None:
+            page_state['conversation_id'][action['id']] = action['id']
+          else:
+            page_state['conversation_id'][
+                action['id']] = page_state['conversation_id'][
+                    action['replyTo_id']]
+          if action['type'] == 'MODIFICATION':
+            page_state['authors'][action['id']] = set(
+                page_state['authors'][action['parent_id']])
+            page_state['authors'][action['id']].add(
+                (action['user_id'], action['user_text']))
+            page_state['ancestor_id'][action['id']] = page_state['ancestor_id'][
+                action['parent_id']]
+          else:
+            page_state['authors'][action['id']] = set([(action['user_id'],
+                                                        action['user_text'])])
+            page_state['ancestor_id'][action['id']] = action['id']
         else:
-          page_state['conversation_id'][
-              action['id']] = page_state['conversation_id'][
-                  action['replyTo_id']]
-        if action['type'] == 'MODIFICATION':
           page_state['authors'][action['id']] = set(
               page_state['authors'][action['parent_id']])
-          page_state['authors'][action['id']].add(
-              (action['user_id'], action['user_text']))
           page_state['ancestor_id'][action['id']] = page_state['ancestor_id'][
               action['parent_id']]
-        else:
-          page_state['authors'][action['id']] = set([(action['user_id'],
-                                                      action['user_text'])])
-          page_state['ancestor_id'][action['id']] = action['id']
-      else:
-        page_state['authors'][action['id']] = set(
-            page_state['authors'][action['parent_id']])
-        page_state['ancestor_id'][action['id']] = page_state['ancestor_id'][
-            action['parent_id']]
-
-      # Removed and restored comments are considered
-      # belonging to the same conversation as its original version.
-      if action['type'] == 'DELETION':
-        page_state['conversation_id'][
-            action['id']] = page_state['conversation_id'][action['parent_id']]
-      if action['type'] == 'RESTORATION':
-        page_state['conversation_id'][
-            action['id']] = page_state['conversation_id'][action['parent_id']]
-      action['conversation_id'] = page_state['conversation_id'][action['id']]
-      action['authors'] = list(page_state['authors'][action['id']])
-      action['page_id'] = rev['page_id']
-      action['page_title'] = rev['page_title']
-      action['cleaned_content'] = rev_clean.clean(action['content'])
-      action['ancestor_id'] = page_state['ancestor_id'][action['id']]
-      # If a comment is deleted, it will be added to a list used for
-      # identifying restoration actions later. Note that comments that
-      # deleted two weeks ago will be removed from the list to ensure
-      # memory efficiency. Also comments that are too long or too short
-      # are ignored in this case.
-      if action['type'] == 'DELETION' and len(
-          action['content']) > self.comment_lowerbound and len(
-              action['content']) < self.comment_upperbound:
-        page_state['deleted_comments'].append(
-            (''.join(action['content']), action['parent_id'],
-             action['indentation']))
-        self.deleted_records[action['parent_id']] = True
-        self.previous_comments.add(''.join(action['content']),
-                                   (action['parent_id'], action['indentation']))
-
-    page_state['conversation_id'] = self.clean_dict(
-        updated_page, page_state['conversation_id'])
-    page_state['authors'] = self.clean_dict(updated_page, page_state['authors'])
-    # Set is not JSON serializable.
-    page_state['authors'] = {
-        action_id: list(authors)
-        for action_id, authors in page_state['authors'].items()
-    }
-    memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-    logging.debug('MOMERY USAGE AFTER POSTPROCESSING: %d KB.', memory_usage)
+
+        # Removed and restored comments are considered
+        # belonging to the same conversation as its original version.
+        if action['type'] == 'DELETION':
+          page_state['conversation_id'][
+              action['id']] = page_state['conversation_id'][action['parent_id']]
+        if action['type'] == 'RESTORATION':
+          page_state['conversation_id'][
+              action['id']] = page_state['conversation_id'][action['parent_id']]
+        action['conversation_id'] = page_state['conversation_id'][action['id']]
+        action['authors'] = list(page_state['authors'][action['id']])
+        action['page_id'] = rev['page_id']
+        action['page_title'] = rev['page_title']
+        action['cleaned_content'] = cleaned_content
+        action['ancestor_id'] = page_state['ancestor_id'][action['id']]
+        if action['type'] == 'RESTORATION':
+          self.previous_comments.touch(''.join(action['content']), timestamp)
+        elif action['type'] == 'ADDITION':
+          self.previous_comments.note_addition(''.join(action['content']))
+        # If a comment is deleted, it will be added to a list used for
+        # identifying restoration actions later. Comments that are too long or
+        # too short are ignored in this case, and comments falling out of the
+        # retention policy are dropped below to bound memory.
+        if action['type'] == 'DELETION' and len(
+            action['content']) > self.comment_lowerbound and len(
+                action['content']) < self.comment_upperbound:
+          content = ''.join(action['content'])
+          page_state['deleted_comments'].append(
+              (content, action['parent_id'], action['indentation'], timestamp))
+          self.deleted_records[action['parent_id']] = True
+          self.previous_comments.add(
+              content, (action['parent_id'], action['indentation']), timestamp)
+      evicted = self.previous_comments.enforce(timestamp)
+      evicted.extend(self.enforce_memory_budget(page_state))
+      if evicted:
+        for action_id, _ in evicted:
+          self.deleted_records.pop(action_id, None)
+        # Keep the serialized deleted comments in line with the index.
+        page_state['deleted_comments'] = self.previous_comments.records()
+      self.prune_metadata(
+          page_state, updated_page,
+          [action['id'] for action in new_actions] +
+          [action_id for action_id, _ in evicted])
+    if trace:
+      trace.event(
+          'processed',
+          actions=len(new_actions),
+          deleted_comments=len(self.previous_comments),
+          evicted=len(evicted),
+          max_rss_kb=tracing.max_rss_kb)
     return page_state, new_actions, rev['text']
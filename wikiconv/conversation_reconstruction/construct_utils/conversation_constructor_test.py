@@ -7,6 +7,8 @@ from __future__ import print_function
 import unittest
 
 from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+from wikiconv.conversation_reconstruction.construct_utils import testing
+from wikiconv.conversation_reconstruction.construct_utils.utils import tracing
 
 
 class ConversationContructorTest(unittest.TestCase):
@@ -41,7 +43,7 @@ class ConversationContructorTest(unittest.TestCase):
                 }
             },
             u"authors": {
-                "332251982.0.0": [(8083618, "Anders Torlind")]
+                "332251982.0.0": {(8083618, "Anders Torlind")}
             },
             u"conversation_id": {
                 "332251982.0.0": "332251982.0.0"
@@ -88,6 +90,113 @@ class ConversationContructorTest(unittest.TestCase):
             332251982
     }])
 
+  def process_history(self, processor, revisions):
+    """Processes revisions, returning the page state and memory usages."""
+    usage = []
+    page_state, _ = testing.replay(
+        revisions, processor,
+        lambda unused_ind, page_state, unused_content: usage.append(
+            processor.memory_usage(page_state)))
+    return page_state, usage
+
+  def rolling_revisions(self, count):
+    """Returns revisions each adding a comment and deleting the oldest one."""
+    return testing.make_revisions(count, max_comments=5)
+
+  def test_memory_budget(self):
+    revisions = self.rolling_revisions(120)
+    budget = 20000
+    _, unbounded_usage = self.process_history(
+        conversation_constructor.ConversationConstructor(), revisions)
+    self.assertGreater(unbounded_usage[-1], 2 * budget)
+    processor = conversation_constructor.ConversationConstructor(
+        memory_budget=budget)
+    page_state, usage = self.process_history(processor, revisions)
+    self.assertLessEqual(max(usage), budget)
+    self.assertGreater(processor.previous_comments.evictions, 0)
+    self.assertEqual(
+        sorted(d[1] for d in page_state["deleted_comments"]),
+        sorted(processor.previous_comments.action_ids()))
+
+  def test_skipped_and_reverted_revisions(self):
+    texts = [
+        ("a", ":First comment, long enough to be kept.\n"),
+        ("b", ":First comment, long enough to be kept.\n\n  \n"),
+        ("c", ":First comment, long enough to be kept.\n:A reply to it.\n"),
+        ("a", ":First comment, long enough to be kept.\n"),
+    ]
+    revisions = [{
+        "user_id": rev_id,
+        "user_text": "User %d" % rev_id,
+        "timestamp": "2001-09-11T18:00:%02dZ" % rev_id,
+        "text": text,
+        "sha1": sha1,
+        "page_title": "placeholder",
+        "page_id": 28031,
+        "rev_id": rev_id
+    } for rev_id, (sha1, text) in enumerate(texts, 1)]
+    processor = conversation_constructor.ConversationConstructor()
+    page_state = None
+    latest_content = ""
+    types = []
+    for rev in revisions:
+      page_state, actions, latest_content = processor.process(
+          page_state, latest_content, dict(rev))
+      types.append([action["type"] for action in actions])
+    self.assertEqual(types, [["ADDITION"], [], ["ADDITION"], ["DELETION"]])
+    self.assertEqual(page_state["rev_id"], 4)
+    self.assertEqual(processor.skipped_revisions, 1)
+    self.assertEqual(processor.reused_cleanings, 1)
+    # The page state after a skipped revision still has its id and timestamp.
+    processor = conversation_constructor.ConversationConstructor()
+    page_state, _, latest_content = processor.process(None, "",
+                                                      dict(revisions[0]))
+    page_state, actions, _ = processor.process(page_state, latest_content,
+                                               dict(revisions[1]))
+    self.assertEqual(actions, [])
+    self.assertEqual((page_state["rev_id"], page_state["timestamp"]),
+                     (2, "2001-09-11T18:00:02Z"))
+
+  def test_bulk_deletion(self):
+    revisions = self.rolling_revisions(5)
+    archived = dict(revisions[-1], rev_id=6, text="{{Archive box}}\n")
+    processor = conversation_constructor.ConversationConstructor()
+    page_state = None
+    latest_content = ""
+    for rev in revisions + [archived]:
+      page_state, actions, latest_content = processor.process(
+          page_state, latest_content, dict(rev))
+    deletions = [action for action in actions if action["type"] == "DELETION"]
+    # The last comment is not followed by a newline, so it is modified.
+    self.assertEqual([action["content"] for action in deletions],
+                     revisions[-1]["text"].splitlines(True)[:-1])
+    self.assertEqual(len(page_state["deleted_comments"]), 4)
+    self.assertEqual(
+        sorted(page_state["page_state"]["actions"]),
+        [0, len(latest_content)])
+
+  def test_tracing(self):
+    events = []
+    tracer = tracing.Tracer(
+        page_ids=["28031"], min_rev_id=7, max_rev_id=8, sink=events.append)
+    self.process_history(
+        conversation_constructor.ConversationConstructor(tracer=tracer),
+        self.rolling_revisions(10))
+    self.assertEqual(set(event["rev_id"] for event in events), {7, 8})
+    found = [event for event in events if event["event"] == "actions_found"]
+    self.assertEqual([event["types"] for event in found],
+                     [["DELETION", "ADDITION"], ["DELETION", "ADDITION"]])
+    self.assertTrue(
+        all(event["max_rss_kb"] > 0
+            for event in events
+            if event["event"] == "processed"))
+    del events[:]
+    tracer.page_ids = set(["1"])
+    self.process_history(
+        conversation_constructor.ConversationConstructor(tracer=tracer),
+        self.rolling_revisions(10))
+    self.assertEqual(events, [])
+
 
 if __name__ == "__main__":
   unittest.main()
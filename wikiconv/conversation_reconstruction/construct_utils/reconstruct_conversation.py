@@ -16,14 +16,24 @@ limitations under the License.
 
 -------------------------------------------------------------------------------
 """
-import copy
+import collections
+import functools
 import json
 import logging
-import os
+import multiprocessing
 import resource
+import time
 
 import apache_beam as beam
+from apache_beam.io import filesystems
+from apache_beam.metrics.metric import Metrics
 from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+from wikiconv.conversation_reconstruction.construct_utils import revision_loader
+from wikiconv.conversation_reconstruction.construct_utils import revision_pipeline
+from wikiconv.conversation_reconstruction.construct_utils import segments
+from wikiconv.conversation_reconstruction.construct_utils.utils import comment_clean
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+from wikiconv.conversation_reconstruction.construct_utils.utils import profiling
 import six
 
 from google.cloud import storage
@@ -32,33 +42,139 @@ from google.cloud import storage
 class ReconstructConversation(beam.DoFn):
   """Wikipedia talk page reconstruction."""
 
-  def __init__(self, storage_client=None):
+  def __init__(self,
+               storage_client=None,
+               retention=None,
+               page_state_format='json',
+               memory_budget=None,
+               tracer=None,
+               prepare_processes=0,
+               snapshot_dir=None,
+               snapshot_interval=None,
+               input_snapshots=None,
+               segment_processes=0,
+               fetch_threads=revision_loader.DEFAULT_THREADS,
+               profiler=None,
+               profile_dir=None):
+    """Constructor.
+
+    Args:
+      storage_client: an optional cloud storage client.
+      retention: an optional restoration_index.RetentionPolicy.
+      page_state_format: the format of output page states, see
+        page_state_codec.
+      memory_budget: an optional number of bytes the state of a page may use.
+        A quarter of it bounds the revisions read ahead.
+      tracer: an optional tracing.Tracer.
+      prepare_processes: number of worker processes cleaning and diffing
+        revisions ahead of their reconstruction, or 0 to do it inline.
+      snapshot_dir: an optional directory to write page snapshots to, see
+        segments.
+      snapshot_interval: number of revisions between the snapshots of pages
+        with more revisions than that.
+      input_snapshots: an optional directory with the snapshots of an earlier
+        run over the same revisions, to reconstruct pages in segments from.
+      segment_processes: number of worker processes reconstructing segments.
+      fetch_threads: number of revisions of big pages read concurrently.
+      profiler: an optional profiling.Profiler selecting the pages whose
+        sequential reconstruction is profiled.
+      profile_dir: the directory the cProfile statistics of pages are written
+        to.
+    """
     self._storage_client = storage_client
+    self._retention = retention
+    self._page_state_format = page_state_format
+    self._memory_budget = memory_budget
+    self._tracer = tracer
+    self._prepare_processes = prepare_processes
+    self._snapshot_dir = snapshot_dir
+    self._snapshot_interval = snapshot_interval
+    self._input_snapshots = input_snapshots
+    self._segment_processes = segment_processes
+    self._fetch_threads = fetch_threads
+    self._profiler = profiler
+    self._profile_dir = profile_dir
+    self._pool = None
+    self._loader = None
+    self.deleted_comment_evictions = Metrics.counter(
+        self.__class__, 'deleted_comment_evictions')
+    self.missed_restorations = Metrics.counter(self.__class__,
+                                               'missed_restorations')
+    self.skipped_revisions = Metrics.counter(self.__class__,
+                                             'skipped_revisions')
+    self.reused_cleanings = Metrics.counter(self.__class__, 'reused_cleanings')
+    self.segmented_pages = Metrics.counter(self.__class__, 'segmented_pages')
+    self.segment_fallbacks = Metrics.counter(self.__class__,
+                                             'segment_fallbacks')
+    self.revision_fetch_latency_ms = Metrics.distribution(
+        self.__class__, 'revision_fetch_latency_ms')
+    self.revision_wait_latency_ms = Metrics.distribution(
+        self.__class__, 'revision_wait_latency_ms')
+    self.profile_stage_ms = {
+        stage: Metrics.distribution(self.__class__, 'profile_%s_ms' % stage)
+        for stage in profiling.STAGES
+    }
+    self.profile_stage_allocated_kb = {
+        stage: Metrics.distribution(self.__class__,
+                                    'profile_%s_allocated_kb' % stage)
+        for stage in profiling.STAGES
+    }
 
   def start_bundle(self):
     if not self._storage_client:
       self._storage_client = storage.Client()
 
-  def merge(self, ps1, ps2):
-    # Merge two page states, ps1 is the later one
-    deleted_ids_ps2 = {d[1]: d for d in ps2['deleted_comments']}
-    deleted_ids_ps1 = {d[1]: d for d in ps1['deleted_comments']}
-    deleted_ids_ps2.update(deleted_ids_ps1)
-    extra_ids = [
-        key for key in deleted_ids_ps2.keys() if key not in deleted_ids_ps1
-    ]
-    ret_p = copy.deepcopy(ps1)
-    ret_p['deleted_comments'] = list(deleted_ids_ps2.values())
-    conv_ids = ps2['conversation_id']
-    auth = ps2['authors']
-    ret_p['conversation_id'] = ret_p['conversation_id']
-    ret_p['authors'] = ret_p['authors']
-    for i in extra_ids:
-      ret_p['conversation_id'][i] = conv_ids[i]
-      ret_p['authors'][i] = auth[i]
-    ret_p['conversation_id'] = ret_p['conversation_id']
-    ret_p['authors'] = ret_p['authors']
-    return ret_p
+  def get_pool(self):
+    if self._pool is None:
+      self._pool = multiprocessing.Pool(
+          max(self._prepare_processes, self._segment_processes))
+    return self._pool
+
+  def teardown(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    if self._loader is not None:
+      self._loader.close()
+      self._loader = None
+
+  def get_loader(self, tmp_input):
+    if self._loader is None or self._loader.tmp_input != tmp_input:
+      if self._loader is not None:
+        self._loader.close()
+      self._loader = revision_loader.RevisionLoader(
+          tmp_input,
+          self._storage_client,
+          threads=self._fetch_threads,
+          max_pending_bytes=(
+              self._memory_budget // 4 if self._memory_budget else
+              revision_loader.DEFAULT_MAX_PENDING_BYTES))
+    return self._loader
+
+  def record_profile(self, profile):
+    """Exports the profile of a page to distributions and its statistics."""
+    summary = self._profiler.finish(profile)
+    for stage, stats in summary['stages'].items():
+      if not stats['calls']:
+        continue
+      self.profile_stage_ms[stage].update(int(stats['seconds'] * 1000))
+      if stats['allocated_bytes'] is not None:
+        self.profile_stage_allocated_kb[stage].update(
+            stats['allocated_bytes'] // 1024)
+    stats = profile.stats()
+    if stats is not None and self._profile_dir:
+      with filesystems.FileSystems.create(
+          filesystems.FileSystems.join(
+              self._profile_dir,
+              profiling.stats_filename(profile.page_id))) as f:
+        f.write(stats)
+
+  def load_revisions(self, page_id, revision_lst, tmp_input):
+    """Yields the revisions of a page, reading their content if needed."""
+    return self.get_loader(tmp_input).load_all(page_id, revision_lst,
+                                               self.revision_fetch_latency_ms,
+                                               self.revision_wait_latency_ms)
 
   def process(self, info, tmp_input):
     """Main reconstruction processing routine.
@@ -70,10 +186,10 @@ class ReconstructConversation(beam.DoFn):
         more revisions than can fit in memory).
 
     Yields:
-      tagged output.
+      tagged output. The 'page_stats' output has the JSON statistics of each
+      reconstructed page, see job_summary.
 
     """
-    log_interval = 100
     # The max memory used in of this process KB, before warning are logged.
     memory_threshold = 1000000
 
@@ -94,13 +210,6 @@ class ReconstructConversation(beam.DoFn):
     if page_state:
       assert len(page_state) == 1
       page_state = page_state[0]
-      page_state['page_state']['actions'] = {
-          int(pos): tuple(val)
-          for pos, val in six.iteritems(page_state['page_state']['actions'])
-      }
-      page_state['authors'] = {}
-      for action_id, authors in six.iteritems(page_state['authors']):
-        page_state['authors'][action_id] = [tuple(author) for author in authors]
     else:
       page_state = None
     if error_log:
@@ -118,97 +227,178 @@ class ReconstructConversation(beam.DoFn):
       if last_revision:
         yield beam.pvalue.TaggedOutput('last_revision',
                                        json.dumps(last_revision))
-        yield beam.pvalue.TaggedOutput('page_states', json.dumps(page_state))
+        # The page state is passed through as it was read, without decoding.
+        if not isinstance(page_state, six.string_types):
+          page_state = json.dumps(page_state)
+        yield beam.pvalue.TaggedOutput('page_states', page_state)
       if error_log:
         yield beam.pvalue.TaggedOutput('error_log', json.dumps(error_log))
       logging.info('Page %s has no sufficient input in this time period.',
                    (page_id))
       return
 
-    processor = conversation_constructor.ConversationConstructor()
+    start_time = time.time()
+    if isinstance(page_state, six.string_types):
+      page_state = page_state_codec.loads(page_state)
+    elif page_state:
+      page_state = page_state_codec.normalize(page_state)
     if page_state:
       logging.info('Page %s existed: loading page state.', (page_id))
-      # Load previous page state.
-      processor.load(page_state['deleted_comments'])
       latest_content = last_revision['text']
     else:
       latest_content = ''
 
     # Initialize
     last_revision_id = 'None'
-    page_state_bak = None
-    cnt = 0
     # Sort revisions by temporal order in memory.
     revision_lst = sorted(rev_ids, key=lambda x: (x['timestamp'], x['rev_id']))
-    last_loading = 0
     logging.info('Reconstruction on page %s started.', (page_id))
-    for key in revision_lst:
-      rev_id_str = str(key['rev_id'])
-      if 'text' not in key:
-        if tmp_input.startswith('gs://'):
-          # Read from cloud storage
-          bucket_name_end = tmp_input.find('/', 5)
-          bucket = self._storage_client.get_bucket(tmp_input[5:bucket_name_end])
-          revision = json.loads(
-              bucket.get_blob(
-                  os.path.join(tmp_input[bucket_name_end + 1:], page_id,
-                               rev_id_str)).download_as_string())
-        else:
-          # Read directly.
-          with open(os.path.join(tmp_input, page_id, rev_id_str), 'r') as f:
-            revision = json.load(f)
-      else:
-        revision = key
-      revision['rev_id'] = int(revision['rev_id'])
-      # Process revision by revision.
-      if 'rev_id' not in revision:
-        continue
-      cnt += 1
-      last_revision_id = revision['rev_id']
-      if not revision['text']:
-        revision['text'] = ''
-      logging.debug('REVISION CONTENT: %s', revision['text'])
-      try:
-        page_state, actions, latest_content = processor.process(
-            page_state, latest_content, revision)
-      except AssertionError:
-        yield beam.pvalue.TaggedOutput(
-            'error_log',
-            json.dumps({
-                'page_id': page_id,
-                'rev_id': last_revision_id
-            }))
-        break
-
-      for action in actions:
-        yield json.dumps(action)
-      memory_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-      if memory_used >= memory_threshold:
-        logging.warn(
-            'MEMORY USED MORE THAN THERESHOLD in PAGE %s REVISION %d : %d KB',
-            revision['page_id'], revision['rev_id'], memory_used)
-      if (cnt % log_interval == 0 and cnt) and page_state:
-        # Reload after every LOG_INTERVAL revisions to keep the low memory
-        # usage.
-        processor = conversation_constructor.ConversationConstructor()
-        page_state_bak = copy.deepcopy(page_state)
-        last_loading = cnt
-        processor.load(page_state['deleted_comments'])
-        page_state['deleted_comments'] = []
-      revision = None
-    if page_state_bak and cnt != last_loading:
-      # Merge the last two page states if a reload happens while processing,
-      # otherwise in a situation where a week's data contains LOG_INTERVAL + 1
-      # revisions, the page state may only contain data from one revision.
-      page_state = self.merge(page_state, page_state_bak)
+    counters = collections.Counter()
+    action_types = collections.Counter()
+    error_rev_id = None
+    failed = False
+    done = 0
+    parts = []
+    if self._input_snapshots and self._segment_processes:
+      parts = segments.split(
+          revision_lst, segments.list_snapshots(self._input_snapshots, page_id))
+    if len(parts) > 1:
+      # Reconstruct the segments between the snapshots of an earlier run in
+      # parallel, as long as they resume from the states it reached.
+      self.segmented_pages.inc()
+      results = segments.reconstruct_segments(
+          self.get_pool(), self._input_snapshots, page_id, page_state,
+          latest_content, parts,
+          functools.partial(self.get_loader(tmp_input).load, page_id),
+          self._retention,
+          self._memory_budget)
+      for ind, result in enumerate(results):
+        for action in result.actions:
+          yield action
+        action_types.update(result.action_types)
+        page_state = result.page_state
+        latest_content = result.latest_content
+        if result.last_rev_id is not None:
+          last_revision_id = result.last_rev_id
+        counters.update({
+            'evictions': result.evictions,
+            'missed_restorations': result.missed_restorations,
+            'skipped_revisions': result.skipped_revisions,
+            'reused_cleanings': result.reused_cleanings
+        })
+        if result.error_rev_id is not None:
+          failed = True
+          error_rev_id = result.error_rev_id
+          yield beam.pvalue.TaggedOutput(
+              'error_log',
+              json.dumps({
+                  'page_id': page_id,
+                  'rev_id': result.error_rev_id
+              }))
+          break
+        done += len(parts[ind][1])
+        if self._snapshot_dir and done < len(revision_lst):
+          segments.write_snapshot(self._snapshot_dir, page_state,
+                                  latest_content)
+      if not failed and done < len(revision_lst):
+        self.segment_fallbacks.inc()
+        logging.warning(
+            'Page %s diverged from its snapshots after %d revisions, '
+            'continuing sequentially.', page_id, done)
+
+    if not failed and done < len(revision_lst):
+      processor = conversation_constructor.ConversationConstructor(
+          self._retention, self._memory_budget, self._tracer, self._profiler)
+      if page_state:
+        # Load previous page state.
+        processor.load(page_state['deleted_comments'],
+                       page_state.get('timestamp'))
+      snapshot_interval = (
+          self._snapshot_interval
+          if self._snapshot_dir and self._snapshot_interval and
+          len(revision_lst) > self._snapshot_interval else None)
+      revisions = self.load_revisions(page_id, revision_lst[done:], tmp_input)
+      if self._prepare_processes and len(revision_lst) - done > 1:
+        # Clean and diff upcoming revisions while the current one is applied.
+        revisions = revision_pipeline.RevisionPipeline(
+            self.get_pool(),
+            max_pending_bytes=(
+                self._memory_budget // 4 if self._memory_budget else
+                revision_pipeline.DEFAULT_MAX_PENDING_BYTES)).prepare(
+                    revisions, latest_content)
+      for ind, revision in enumerate(revisions, done + 1):
+        last_revision_id = revision['rev_id']
+        try:
+          page_state, actions, latest_content = processor.process(
+              page_state, latest_content, revision)
+        except AssertionError:
+          error_rev_id = last_revision_id
+          yield beam.pvalue.TaggedOutput(
+              'error_log',
+              json.dumps({
+                  'page_id': page_id,
+                  'rev_id': last_revision_id
+              }))
+          break
+
+        for action in actions:
+          yield json.dumps(action)
+        action_types.update(action['type'] for action in actions)
+        if (snapshot_interval and not ind % snapshot_interval and
+            ind < len(revision_lst)):
+          page_state['deleted_comments'] = (
+              processor.previous_comments.records())
+          segments.write_snapshot(self._snapshot_dir, page_state,
+                                  latest_content)
+        memory_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if memory_used >= memory_threshold:
+          logging.warn(
+              'MEMORY USED MORE THAN THERESHOLD in PAGE %s REVISION %d : %d KB',
+              revision['page_id'], revision['rev_id'], memory_used)
+        revision = None
+      if page_state:
+        # The restoration index is updated in place, so the page state is
+        # written out from it rather than from the deletions appended while
+        # processing.
+        page_state['deleted_comments'] = processor.previous_comments.records()
+      counters.update({
+          'evictions': processor.previous_comments.evictions,
+          'missed_restorations': processor.previous_comments.missed_restorations,
+          'skipped_revisions': processor.skipped_revisions,
+          'reused_cleanings': processor.reused_cleanings
+      })
+      if processor.profile:
+        self.record_profile(processor.profile)
+    self.deleted_comment_evictions.inc(counters['evictions'])
+    self.missed_restorations.inc(counters['missed_restorations'])
+    self.skipped_revisions.inc(counters['skipped_revisions'])
+    self.reused_cleanings.inc(counters['reused_cleanings'])
     if error_log:
       yield beam.pvalue.TaggedOutput('error_log', json.dumps(error_log))
-    yield beam.pvalue.TaggedOutput('page_states', json.dumps(page_state))
+    yield beam.pvalue.TaggedOutput(
+        'page_states',
+        page_state_codec.dumps(page_state, self._page_state_format))
     yield beam.pvalue.TaggedOutput(
         'last_revision', json.dumps({
             'page_id': page_id,
             'text': latest_content
         }))
+    yield beam.pvalue.TaggedOutput(
+        'page_stats',
+        json.dumps({
+            'page_id': page_id,
+            'revisions': len(revision_lst),
+            'bytes': sum(
+                len(rev['text']) if 'text' in rev else rev.get('length', 0)
+                for rev in revision_lst),
+            'stored': any('text' not in rev for rev in revision_lst),
+            'giant': bool(data.get('giant')),
+            'actions': dict(action_types),
+            'seconds': time.time() - start_time,
+            'error_rev_id': error_rev_id
+        }))
     logging.info(
         'USERLOG: Reconstruction on page %s complete! last revision: %s',
         page_id, last_revision_id)
+    logging.info('USERLOG: Comment cleaning cache: %s',
+                 comment_clean.cache.stats())
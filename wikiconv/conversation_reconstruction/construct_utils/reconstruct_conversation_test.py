@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import marshal
 import os
 import shutil
 import tempfile
@@ -13,6 +14,8 @@ import apache_beam as beam
 from apache_beam.testing import test_pipeline
 from apache_beam.testing import util
 from wikiconv.conversation_reconstruction.construct_utils import reconstruct_conversation
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+from wikiconv.conversation_reconstruction.construct_utils.utils import profiling
 
 
 class FakeStorageClient(object):
@@ -83,6 +86,79 @@ class ReconstructConversationTest(unittest.TestCase):
     pipeline.run()
     shutil.rmtree(tempdir)
 
+  def test_encoded_page_state_passes_through(self):
+    storage_mock = FakeStorageClient()
+    tempdir = tempfile.mkdtemp()
+    encoded = page_state_codec.encode({
+        'page_id': 'page1',
+        'page_state': {
+            'actions': {
+                0: (-1, -1)
+            }
+        },
+        'authors': {}
+    })
+
+    pipeline = test_pipeline.TestPipeline()
+    pc = beam.Create([
+        ('page1', {
+            'last_revision': ['xxx'],
+            'page_state': [encoded],
+            'error_log': [],
+            'to_be_processed': []
+        }),
+    ])
+    res = pipeline | pc | beam.ParDo(
+        reconstruct_conversation.ReconstructConversation(storage_mock),
+        tempdir).with_outputs(
+            'page_states',
+            'last_revision',
+            'error_log',
+            main='reconstruction_results')
+    util.assert_that(
+        res['page_states'], util.equal_to([encoded]), label='page_states')
+    pipeline.run()
+    shutil.rmtree(tempdir)
+
+  def test_profiled_page(self):
+    tempdir = tempfile.mkdtemp()
+    summaries = []
+    revisions = [{
+        'user_id': 1,
+        'user_text': 'someone',
+        'timestamp': '2001-09-11T18:22:%02dZ' % ind,
+        'text': text,
+        'page_title': 'placeholder',
+        'page_id': 'page1',
+        'rev_id': ind
+    } for ind, text in enumerate([
+        'A first comment on the page.\n',
+        'A first comment on the page.\n\n:A reply to it.\n'
+    ])]
+    dofn = reconstruct_conversation.ReconstructConversation(
+        FakeStorageClient(),
+        profiler=profiling.Profiler(
+            page_ids=[], cprofile_page_ids=['page1'], sink=summaries.append),
+        profile_dir=tempdir)
+    outputs = list(
+        dofn.process(('page1', {
+            'last_revision': [],
+            'page_state': [],
+            'error_log': [],
+            'to_be_processed': revisions
+        }), tempdir))
+    self.assertEqual(len([o for o in outputs if isinstance(o, str)]), 2)
+    self.assertEqual(len(summaries), 1)
+    self.assertEqual(summaries[0]['revisions'], 2)
+    self.assertEqual(summaries[0]['stages']['insert']['calls'], 2)
+    self.assertEqual(summaries[0]['stages']['diff']['calls'], 2)
+    with open(os.path.join(tempdir, profiling.stats_filename('page1')),
+              'rb') as f:
+      stats = marshal.loads(f.read())
+    self.assertTrue(
+        any(function == 'compute_diff' for (_, _, function) in stats))
+    shutil.rmtree(tempdir)
+
 
 if __name__ == '__main__':
   unittest.main()
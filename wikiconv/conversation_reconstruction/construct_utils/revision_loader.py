@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Loading of the revisions of big pages, with concurrent read-ahead.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+The revisions of pages with too many revisions to be grouped in memory are
+written to storage, and only their metadata reaches the reconstruction. They
+are written to a few segment files per page, each holding consecutive
+revisions in timestamp order as JSON lines. Next to each segment, an index
+lists the revision id, timestamp, offset and length of its records. The
+metadata passed to the reconstruction carries the same location.
+
+RevisionLoader reads the revisions of a page in a thread pool, in a window
+ahead of the revision being reconstructed. The window is bounded by a number of
+revisions and by the size of the texts read but not yet consumed. Local
+segments are memory-mapped. Segments in cloud storage are read sequentially in
+large chunks, so consecutive revisions cost a single request; the bucket is
+looked up once per loader.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+from concurrent import futures
+import json
+import mmap
+import os
+import threading
+import time
+
+from apache_beam.io import filesystems
+
+from google.cloud import storage
+
+DEFAULT_THREADS = 16
+DEFAULT_MAX_PENDING = 256
+DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+DEFAULT_CHUNK_BYTES = 8 * 1024 * 1024
+SEGMENT_PREFIX = 'segment-'
+INDEX_SUFFIX = '.index'
+# Number of segments kept open by a loader.
+OPEN_SEGMENTS = 4
+
+
+def segment_name(segment):
+  return '%s%05d' % (SEGMENT_PREFIX, segment)
+
+
+def write_segment(tmp_input, page_id, segment, records):
+  """Writes a segment of the revisions of a page, and its index.
+
+  Args:
+    tmp_input: the location revisions of big pages are written to.
+    page_id: the id of the page.
+    segment: the number of the segment in the page.
+    records: the revisions as JSON strings, in timestamp order.
+
+  Returns:
+    The metadata of the revisions, with their location in the segment.
+  """
+  page_dir = filesystems.FileSystems.join(tmp_input, page_id)
+  index = []
+  offset = 0
+  with filesystems.FileSystems.create(
+      filesystems.FileSystems.join(page_dir, segment_name(segment))) as f:
+    for record in records:
+      revision = json.loads(record)
+      data = record.encode('utf-8') + b'\n'
+      f.write(data)
+      index.append({
+          'timestamp': revision['timestamp'],
+          'rev_id': int(revision['rev_id']),
+          'segment': segment,
+          'offset': offset,
+          'length': len(data)
+      })
+      offset += len(data)
+  with filesystems.FileSystems.create(
+      filesystems.FileSystems.join(page_dir,
+                                   segment_name(segment) + INDEX_SUFFIX)) as f:
+    f.write(''.join(json.dumps(entry) + '\n' for entry in index).encode('utf-8'))
+  return index
+
+
+class _LocalSegment(object):
+  """A memory-mapped segment file."""
+
+  def __init__(self, filename):
+    with open(filename, 'rb') as f:
+      self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def read(self, offset, length):
+    return self._data[offset:offset + length]
+
+
+class _BlobSegment(object):
+  """A segment in cloud storage, read sequentially in chunks."""
+
+  def __init__(self, blob, chunk_bytes):
+    self._blob = blob
+    self._chunk_bytes = chunk_bytes
+    self._lock = threading.Lock()
+    self._start = 0
+    self._chunk = b''
+
+  def read(self, offset, length):
+    with self._lock:
+      if (offset < self._start or
+          offset + length > self._start + len(self._chunk)):
+        self._start = offset
+        self._chunk = self._blob.download_as_string(
+            start=offset, end=offset + max(length, self._chunk_bytes) - 1)
+      return self._chunk[offset - self._start:offset - self._start + length]
+
+
+class RevisionLoader(object):
+  """Loads revisions from where the revisions of big pages were written."""
+
+  def __init__(self,
+               tmp_input,
+               storage_client=None,
+               threads=DEFAULT_THREADS,
+               max_pending=DEFAULT_MAX_PENDING,
+               max_pending_bytes=DEFAULT_MAX_PENDING_BYTES,
+               chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Constructor.
+
+    Args:
+      tmp_input: the location revisions of big pages were written to, a local
+        directory or a gs:// path.
+      storage_client: the cloud storage client, created when first needed if
+        None.
+      threads: number of revisions read concurrently.
+      max_pending: number of revisions that may be read ahead.
+      max_pending_bytes: size of the stored revisions that may be read ahead,
+        counted from when their read is submitted.
+      chunk_bytes: size of the reads from segments in cloud storage.
+    """
+    self.tmp_input = tmp_input
+    self.threads = threads
+    self.max_pending = max_pending
+    self.max_pending_bytes = max_pending_bytes
+    self.chunk_bytes = chunk_bytes
+    self._storage_client = storage_client
+    self._bucket = None
+    self._prefix = None
+    self._executor = None
+    self._segments = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __getstate__(self):
+    # Worker processes create their own client, thread pool and segments.
+    state = dict(self.__dict__)
+    state.update(
+        _storage_client=None,
+        _bucket=None,
+        _executor=None,
+        _segments=collections.OrderedDict(),
+        _lock=None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def _get_segment(self, page_id, segment):
+    """Returns the open segment of a page, opening it if needed."""
+    with self._lock:
+      key = (page_id, segment)
+      if key in self._segments:
+        return self._segments[key]
+      if self.tmp_input.startswith('gs://'):
+        if self._bucket is None:
+          bucket_name_end = self.tmp_input.find('/', 5)
+          if self._storage_client is None:
+            self._storage_client = storage.Client()
+          self._bucket = self._storage_client.get_bucket(
+              self.tmp_input[5:bucket_name_end])
+          self._prefix = self.tmp_input[bucket_name_end + 1:]
+        opened = _BlobSegment(
+            self._bucket.get_blob(
+                os.path.join(self._prefix, page_id, segment_name(segment))),
+            self.chunk_bytes)
+      else:
+        opened = _LocalSegment(
+            os.path.join(self.tmp_input, page_id, segment_name(segment)))
+      # Segments are read in order, so the oldest open one is done with. It is
+      # closed once the reads still using it are over.
+      self._segments[key] = opened
+      if len(self._segments) > OPEN_SEGMENTS:
+        self._segments.popitem(last=False)
+      return opened
+
+  def read(self, page_id, key):
+    """Reads a revision, and the time it took in milliseconds.
+
+    Args:
+      page_id: the id of the page.
+      key: the revision, or its metadata if the revision was written to storage.
+
+    Returns:
+      A tuple of the revision dictionary and the read latency, which is None
+      when the revision did not need to be read.
+    """
+    if 'text' in key:
+      return normalize(key), None
+    start = time.time()
+    data = self._get_segment(page_id, key['segment']).read(
+        key['offset'], key['length'])
+    revision = json.loads(data.decode('utf-8'))
+    return normalize(revision), int((time.time() - start) * 1000)
+
+  def load(self, page_id, key):
+    """Returns a revision, reading its content if it was stored."""
+    return self.read(page_id, key)[0]
+
+  def load_all(self, page_id, keys, fetch_latency=None, wait_latency=None):
+    """Yields the revisions of a page, reading ahead of the caller.
+
+    Args:
+      page_id: the id of the page.
+      keys: the revisions or their metadata, in the order to yield them.
+      fetch_latency: an optional distribution updated with the read latency of
+        each stored revision, in milliseconds.
+      wait_latency: an optional distribution updated with the time spent
+        waiting for each stored revision to be read, in milliseconds.
+
+    Yields:
+      The revision dictionaries, in order.
+    """
+    keys = iter(keys)
+    # Pairs of a revision, or the future reading it, and the size of its
+    # record, counted from when the read is submitted until it is consumed.
+    pending = collections.deque()
+    pending_bytes = 0
+    exhausted = False
+    try:
+      while True:
+        while not exhausted and (not pending or
+                                 self._has_room(len(pending), pending_bytes)):
+          key = next(keys, None)
+          if key is None:
+            exhausted = True
+          elif 'text' in key:
+            pending.append((key, 0))
+          else:
+            pending.append((self._get_executor().submit(self.read, page_id,
+                                                        key), key['length']))
+            pending_bytes += key['length']
+        if not pending:
+          return
+        entry, size = pending.popleft()
+        pending_bytes -= size
+        if not isinstance(entry, futures.Future):
+          yield normalize(entry)
+          continue
+        start = time.time()
+        revision, latency = entry.result()
+        if wait_latency is not None:
+          wait_latency.update(int((time.time() - start) * 1000))
+        if fetch_latency is not None:
+          fetch_latency.update(latency)
+        yield revision
+    finally:
+      # The caller may stop early, e.g. when the reconstruction fails.
+      for entry, _ in pending:
+        if isinstance(entry, futures.Future):
+          entry.cancel()
+
+  def _has_room(self, count, size):
+    """Returns whether another read may be submitted.
+
+    Args:
+      count: the number of revisions read ahead and not yet consumed.
+      size: the size of their records in the segments, in bytes.
+    """
+    return count < self.max_pending and size < self.max_pending_bytes
+
+  def _get_executor(self):
+    if self._executor is None:
+      self._executor = futures.ThreadPoolExecutor(self.threads)
+    return self._executor
+
+  def close(self):
+    if self._executor is not None:
+      self._executor.shutdown()
+      self._executor = None
+    self._segments.clear()
+
+
+def normalize(revision):
+  revision['rev_id'] = int(revision['rev_id'])
+  if not revision['text']:
+    revision['text'] = ''
+  return revision
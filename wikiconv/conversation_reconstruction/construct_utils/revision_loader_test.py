@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Tests for revision_loader."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils import revision_loader
+
+PAGE_ID = '28031'
+
+
+def make_revisions(count):
+  return [{
+      'rev_id': rev_id,
+      'page_id': PAGE_ID,
+      'timestamp': 1558015201000 + rev_id,
+      'text': 'Text of revision %d.' % rev_id if rev_id % 5 else None
+  } for rev_id in range(1, count + 1)]
+
+
+class FakeBlob(object):
+
+  def __init__(self, data, on_download):
+    self._data = data
+    self._on_download = on_download
+
+  def download_as_string(self, start=None, end=None):
+    self._on_download()
+    return self._data[start:end + 1]
+
+
+class FakeBucket(object):
+
+  def __init__(self, blobs, on_download):
+    self.blobs = blobs
+    self._on_download = on_download
+
+  def get_blob(self, name):
+    return FakeBlob(self.blobs[name], self._on_download)
+
+
+class FakeStorageClient(object):
+  """A storage client serving blobs from a dictionary."""
+
+  def __init__(self, bucket_name, blobs):
+    self.bucket_name = bucket_name
+    self.blobs = blobs
+    self.get_bucket_calls = 0
+    self.downloads = 0
+    self.delay = 0
+    self.release = threading.Event()
+    self.release.set()
+    self._lock = threading.Lock()
+
+  def on_download(self):
+    self.release.wait()
+    time.sleep(self.delay)
+    with self._lock:
+      self.downloads += 1
+
+  def get_bucket(self, name):
+    assert name == self.bucket_name
+    self.get_bucket_calls += 1
+    return FakeBucket(self.blobs, self.on_download)
+
+
+class Distribution(object):
+
+  def __init__(self):
+    self.values = []
+
+  def update(self, value):
+    self.values.append(value)
+
+
+def write_segments(tmp_input, revisions, per_segment):
+  """Writes revisions to segments, returning their metadata."""
+  ret = []
+  for segment, start in enumerate(range(0, len(revisions), per_segment)):
+    ret.extend(
+        revision_loader.write_segment(
+            tmp_input, PAGE_ID, segment,
+            [json.dumps(rev) for rev in revisions[start:start + per_segment]]))
+  return ret
+
+
+def fake_client(revisions, per_segment):
+  """Returns a FakeStorageClient serving the segments of revisions."""
+  tempdir = tempfile.mkdtemp()
+  metadata = write_segments(tempdir, revisions, per_segment)
+  blobs = {}
+  for name in os.listdir(os.path.join(tempdir, PAGE_ID)):
+    with open(os.path.join(tempdir, PAGE_ID, name), 'rb') as f:
+      blobs['path/%s/%s' % (PAGE_ID, name)] = f.read()
+  shutil.rmtree(tempdir)
+  return FakeStorageClient('bucket', blobs), metadata
+
+
+def normalized(revisions):
+  return [
+      dict(rev, text=rev['text'] or '', rev_id=int(rev['rev_id']))
+      for rev in revisions
+  ]
+
+
+class RevisionLoaderTest(unittest.TestCase):
+
+  def test_local_directory(self):
+    tempdir = tempfile.mkdtemp()
+    revisions = make_revisions(30)
+    metadata = write_segments(
+        tempdir, [dict(rev, rev_id=str(rev['rev_id'])) for rev in revisions], 7)
+    self.assertEqual(
+        sorted(os.listdir(os.path.join(tempdir, PAGE_ID)))[:2],
+        ['segment-00000', 'segment-00000.index'])
+    with open(os.path.join(tempdir, PAGE_ID, 'segment-00001.index')) as f:
+      self.assertEqual([json.loads(line) for line in f], metadata[7:14])
+    loader = revision_loader.RevisionLoader(tempdir, threads=4, max_pending=8)
+    fetch_latency = Distribution()
+    wait_latency = Distribution()
+    # Revisions that were not written to storage are passed through.
+    keys = metadata[:20] + make_revisions(30)[20:]
+    self.assertEqual(
+        list(loader.load_all(PAGE_ID, keys, fetch_latency, wait_latency)),
+        normalized(revisions))
+    self.assertEqual(len(fetch_latency.values), 20)
+    self.assertEqual(len(wait_latency.values), 20)
+    self.assertEqual(
+        loader.load(PAGE_ID, metadata[2]), normalized(revisions)[2])
+    loader.close()
+    shutil.rmtree(tempdir)
+
+  def test_object_store(self):
+    revisions = make_revisions(40)
+    client, metadata = fake_client(revisions, 10)
+    loader = revision_loader.RevisionLoader(
+        'gs://bucket/path', client, threads=4, max_pending=6, chunk_bytes=200)
+    self.assertEqual(
+        list(loader.load_all(PAGE_ID, metadata)), normalized(revisions))
+    self.assertEqual(client.get_bucket_calls, 1)
+    # Consecutive revisions are read in chunks.
+    self.assertLess(client.downloads, 40)
+    loader.close()
+
+  def test_read_ahead_is_bounded(self):
+    revisions = make_revisions(40)
+    client, metadata = fake_client(revisions, 40)
+    # Reads are slow, so most are still in flight when the next is submitted.
+    client.delay = 0.01
+    length = max(key['length'] for key in metadata)
+    state = {}
+
+    def keys():
+      for key in metadata:
+        state['requested'].append(key['rev_id'])
+        state['bytes'] += key['length']
+        state['peak'] = max(state['peak'], state['bytes'])
+        yield key
+
+    for max_pending, max_pending_bytes in ((5, 10**6), (40, 3 * length)):
+      state.update(requested=[], bytes=0, peak=0)
+      loader = revision_loader.RevisionLoader(
+          'gs://bucket/path',
+          client,
+          threads=4,
+          max_pending=max_pending,
+          max_pending_bytes=max_pending_bytes,
+          chunk_bytes=1)
+      for rev, key in zip(loader.load_all(PAGE_ID, keys()), metadata):
+        self.assertLessEqual(
+            len(state['requested']), rev['rev_id'] + max_pending)
+        state['bytes'] -= key['length']
+      self.assertEqual(len(state['requested']), 40)
+      self.assertLessEqual(state['peak'], max_pending_bytes + length)
+      loader.close()
+
+  def test_stopping_early_cancels_reads(self):
+    revisions = make_revisions(40)
+    client, metadata = fake_client(revisions, 40)
+    loader = revision_loader.RevisionLoader(
+        'gs://bucket/path', client, threads=1, max_pending=10, chunk_bytes=1)
+    loaded = loader.load_all(PAGE_ID, metadata)
+    self.assertEqual(next(loaded)['rev_id'], 1)
+    client.release.clear()
+    loaded.close()
+    client.release.set()
+    loader.close()
+    self.assertLess(client.downloads, 12)
+
+  def test_pickling(self):
+    client = FakeStorageClient('bucket', {})
+    loader = revision_loader.RevisionLoader('gs://bucket/path', client)
+    unpickled = pickle.loads(pickle.dumps(loader))
+    self.assertEqual(unpickled.tmp_input, 'gs://bucket/path')
+    self.assertIsNone(unpickled._storage_client)  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Cleaning and diffing of revisions ahead of their reconstruction.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Reconstructing a page is sequential: each revision updates the page state the
+next one is applied to. Cleaning the HTML of a revision and diffing it against
+the previous cleaned revision do not depend on the page state, and on long
+pages they are most of the work.
+
+RevisionPipeline hands these steps to a process pool. While the caller applies
+revision i, revisions i+1, i+2, ... are cleaned, and each is diffed as soon as
+it and its predecessor are clean. Revisions are read ahead only while the
+texts of the pending revisions fit in a byte budget, so a page with large
+revisions is not loaded into memory at once; at least one revision is always
+pending.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+
+from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+
+DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_PENDING = 64
+
+
+class _Pending(object):
+  """A revision read ahead, with the state of its preparation."""
+
+  def __init__(self, rev):
+    self.rev = rev
+    self.size = len(rev['text'])
+    self.cleaned = None
+    self.diff = None
+    self.error = None
+
+
+class RevisionPipeline(object):
+  """Cleans and diffs the revisions of a page in a process pool."""
+
+  def __init__(self,
+               pool,
+               max_pending_bytes=DEFAULT_MAX_PENDING_BYTES,
+               max_pending=DEFAULT_MAX_PENDING):
+    """Constructor.
+
+    Args:
+      pool: the multiprocessing pool to clean and diff revisions in.
+      max_pending_bytes: size of the revision texts that may be read ahead.
+      max_pending: number of revisions that may be read ahead.
+    """
+    self._pool = pool
+    self.max_pending_bytes = max_pending_bytes
+    self.max_pending = max_pending
+
+  def prepare(self, revisions, latest_content):
+    """Prepares revisions for ConversationConstructor.process.
+
+    Args:
+      revisions: iterable of revision dictionaries, in the order they are
+        processed. Their text must not be None.
+      latest_content: the cleaned text of the latest processed revision.
+
+    Yields:
+      The revisions, in order, with their text cleaned and their diff set.
+    """
+    revisions = iter(revisions)
+    condition = threading.Condition()
+    pending = {}
+    # Sequence number of the next revision to yield, and the cleaned text of
+    # the revision before it.
+    state = {'next': 0, 'latest': latest_content, 'read': 0, 'bytes': 0}
+    exhausted = []
+
+    def previous_text(seq):
+      if seq == state['next']:
+        return state['latest']
+      previous = pending.get(seq - 1)
+      return previous.cleaned if previous else None
+
+    def submit_diff(seq):
+      entry = pending.get(seq)
+      if entry is None or entry.cleaned is None or entry.diff is not None:
+        return
+      previous = previous_text(seq)
+      if previous is None:
+        return
+      entry.diff = self._pool.apply_async(conversation_constructor.compute_diff,
+                                          (previous, entry.cleaned))
+      condition.notify_all()
+
+    def on_cleaned(seq, cleaned):
+      with condition:
+        pending[seq].cleaned = cleaned
+        submit_diff(seq)
+        submit_diff(seq + 1)
+
+    def on_error(seq, error):
+      with condition:
+        pending[seq].error = error
+        condition.notify_all()
+
+    def read_ahead():
+      while not exhausted and (not pending or
+                               (len(pending) < self.max_pending and
+                                state['bytes'] < self.max_pending_bytes)):
+        try:
+          rev = next(revisions)
+        except StopIteration:
+          exhausted.append(True)
+          return
+        seq = state['read']
+        entry = _Pending(rev)
+        with condition:
+          pending[seq] = entry
+          state['read'] += 1
+          state['bytes'] += entry.size
+        self._pool.apply_async(
+            conversation_constructor.clean_revision, (rev['text'],),
+            callback=lambda cleaned, seq=seq: on_cleaned(seq, cleaned),
+            error_callback=lambda error, seq=seq: on_error(seq, error))
+
+    read_ahead()
+    while pending:
+      seq = state['next']
+      entry = pending[seq]
+      with condition:
+        while entry.diff is None and entry.error is None:
+          condition.wait()
+      if entry.error is not None:
+        raise entry.error
+      diff = entry.diff.get()
+      with condition:
+        del pending[seq]
+        state['next'] += 1
+        state['latest'] = entry.cleaned
+        state['bytes'] -= entry.size
+        submit_diff(seq + 1)
+      rev = entry.rev
+      rev['text'] = entry.cleaned
+      rev['diff'] = diff
+      read_ahead()
+      yield rev
@@ -0,0 +1,83 @@
+"""Tests for revision_pipeline."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+from wikiconv.conversation_reconstruction.construct_utils import revision_pipeline
+from wikiconv.conversation_reconstruction.construct_utils import testing
+
+
+def make_revisions(count):
+  """Returns revisions of a page where comments are added and edited."""
+  return testing.make_revisions(
+      count, comment="<b>Comment</b> number %d, which is long enough.",
+      edit_every=3)
+
+
+def reconstruct(revisions):
+  return testing.replay(revisions)[1]
+
+
+class RevisionPipelineTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.pool = multiprocessing.Pool(2)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.pool.close()
+    cls.pool.join()
+
+  def test_prepare(self):
+    expected = []
+    latest_content = "Old text.\n"
+    for rev in make_revisions(20):
+      text = conversation_constructor.clean_revision(rev["text"])
+      expected.append(
+          (rev["rev_id"], text,
+           conversation_constructor.compute_diff(latest_content, text)))
+      latest_content = text
+    for max_pending_bytes in (1, 1000, 10**6):
+      pipeline = revision_pipeline.RevisionPipeline(
+          self.pool, max_pending_bytes=max_pending_bytes, max_pending=4)
+      self.assertEqual([(rev["rev_id"], rev["text"], rev["diff"])
+                        for rev in pipeline.prepare(
+                            make_revisions(20), "Old text.\n")], expected)
+
+  def test_read_ahead_is_bounded(self):
+    read = []
+
+    def revisions():
+      for rev in make_revisions(10):
+        read.append(rev["rev_id"])
+        yield rev
+
+    pipeline = revision_pipeline.RevisionPipeline(self.pool, max_pending=3)
+    for rev in pipeline.prepare(revisions(), ""):
+      self.assertLessEqual(len(read), rev["rev_id"] + 3)
+    self.assertEqual(len(read), 10)
+
+  def test_errors_are_raised(self):
+    revisions = make_revisions(3)
+    # Cleaning fails in the worker on bytes.
+    revisions[1]["text"] = b"bytes"
+    pipeline = revision_pipeline.RevisionPipeline(self.pool)
+    with self.assertRaises(TypeError):
+      list(pipeline.prepare(revisions, ""))
+
+  def test_reconstruction(self):
+    pipeline = revision_pipeline.RevisionPipeline(self.pool)
+    expected = reconstruct(make_revisions(30))
+    self.assertEqual(len(expected), 30)
+    self.assertEqual(
+        reconstruct(pipeline.prepare(make_revisions(30), "")), expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
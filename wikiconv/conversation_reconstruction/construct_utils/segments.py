@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Reconstruction of long page histories in segments between snapshots.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Reconstructing a page is sequential, so a page with a very long history keeps
+one worker busy long after the others are done. While reconstructing a long
+history, the pipeline can write a snapshot every few revisions: the page state
+after a revision, and the cleaned text of that revision. Together they are all
+the constructor needs to resume from that revision.
+
+When the same history is reconstructed again, e.g. after a fix to the
+constructor, it is split after each revision with a snapshot. Every segment
+starts from the snapshot before it, so segments can be reconstructed in
+parallel. Their actions are concatenated in segment order.
+
+A snapshot taken by an earlier run is only a valid starting point if the
+constructor reaches the same state at that revision. The state at the end of
+each segment is therefore compared with the snapshot the next segment starts
+from. From the first mismatch on, the remaining segments are discarded and the
+history is reconstructed sequentially from the verified state, so the output is
+always that of a sequential run.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import json
+import posixpath
+
+from apache_beam.io import filesystems
+from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+import six
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+
+def snapshot_path(snapshot_dir, page_id, rev_id):
+  return filesystems.FileSystems.join(
+      snapshot_dir, six.text_type(page_id),
+      '%d%s' % (int(rev_id), SNAPSHOT_SUFFIX))
+
+
+def write_snapshot(snapshot_dir, page_state, latest_content):
+  """Writes the snapshot of a page after its latest processed revision.
+
+  Args:
+    snapshot_dir: the directory of the snapshots.
+    page_state: dictionary, with the deleted comments as index records.
+    latest_content: the cleaned text of the latest processed revision.
+
+  Returns:
+    The path of the snapshot.
+  """
+  path = snapshot_path(snapshot_dir, page_state['page_id'],
+                       page_state['rev_id'])
+  data = json.dumps({
+      'page_state': page_state_codec.dumps(page_state, 'binary'),
+      'latest_content': latest_content
+  })
+  with filesystems.FileSystems.create(path) as f:
+    f.write(data.encode('utf-8'))
+  return path
+
+
+def read_snapshot(snapshot_dir, page_id, rev_id):
+  """Returns the page state and latest content of a snapshot."""
+  with filesystems.FileSystems.open(
+      snapshot_path(snapshot_dir, page_id, rev_id)) as f:
+    data = json.loads(f.read().decode('utf-8'))
+  return page_state_codec.loads(data['page_state']), data['latest_content']
+
+
+def list_snapshots(snapshot_dir, page_id):
+  """Returns the set of revision ids of a page that have a snapshot."""
+  pattern = filesystems.FileSystems.join(snapshot_dir, six.text_type(page_id),
+                                         '*' + SNAPSHOT_SUFFIX)
+  match = filesystems.FileSystems.match([pattern])[0]
+  return set(
+      int(posixpath.basename(metadata.path)[:-len(SNAPSHOT_SUFFIX)])
+      for metadata in match.metadata_list)
+
+
+def fingerprint(page_state, latest_content):
+  """Returns a digest of the state the reconstruction of a page resumes from.
+
+  Author sets do not affect the digest. The order of the deleted comments
+  does, as it decides which are evicted first.
+
+  Args:
+    page_state: dictionary.
+    latest_content: the cleaned text of the latest processed revision.
+
+  Returns:
+    The hexadecimal SHA-1 digest.
+  """
+  canonical = dict(page_state)
+  canonical['authors'] = {
+      action_id: sorted(list(author) for author in authors)
+      for action_id, authors in six.iteritems(page_state.get('authors', {}))
+  }
+  canonical['deleted_comments'] = [
+      list(record) for record in page_state.get('deleted_comments', [])
+  ]
+  canonical['page_state'] = dict(page_state['page_state'])
+  canonical['page_state']['actions'] = sorted(
+      [offset, list(action)]
+      for offset, action in six.iteritems(page_state['page_state']['actions']))
+  data = json.dumps([canonical, latest_content], sort_keys=True)
+  return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def split(revisions, snapshot_rev_ids):
+  """Splits the sorted revisions of a page after each one with a snapshot.
+
+  Args:
+    revisions: the revisions, or revision keys, in processing order.
+    snapshot_rev_ids: set of the revision ids with a snapshot.
+
+  Returns:
+    A list of (start, revisions) pairs, where start is the id of the revision
+    whose snapshot the segment starts from, or None for the first segment.
+  """
+  segments = []
+  start = None
+  current = []
+  for rev in revisions:
+    current.append(rev)
+    if int(rev['rev_id']) in snapshot_rev_ids:
+      segments.append((start, current))
+      start = int(rev['rev_id'])
+      current = []
+  if current:
+    segments.append((start, current))
+  return segments
+
+
+class SegmentResult(object):
+  """The outcome of reconstructing a segment.
+
+  Attributes:
+    actions: the JSON serialized actions, in order.
+    action_types: a Counter of the types of the actions.
+    page_state: the page state after the last processed revision.
+    latest_content: the cleaned text of the last processed revision.
+    last_rev_id: id of the last revision processed, or None.
+    error_rev_id: id of the revision the reconstruction failed on, or None.
+    evictions, missed_restorations, skipped_revisions, reused_cleanings: the
+      counters of the constructor.
+  """
+
+  def __init__(self, page_state, latest_content):
+    self.actions = []
+    self.action_types = collections.Counter()
+    self.page_state = page_state
+    self.latest_content = latest_content
+    self.last_rev_id = None
+    self.error_rev_id = None
+    self.evictions = 0
+    self.missed_restorations = 0
+    self.skipped_revisions = 0
+    self.reused_cleanings = 0
+
+
+def reconstruct(processor, page_state, latest_content, revisions):
+  """Applies revisions to a loaded constructor, collecting the results.
+
+  Args:
+    processor: a ConversationConstructor, loaded with page_state.
+    page_state: dictionary, or None for a new page.
+    latest_content: the cleaned text of the latest processed revision.
+    revisions: iterable of revision dictionaries.
+
+  Returns:
+    A SegmentResult. Its page state has the deleted comments as index records.
+  """
+  result = SegmentResult(page_state, latest_content)
+  for revision in revisions:
+    try:
+      result.page_state, actions, result.latest_content = processor.process(
+          result.page_state, result.latest_content, revision)
+    except AssertionError:
+      result.error_rev_id = revision['rev_id']
+      break
+    result.last_rev_id = revision['rev_id']
+    result.actions.extend(json.dumps(action) for action in actions)
+    result.action_types.update(action['type'] for action in actions)
+  if result.page_state:
+    result.page_state['deleted_comments'] = (
+        processor.previous_comments.records())
+  result.evictions = processor.previous_comments.evictions
+  result.missed_restorations = processor.previous_comments.missed_restorations
+  result.skipped_revisions = processor.skipped_revisions
+  result.reused_cleanings = processor.reused_cleanings
+  return result
+
+
+def new_processor(page_state, retention=None, memory_budget=None):
+  """Returns a ConversationConstructor loaded with page_state."""
+  processor = conversation_constructor.ConversationConstructor(
+      retention, memory_budget)
+  if page_state:
+    processor.load(page_state['deleted_comments'], page_state.get('timestamp'))
+  return processor
+
+
+def reconstruct_segment(task):
+  """Reconstructs a segment, in a worker process.
+
+  Args:
+    task: a tuple of the snapshot directory, the page id, the id of the
+      revision whose snapshot the segment starts from (or None), the page state
+      and latest content to start from when there is no such snapshot, the
+      revision keys, a function loading a revision from its key, and the
+      retention policy and memory budget of the constructor.
+
+  Returns:
+    A tuple of the SegmentResult and the fingerprints of the states the segment
+    started from and ended with. The reconstruction may fail in any way when
+    the snapshot does not match the state a sequential run reaches, so an
+    exception is returned in place of the result until the snapshot has been
+    verified.
+  """
+  (snapshot_dir, page_id, start, initial, keys, load_revision, retention,
+   memory_budget) = task
+  if start is None:
+    page_state, latest_content = initial
+  else:
+    page_state, latest_content = read_snapshot(snapshot_dir, page_id, start)
+  start_fingerprint = (
+      fingerprint(page_state, latest_content) if page_state else None)
+  try:
+    result = reconstruct(
+        new_processor(page_state, retention, memory_budget), page_state,
+        latest_content, (load_revision(key) for key in keys))
+  except Exception as e:  # pylint: disable=broad-except
+    return e, start_fingerprint, None
+  return (result, start_fingerprint,
+          fingerprint(result.page_state, result.latest_content)
+          if result.page_state else None)
+
+
+def reconstruct_segments(pool, snapshot_dir, page_id, page_state,
+                         latest_content, parts, load_revision, retention=None,
+                         memory_budget=None):
+  """Reconstructs the segments of a page in parallel.
+
+  Args:
+    pool: the multiprocessing pool to reconstruct segments in.
+    snapshot_dir: the directory of the snapshots the segments start from.
+    page_id: the id of the page.
+    page_state: the page state the first segment starts from, or None.
+    latest_content: the cleaned text the first segment starts from.
+    parts: the segments, as returned by split.
+    load_revision: a picklable function loading a revision from its key.
+    retention: the retention policy of the constructor.
+    memory_budget: the memory budget of the constructor.
+
+  Yields:
+    The SegmentResults of the segments, in order, as long as each starts from
+    the state the segment before it ended with. When the reconstruction of a
+    segment fails, it is the last one yielded.
+  """
+  tasks = [(snapshot_dir, page_id, start,
+            (page_state, latest_content) if start is None else None, keys,
+            load_revision, retention, memory_budget) for start, keys in parts]
+  previous = None
+  for ind, (result, start_fingerprint,
+            end_fingerprint) in enumerate(pool.imap(reconstruct_segment, tasks)):
+    if ind and start_fingerprint != previous:
+      return
+    if isinstance(result, Exception):
+      raise result
+    yield result
+    if result.error_rev_id is not None:
+      return
+    previous = end_fingerprint
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Tests for segments."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import multiprocessing
+import shutil
+import tempfile
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils import segments
+from wikiconv.conversation_reconstruction.construct_utils import testing
+from wikiconv.conversation_reconstruction.construct_utils.utils import restoration_index
+
+PAGE_ID = testing.PAGE_ID
+
+
+def normalized(actions):
+  """Returns the actions with their authors sorted."""
+  ret = []
+  for action in actions:
+    action = json.loads(action)
+    action['authors'] = sorted(action['authors'])
+    ret.append(action)
+  return ret
+
+
+def rolling_revisions(count):
+  """Returns revisions each adding a comment and deleting an older one."""
+  return testing.make_revisions(
+      count, max_comments=4, deleted=lambda rev_id: rev_id % 3,
+      restore_every=7, page_id=PAGE_ID)
+
+
+def sequential(revisions, snapshot_dir=None, interval=None, retention=None):
+  """Reconstructs revisions in one go, writing a snapshot every interval."""
+  processor = segments.new_processor(None, retention)
+
+  def write_snapshot(ind, page_state, latest_content):
+    if interval and not ind % interval:
+      page_state['deleted_comments'] = processor.previous_comments.records()
+      segments.write_snapshot(snapshot_dir, page_state, latest_content)
+
+  _, actions = testing.replay(revisions, processor, write_snapshot)
+  return normalized([json.dumps(action) for action in actions])
+
+
+class SegmentsTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.pool = multiprocessing.Pool(2)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.pool.close()
+    cls.pool.join()
+
+  def setUp(self):
+    self.snapshot_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.snapshot_dir)
+
+  def reconstruct_segments(self, revisions, retention=None):
+    parts = segments.split(
+        revisions, segments.list_snapshots(self.snapshot_dir, PAGE_ID))
+    actions = []
+    done = 0
+    for ind, result in enumerate(
+        segments.reconstruct_segments(self.pool, self.snapshot_dir, PAGE_ID,
+                                      None, '', parts, dict, retention)):
+      self.assertIsNone(result.error_rev_id)
+      actions.extend(result.actions)
+      done += len(parts[ind][1])
+    return normalized(actions), done
+
+  def test_split(self):
+    revisions = [{'rev_id': rev_id} for rev_id in range(1, 8)]
+    self.assertEqual(
+        segments.split(revisions, {3, 7}),
+        [(None, revisions[:3]), (3, revisions[3:])])
+    self.assertEqual(segments.split(revisions, set()), [(None, revisions)])
+
+  def test_snapshot(self):
+    page_state = {
+        'page_id': PAGE_ID,
+        'rev_id': 12,
+        'timestamp': 1000000000,
+        'authors': {
+            '12.0.0': {(12, 'User 12')}
+        },
+        'ancestor_id': {},
+        'deleted_comments': [('Deleted.\n', '11.0.0', 1, 999999999)],
+        'page_state': {
+            'actions': {
+                0: ('12.0.0', 0),
+                8: (-1, -1)
+            }
+        }
+    }
+    path = segments.write_snapshot(self.snapshot_dir, page_state, 'Content.\n')
+    self.assertTrue(path.endswith(segments.SNAPSHOT_SUFFIX))
+    self.assertEqual(segments.list_snapshots(self.snapshot_dir, PAGE_ID), {12})
+    self.assertEqual(
+        segments.list_snapshots(self.snapshot_dir, PAGE_ID + 1), set())
+    loaded, latest_content = segments.read_snapshot(self.snapshot_dir, PAGE_ID,
+                                                    12)
+    self.assertEqual(latest_content, 'Content.\n')
+    self.assertEqual(
+        segments.fingerprint(loaded, latest_content),
+        segments.fingerprint(page_state, 'Content.\n'))
+    self.assertNotEqual(
+        segments.fingerprint(loaded, latest_content),
+        segments.fingerprint(page_state, 'Other content.\n'))
+
+  def test_segments_match_sequential_run(self):
+    revisions = rolling_revisions(50)
+    expected = sequential(revisions, self.snapshot_dir, 12)
+    self.assertEqual(
+        segments.list_snapshots(self.snapshot_dir, PAGE_ID), {12, 24, 36, 48})
+    self.assertEqual(self.reconstruct_segments(revisions), (expected, 50))
+
+  def test_segments_with_bounded_retention(self):
+    # Both comments are deleted in revision 3 and only one stays indexed when a
+    # third one is deleted after the snapshot: the one deleted first is
+    # evicted, whatever the order of their texts.
+    comments = {
+        name: ':%s wrote a comment long enough to be remembered.' % name
+        for name in ('Zed', 'Abe', 'Max')
+    }
+    pages = [['Zed'], ['Zed', 'Abe'], [], ['Max'], [], ['Zed', 'Abe']]
+    revisions = testing.make_revisions(len(pages), page_id=PAGE_ID)
+    for rev, page in zip(revisions, pages):
+      rev['text'] = '\n'.join(comments[name] for name in page)
+    retention = restoration_index.RetentionPolicy(max_count=2)
+    expected = sequential(revisions, self.snapshot_dir, 3, retention)
+    self.assertEqual([action['type'] for action in expected[-2:]],
+                     ['ADDITION', 'RESTORATION'])
+    self.assertEqual(
+        self.reconstruct_segments(revisions, retention), (expected, 6))
+
+  def test_mismatching_snapshot(self):
+    revisions = rolling_revisions(50)
+    expected = sequential(revisions, self.snapshot_dir, 12)
+    page_state, latest_content = segments.read_snapshot(
+        self.snapshot_dir, PAGE_ID, 24)
+    segments.write_snapshot(self.snapshot_dir, page_state,
+                            latest_content + 'Tampered.\n')
+    actions, done = self.reconstruct_segments(revisions)
+    # Only the segments up to the tampered snapshot are reconstructed.
+    self.assertEqual(done, 24)
+    self.assertEqual(actions, expected[:len(actions)])
+    self.assertEqual(sequential(revisions[:24]), actions)
+
+
+if __name__ == '__main__':
+  unittest.main()
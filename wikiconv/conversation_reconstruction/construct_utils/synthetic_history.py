@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+A generator of synthetic talk page histories, for testing the reconstruction
+at a scale the bundled test pages do not reach and without the network access
+fetch_testdata.py needs.
+
+Each revision of a generated page applies one edit to a model of the page:
+a new section, a reply, a modification, a deletion or restoration of a comment,
+the archiving of the oldest sections, the move of a section, or a vandalism
+reverted by the next revision. The rates of the edits, the length of the
+comments, the depth of the reply threads and the share of HTML-heavy comments
+are set by Distributions. A page is a function of its id, its number of
+revisions, the seed and the distributions only.
+
+The revisions are written in the ingested format, one JSON object per line in
+timestamp order.
+
+Run with:
+  python -m wikiconv.conversation_reconstruction.construct_utils.synthetic_history \
+      -n 100000 -o /tmp/synthetic.json
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import logging
+import random
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+SIGNATURE_TIME_FORMAT = '%H:%M, %d %B %Y'
+DEFAULT_START = datetime.datetime(2005, 1, 1)
+# Deleted comments kept as candidates for a restoration.
+MAX_RESTORABLE = 1000
+
+_SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'de', 'pa',
+              'bri', 'con', 'ex', 'for', 'gen', 'hum', 'ist', 'jor', 'tal',
+              'wen')
+_HTML_TEMPLATES = ('<span style="color:#{n:06x}">{word}</span>',
+                   '<small>{word}</small>', '<div class="c{n:x}">{word}</div>',
+                   '<b>{word}</b><br />', '{{{{tl|t{n:x}}}}} {word}',
+                   "'''{word}'''", '<ref>{n:x} {word}</ref>')
+
+
+class Distributions(object):
+  """The tunable distributions of a synthetic history.
+
+  The edit rates are relative weights of the edits of a revision.
+
+  Attributes:
+    section_rate: weight of the creation of a new section.
+    reply_rate: weight of a new comment in an existing section.
+    modification_rate: weight of the modification of a comment.
+    deletion_rate: weight of the deletion of a comment.
+    restoration_rate: weight of the restoration of a deleted comment.
+    archive_rate: weight of the archiving of the oldest sections.
+    rearrangement_rate: weight of the move of a section.
+    vandalism_rate: weight of a vandalism, reverted by the next revision.
+    comment_words: mean number of words of a comment.
+    max_comment_words: maximum number of words of a comment.
+    deep_reply_rate: probability that a reply answers the latest comment of
+      its section, which grows deep threads.
+    max_indentation: maximum indentation of a reply.
+    html_rate: probability that a word of a comment is marked up.
+    archive_keep: number of sections left on the page by an archiving.
+    users: number of distinct authors.
+    mean_gap_seconds: mean time between two revisions.
+  """
+
+  def __init__(self,
+               section_rate=0.08,
+               reply_rate=0.5,
+               modification_rate=0.1,
+               deletion_rate=0.1,
+               restoration_rate=0.05,
+               archive_rate=0.005,
+               rearrangement_rate=0.02,
+               vandalism_rate=0.03,
+               comment_words=40,
+               max_comment_words=800,
+               deep_reply_rate=0.5,
+               max_indentation=12,
+               html_rate=0.05,
+               archive_keep=5,
+               users=200,
+               mean_gap_seconds=6 * 3600):
+    self.section_rate = section_rate
+    self.reply_rate = reply_rate
+    self.modification_rate = modification_rate
+    self.deletion_rate = deletion_rate
+    self.restoration_rate = restoration_rate
+    self.archive_rate = archive_rate
+    self.rearrangement_rate = rearrangement_rate
+    self.vandalism_rate = vandalism_rate
+    self.comment_words = comment_words
+    self.max_comment_words = max_comment_words
+    self.deep_reply_rate = deep_reply_rate
+    self.max_indentation = max_indentation
+    self.html_rate = html_rate
+    self.archive_keep = archive_keep
+    self.users = users
+    self.mean_gap_seconds = mean_gap_seconds
+
+  def edit_weights(self):
+    return [('section', self.section_rate), ('reply', self.reply_rate),
+            ('modification', self.modification_rate),
+            ('deletion', self.deletion_rate),
+            ('restoration', self.restoration_rate),
+            ('archive', self.archive_rate),
+            ('rearrangement', self.rearrangement_rate),
+            ('vandalism', self.vandalism_rate)]
+
+
+class _Page(object):
+  """The model of a talk page, as a list of sections of comments."""
+
+  def __init__(self):
+    # Each section is a list of its title and of its comments; each comment is
+    # a list of its indentation and its text, signature included.
+    self.sections = []
+    self.archives = 0
+    self.restorable = []
+
+  def comments(self):
+    return [(section, ind)
+            for section in self.sections
+            for ind in range(len(section[1]))]
+
+  def render(self):
+    parts = []
+    if self.archives:
+      parts.append('{{Archive box|%s}}\n\n' % ' '.join(
+          '[[/Archive %d]]' % (i + 1) for i in range(self.archives)))
+    for title, comments in self.sections:
+      parts.append('== %s ==\n\n' % title)
+      for indentation, text in comments:
+        parts.append(':' * indentation + text + '\n\n')
+    return ''.join(parts)
+
+
+class HistoryGenerator(object):
+  """Generates the revisions of a synthetic talk page."""
+
+  def __init__(self, page_id, seed=0, distributions=None, first_rev_id=1,
+               start=DEFAULT_START):
+    """Constructor.
+
+    Args:
+      page_id: the id of the page.
+      seed: the seed of the history.
+      distributions: the Distributions of the edits, or None for the default
+        ones.
+      first_rev_id: the id of the first revision; ids are consecutive.
+      start: the datetime of the first revision.
+    """
+    self.page_id = page_id
+    self.distributions = distributions or Distributions()
+    self._rng = random.Random(seed * 1000003 + int(page_id))
+    self._rev_id = first_rev_id
+    self._time = start
+    self._page = _Page()
+    self._edits, weights = zip(*self.distributions.edit_weights())
+    total = sum(weights)
+    self._cumulative_weights = []
+    cumulative = 0
+    for weight in weights:
+      cumulative += weight / total
+      self._cumulative_weights.append(cumulative)
+
+  def _user(self):
+    user = int(self._rng.paretovariate(1.2)) % self.distributions.users
+    return user + 1, 'User%d' % (user + 1)
+
+  def _word(self):
+    word = ''.join(
+        self._rng.choice(_SYLLABLES)
+        for _ in range(self._rng.randint(1, 3)))
+    if self._rng.random() < self.distributions.html_rate:
+      return self._rng.choice(_HTML_TEMPLATES).format(
+          n=self._rng.randint(0, 0xffffff), word=word)
+    return word
+
+  def _text(self, user_text):
+    dist = self.distributions
+    words = min(dist.max_comment_words,
+                1 + int(self._rng.expovariate(1 / dist.comment_words)))
+    body = ' '.join(self._word() for _ in range(words))
+    return '%s. [[User:%s|%s]] ([[User talk:%s|talk]]) %s (UTC)' % (
+        body, user_text, user_text, user_text,
+        self._time.strftime(SIGNATURE_TIME_FORMAT))
+
+  def _pick_edit(self):
+    draw = self._rng.random()
+    for edit, cumulative in zip(self._edits, self._cumulative_weights):
+      if draw < cumulative:
+        return edit
+    return self._edits[-1]
+
+  def _apply(self, edit, user_text):
+    """Applies an edit to the page, returning its edit summary."""
+    page = self._page
+    comments = page.comments()
+    if edit == 'section' or not page.sections:
+      title = ' '.join(self._word() for _ in range(self._rng.randint(1, 4)))
+      page.sections.append([title, [[0, self._text(user_text)]]])
+      return '/* %s */ new section' % title
+    if edit == 'reply':
+      section = self._rng.choice(page.sections)[1]
+      if not section:
+        section.append([0, self._text(user_text)])
+        return 'comment'
+      if self._rng.random() < self.distributions.deep_reply_rate:
+        parent = len(section) - 1
+      else:
+        parent = self._rng.randrange(len(section))
+      indentation = min(section[parent][0] + 1,
+                        self.distributions.max_indentation)
+      position = parent + 1
+      while position < len(section) and section[position][0] > section[
+          parent][0]:
+        position += 1
+      section.insert(position, [indentation, self._text(user_text)])
+      return 'reply'
+    if edit == 'modification' and comments:
+      section, ind = self._rng.choice(comments)
+      comment = section[1][ind]
+      comment[1] = '%s %s' % (' '.join(
+          self._word() for _ in range(self._rng.randint(1, 10))), comment[1])
+      return 'copyedit'
+    if edit == 'deletion' and comments:
+      section, ind = self._rng.choice(comments)
+      page.restorable.append((section, ind, section[1].pop(ind)))
+      if len(page.restorable) > MAX_RESTORABLE:
+        del page.restorable[self._rng.randrange(MAX_RESTORABLE)]
+      return 'remove comment'
+    if edit == 'restoration' and page.restorable:
+      section, ind, comment = page.restorable.pop(
+          self._rng.randrange(len(page.restorable)))
+      if not any(section is s for s in page.sections):
+        section = page.sections[-1]
+      section[1].insert(min(ind, len(section[1])), comment)
+      return 'restore comment'
+    if edit == 'archive' and len(
+        page.sections) > self.distributions.archive_keep:
+      page.archives += 1
+      del page.sections[:-self.distributions.archive_keep]
+      return 'Archiving to [[/Archive %d]]' % page.archives
+    if edit == 'rearrangement' and len(page.sections) > 1:
+      section = page.sections.pop(self._rng.randrange(len(page.sections)))
+      page.sections.insert(
+          self._rng.randrange(len(page.sections) + 1), section)
+      return 'move section'
+    return None
+
+  def _revision(self, text, comment, user):
+    self._time += datetime.timedelta(
+        seconds=1 + int(
+            self._rng.expovariate(1 / self.distributions.mean_gap_seconds)))
+    year, week, _ = self._time.isocalendar()
+    rev = {
+        'comment': comment,
+        'week': week,
+        'sha1': hashlib.sha1(text.encode('utf-8')).hexdigest(),
+        'user_id': '%d' % user[0],
+        'format': 'text/x-wiki',
+        'user_text': user[1],
+        'timestamp': self._time.strftime(TIMESTAMP_FORMAT),
+        'user_ip': None,
+        'text': text,
+        'year': year,
+        'page_title': 'Talk:Synthetic %s' % self.page_id,
+        'model': 'wikitext',
+        'rev_id': '%d' % self._rev_id,
+        'page_id': '%s' % self.page_id,
+        'page_namespace': '1'
+    }
+    self._rev_id += 1
+    return rev
+
+  def revisions(self, num_revisions):
+    """Yields the revisions of the page, in timestamp order.
+
+    Args:
+      num_revisions: the number of revisions of the page.
+
+    Yields:
+      Revisions in the ingested format.
+    """
+    emitted = 0
+    while emitted < num_revisions:
+      user = self._user()
+      edit = self._pick_edit()
+      if edit == 'vandalism' and self._page.sections and (
+          emitted + 2 <= num_revisions):
+        text = self._page.render()
+        position = self._rng.randrange(len(text) + 1)
+        yield self._revision(
+            text[:position] + ' '.join(
+                self._word() for _ in range(self._rng.randint(1, 20))).upper() +
+            text[position:], '', user)
+        # The revert restores the exact text of the revision before.
+        yield self._revision(text, 'Reverted edits by %s' % user[1],
+                             self._user())
+        emitted += 2
+        continue
+      comment = self._apply(edit, user[1])
+      if comment is None:
+        comment = self._apply('reply', user[1])
+      yield self._revision(self._page.render(), comment, user)
+      emitted += 1
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-n', '--num_revisions', dest='num_revisions', default=1000, type=int,
+      help='Number of revisions of each page.')
+  parser.add_argument(
+      '-p', '--pages', dest='pages', default=1, type=int,
+      help='Number of pages, with consecutive ids from --page_id.')
+  parser.add_argument('--page_id', dest='page_id', default=1, type=int)
+  parser.add_argument('-s', '--seed', dest='seed', default=0, type=int)
+  parser.add_argument('-o', '--output', dest='output', required=True)
+  defaults = Distributions()
+  for name, value in sorted(vars(defaults).items()):
+    parser.add_argument(
+        '--' + name, dest=name, default=value, type=type(value))
+  args = parser.parse_args(argv)
+  distributions = Distributions(
+      **{name: getattr(args, name) for name in vars(defaults)})
+  first_rev_id = 1
+  with io.open(args.output, 'w', encoding='utf-8') as f:
+    for page_id in range(args.page_id, args.page_id + args.pages):
+      generator = HistoryGenerator(page_id, args.seed, distributions,
+                                   first_rev_id)
+      for rev in generator.revisions(args.num_revisions):
+        f.write(json.dumps(rev, ensure_ascii=False) + '\n')
+      first_rev_id += args.num_revisions
+      logging.info('PROGRESS LOG: page %d generated.', page_id)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main()
@@ -0,0 +1,89 @@
+"""Tests for synthetic_history."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+from wikiconv.conversation_reconstruction.construct_utils import synthetic_history
+from wikiconv.conversation_reconstruction.construct_utils import testing
+
+INGESTED_FIELDS = set([
+    "comment", "week", "sha1", "user_id", "format", "user_text", "timestamp",
+    "user_ip", "text", "year", "page_title", "model", "rev_id", "page_id",
+    "page_namespace"
+])
+
+
+class SyntheticHistoryTest(unittest.TestCase):
+
+  def test_deterministic(self):
+    first = list(synthetic_history.HistoryGenerator(7, seed=3).revisions(200))
+    second = list(synthetic_history.HistoryGenerator(7, seed=3).revisions(200))
+    other = list(synthetic_history.HistoryGenerator(7, seed=4).revisions(200))
+    self.assertEqual(first, second)
+    self.assertNotEqual([rev["text"] for rev in first],
+                        [rev["text"] for rev in other])
+
+  def test_ingested_format(self):
+    revisions = list(
+        synthetic_history.HistoryGenerator(7, first_rev_id=100).revisions(50))
+    self.assertEqual(len(revisions), 50)
+    for rev in revisions:
+      self.assertEqual(set(rev), INGESTED_FIELDS)
+      self.assertEqual(rev["page_id"], "7")
+    self.assertEqual([rev["rev_id"] for rev in revisions],
+                     [str(rev_id) for rev_id in range(100, 150)])
+    timestamps = [rev["timestamp"] for rev in revisions]
+    self.assertEqual(timestamps, sorted(timestamps))
+
+  def test_distributions(self):
+    distributions = synthetic_history.Distributions(
+        section_rate=0, reply_rate=1, modification_rate=0, deletion_rate=0,
+        restoration_rate=0, archive_rate=0, rearrangement_rate=0,
+        vandalism_rate=0, deep_reply_rate=1, max_indentation=3)
+    revisions = list(
+        synthetic_history.HistoryGenerator(
+            7, distributions=distributions).revisions(20))
+    # A single section, replies only, each to the latest comment.
+    self.assertEqual(revisions[-1]["text"].count("=="), 2)
+    for previous, rev in zip(revisions, revisions[1:]):
+      self.assertTrue(rev["text"].startswith(previous["text"]))
+    self.assertIn("\n\n:::", revisions[-1]["text"])
+    self.assertNotIn("\n\n::::", revisions[-1]["text"])
+
+  def test_reconstruction(self):
+    processor = conversation_constructor.ConversationConstructor()
+    _, actions = testing.replay(
+        synthetic_history.HistoryGenerator(7).revisions(400), processor)
+    types = collections.Counter(action["type"] for action in actions)
+    for action_type in ("CREATION", "ADDITION", "MODIFICATION", "DELETION",
+                        "RESTORATION"):
+      self.assertGreater(types[action_type], 0, action_type)
+    # Reverted vandalisms reuse the cleaning of the revision they revert to.
+    self.assertGreater(processor.reused_cleanings, 0)
+
+  def test_main(self):
+    tempdir = tempfile.mkdtemp()
+    output = os.path.join(tempdir, "revisions.json")
+    synthetic_history.main(
+        ["-n", "30", "-p", "2", "--page_id", "5", "-o", output,
+         "--html_rate", "0.5"])
+    with open(output) as f:
+      revisions = [json.loads(line) for line in f]
+    self.assertEqual(len(revisions), 60)
+    self.assertEqual([rev["page_id"] for rev in revisions],
+                     ["5"] * 30 + ["6"] * 30)
+    self.assertEqual(len(set(rev["rev_id"] for rev in revisions)), 60)
+    shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Revision histories and replays shared by the tests and benchmarks.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+make_revisions builds the small histories the tests of the constructor need,
+one comment per revision with optional edits, deletions and restorations, and
+replay runs revisions through a ConversationConstructor the way the pipeline
+does.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import datetime
+
+from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+
+PAGE_ID = 28031
+# Revision n is made n seconds after this.
+BASE_TIME = datetime.datetime(2001, 9, 11, 18)
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+LONG_COMMENT = (':Comment number %d, which is long enough to be remembered '
+                'after it is deleted.')
+
+
+def _first(unused_rev_id):
+  return 0
+
+
+def make_revisions(count,
+                   comment=LONG_COMMENT,
+                   max_comments=None,
+                   deleted=_first,
+                   edit_every=None,
+                   restore_every=None,
+                   page_id=PAGE_ID):
+  """Returns the revisions of a page, each adding or editing a comment.
+
+  Args:
+    count: the number of revisions.
+    comment: the format of the comment added by a revision, given its id.
+    max_comments: if set, a comment is deleted whenever there are more.
+    deleted: a function returning the position of the comment deleted by a
+      revision, given its id.
+    edit_every: if set, every that many revisions edit the first comment
+      instead of adding one.
+    restore_every: if set, every that many revisions restore the comments of
+      the revision before the previous one.
+    page_id: the page id of the revisions.
+
+  Returns:
+    The list of revisions, with rev_ids from 1 to count.
+  """
+  comments = []
+  revisions = []
+  for rev_id in range(1, count + 1):
+    if edit_every and rev_id % edit_every == 0:
+      comments[0] += ' Edited in revision %d.' % rev_id
+    else:
+      comments.append(comment % rev_id)
+    if max_comments and len(comments) > max_comments:
+      comments.pop(deleted(rev_id))
+    if restore_every and rev_id % restore_every == 0:
+      comments = revisions[-2]['text'].split('\n')
+    revisions.append({
+        'user_id': rev_id,
+        'user_text': 'User %d' % rev_id,
+        'timestamp': (BASE_TIME + datetime.timedelta(seconds=rev_id)
+                     ).strftime(TIMESTAMP_FORMAT),
+        'text': '\n'.join(comments),
+        'page_title': 'placeholder',
+        'page_id': page_id,
+        'rev_id': rev_id
+    })
+  return revisions
+
+
+def replay(revisions, processor=None, after_revision=None):
+  """Reconstructs revisions in order.
+
+  Args:
+    revisions: iterable of the revisions of a page. They are copied, as the
+      constructor stores their cleaned text and diff in them.
+    processor: the ConversationConstructor to use, a new one by default.
+    after_revision: an optional function called after each revision with its
+      1-based position, the page state and the latest content.
+
+  Returns:
+    A pair of the final page state and of the list of all the actions.
+  """
+  if processor is None:
+    processor = conversation_constructor.ConversationConstructor()
+  page_state = None
+  latest_content = ''
+  actions = []
+  for ind, rev in enumerate(revisions, 1):
+    page_state, new_actions, latest_content = processor.process(
+        page_state, latest_content, dict(rev))
+    actions.extend(new_actions)
+    if after_revision is not None:
+      after_revision(ind, page_state, latest_content)
+  return page_state, actions
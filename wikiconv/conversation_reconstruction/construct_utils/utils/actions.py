@@ -57,7 +57,7 @@ def comment_removal(removal_info, rev):
   action['indentation'] = removed_action[1]
   action['id'] = str(rev['rev_id']) + '.' + str(op['b1']) + '.' + str(op['a1'])
   action['rev_id'] = rev['rev_id']
-  action['content'] = ''.join(op['tokens'])
+  action['content'] = insert_utils.join_tokens(op['tokens'])
   action['user_id'] = rev['user_id']
   action['user_text'] = rev['user_text']
   action['timestamp'] = rev['timestamp']
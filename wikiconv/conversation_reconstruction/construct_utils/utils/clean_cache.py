@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Memoization of comment cleaning results.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Many action contents are exact repeats: signature-only edits, templated
+warnings, bot notices, restored comments and modifications re-emitting a whole
+comment. CleanCache remembers cleaned texts in LRU order, keyed by the name of
+the cleaning function and the SHA-1 digest of the input, so the inputs
+themselves are not kept alive. The cache is bounded by an estimate of the bytes
+held and is safe to share between threads.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import functools
+import hashlib
+import sys
+import threading
+
+# Approximate bytes used by the key tuple, digest and dictionary slot of an
+# entry, on top of the cached string itself.
+ENTRY_OVERHEAD = 200
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+def content_key(cleaner, text):
+  """Returns the cache key for text cleaned by the cleaner function."""
+  return ('%s.%s' % (cleaner.__module__, cleaner.__name__),
+          hashlib.sha1(text.encode('utf-8', 'surrogatepass')).digest())
+
+
+class CleanCache(object):
+  """A thread-safe LRU cache of cleaned texts bounded by size in bytes."""
+
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def lookup(self, key):
+    """Returns the cached value for key, or None, updating the statistics."""
+    with self._lock:
+      value = self._entries.get(key)
+      if value is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      # Mark as most recently used.
+      del self._entries[key]
+      self._entries[key] = value
+      return value
+
+  def store(self, key, value):
+    """Stores value, evicting least recently used entries over budget."""
+    size = sys.getsizeof(value) + ENTRY_OVERHEAD
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      previous = self._entries.pop(key, None)
+      if previous is not None:
+        self._bytes -= sys.getsizeof(previous) + ENTRY_OVERHEAD
+      self._entries[key] = value
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        _, evicted = self._entries.popitem(last=False)
+        self._bytes -= sys.getsizeof(evicted) + ENTRY_OVERHEAD
+        self.evictions += 1
+
+  def clean(self, cleaner, text):
+    """Returns cleaner(text), from the cache when possible."""
+    key = content_key(cleaner, text)
+    value = self.lookup(key)
+    if value is None:
+      value = cleaner(text)
+      self.store(key, value)
+    return value
+
+  def memoize(self, cleaner):
+    """Wraps a cleaning function so its results go through this cache."""
+
+    @functools.wraps(cleaner)
+    def cached_cleaner(text):
+      return self.clean(cleaner, text)
+
+    return cached_cleaner
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    """Returns the hit-rate metrics of the cache as a dictionary."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+          'entries': len(self._entries),
+          'bytes': self._bytes,
+      }
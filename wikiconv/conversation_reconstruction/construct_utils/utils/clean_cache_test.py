@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Tests for clean_cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import threading
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils.utils import clean_cache
+from wikiconv.conversation_reconstruction.construct_utils.utils import comment_clean
+
+
+class CountingCleaner(object):
+
+  def __init__(self):
+    self.calls = 0
+
+  def __call__(self, text):
+    self.calls += 1
+    return text.upper()
+
+
+def upper(text):
+  return text.upper()
+
+
+class CleanCacheTest(unittest.TestCase):
+
+  def test_memoize(self):
+    cleaner = CountingCleaner()
+    cleaner.__name__ = 'upper'
+    cache = clean_cache.CleanCache()
+    cached = cache.memoize(cleaner)
+    self.assertEqual(cached('a'), 'A')
+    self.assertEqual(cached('a'), 'A')
+    self.assertEqual(cached('b'), 'B')
+    self.assertEqual(cleaner.calls, 2)
+    stats = cache.stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 2)
+    self.assertAlmostEqual(stats['hit_rate'], 1.0 / 3)
+    self.assertEqual(stats['entries'], 2)
+
+  def test_keys_depend_on_cleaner(self):
+    self.assertNotEqual(
+        clean_cache.content_key(comment_clean.clean, 'x'),
+        clean_cache.content_key(comment_clean.content_clean, 'x'))
+    self.assertEqual(
+        clean_cache.content_key(upper, 'x'), clean_cache.content_key(upper, 'x'))
+
+  def test_evicts_least_recently_used(self):
+    entry_size = sys.getsizeof('A') + clean_cache.ENTRY_OVERHEAD
+    cache = clean_cache.CleanCache(max_bytes=2 * entry_size)
+    cache.clean(upper, 'a')
+    cache.clean(upper, 'b')
+    # Touch 'a' so that 'b' is the least recently used entry.
+    cache.clean(upper, 'a')
+    cache.clean(upper, 'c')
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.evictions, 1)
+    self.assertIsNotNone(cache.lookup(clean_cache.content_key(upper, 'a')))
+    self.assertIsNone(cache.lookup(clean_cache.content_key(upper, 'b')))
+    self.assertLessEqual(cache.stats()['bytes'], cache.max_bytes)
+
+  def test_skips_values_over_budget(self):
+    cache = clean_cache.CleanCache(max_bytes=1000)
+    self.assertEqual(cache.clean(upper, 'x' * 2000), 'X' * 2000)
+    self.assertEqual(len(cache), 0)
+
+  def test_threads(self):
+    cache = clean_cache.CleanCache()
+    texts = ['text %d' % (i % 50) for i in range(2000)]
+    results = []
+
+    def work():
+      results.append([cache.clean(comment_clean.clean, t) for t in texts])
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    expected = [comment_clean.clean(t) for t in texts]
+    for result in results:
+      self.assertEqual(result, expected)
+    self.assertEqual(len(cache), 50)
+
+  def test_clean_batch_output_unchanged(self):
+    cache = clean_cache.CleanCache()
+    texts = [
+        '[[User:A|A]] hi --', 'plain', '[[User:A|A]] hi --',
+        '<!-- {{blocked}} --> x'
+    ]
+    for cleaner in [comment_clean.clean, comment_clean.content_clean]:
+      expected = [cleaner(t) for t in texts]
+      for _ in range(2):
+        self.assertEqual(
+            comment_clean.clean_batch(texts, cleaner=cleaner, cache=cache),
+            expected)
+    # Duplicates within a batch are cleaned once, later batches hit the cache.
+    self.assertEqual(len(cache), 6)
+    self.assertEqual(cache.misses, 6)
+    self.assertEqual(cache.hits, 8)
+
+
+if __name__ == '__main__':
+  unittest.main()
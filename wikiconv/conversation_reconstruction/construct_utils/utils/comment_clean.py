@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Revision and comment cleaning utilities.
+
+Copyright 2017 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+This is the one place where MediaWiki comments are cleaned, shared by the
+conversation constructor, the content cleaning pipeline and antidox.
+
+All substitution patterns are compiled once, and literal substitutions are
+done with str.replace. The link patterns are applied one after another in
+their original order, each only to the comments containing its link prefix:
+what a pattern matches depends on what the ones before it removed, e.g.
+'[[User:A|[[Image:x.png]]]]' is removed entirely because the image link goes
+first, and '([[User:A]][[User talk:A]])' parentheses included because the
+user link does.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import multiprocessing
+import re
+
+import mwparserfromhell
+from wikiconv.conversation_reconstruction.construct_utils.utils import clean_cache
+from wikiconv.conversation_reconstruction.construct_utils.utils import html_strip
+
+months = [
+    'January',
+    'February',
+    'March',
+    'April',
+    'May',
+    'June',
+    'July',
+    'August',
+    'September',
+    'October',
+    'November',
+    'December',
+    'Jan',
+    'Feb',
+    'Mar',
+    'Apr',
+    'May',
+    'Jun',
+    'Jul',
+    'Aug',
+    'SJep',
+    'Oct',
+    'Nov',
+    'Dec',
+]
+
+month_or = '|'.join(months)
+date_p = re.compile(r'\d\d:\d\d,( \d?\d)? (%s)( \d?\d)?,? \d\d\d\d (\(UTC\))?' %
+                    month_or)
+
+# (link prefix, pattern) pairs, applied in order. The user talk and
+# contribution patterns also take the parentheses around a link.
+link_patterns = [
+    (prefix, re.compile(re.escape(prefix) + r'.*?\]\]'))
+    for prefix in ('[[Image:', '[[File:', '[[User:', '[[user:')
+] + [(prefix, re.compile(r'\(?' + re.escape(prefix) + r'.*?\]\]\)?'))
+     for prefix in ('[[User talk:', '[[user talk:', '[[User Talk:',
+                    '[[User_talk:', '[[user_talk:', '[[User_Talk:',
+                    '[[Special:Contributions')]
+# Blocking notices left by administrators, marked after the image links.
+BLOCKED = '<!-- {{blocked}} -->'
+preceding_p = re.compile('—Preceding .* comment added by   •')
+
+BLOCKING_ACTION = '[BLOCKING_ACTION]'
+
+DEFAULT_CHUNKSIZE = 64
+
+# Cleaned texts shared by every user of this module in the process.
+cache = clean_cache.CleanCache()
+
+
+def _remove_links(text, patterns):
+  for prefix, pattern in patterns:
+    if prefix in text:
+      text = pattern.sub('', text)
+  return text
+
+
+def remove_date(text):
+  return date_p.sub('', text)
+
+
+def remove_links(text):
+  if '[[' not in text:
+    return text
+  return _remove_links(text, link_patterns)
+
+
+def remove_links_and_blocks(text):
+  if BLOCKED in text:
+    text = _remove_links(text, link_patterns[:1]).replace(
+        BLOCKED, BLOCKING_ACTION)
+    return _remove_links(text, link_patterns[1:])
+  return remove_links(text)
+
+
+def post_clean(text):
+  text = text.replace('--', '').replace(' :', ' ')
+  if '—Preceding' in text:
+    text = preceding_p.sub('', text)
+  return text
+
+
+def strip_html(text):
+  return html_strip.strip_html(text)
+
+
+def strip_mw(text):
+  try:
+    parsed = mwparserfromhell.parse(text, skip_style_tags=True).strip_code()
+  except:  # pylint: disable=bare-except
+    return text
+  return parsed
+
+
+def clean_html(rev):
+  """Clean revision HTML, keeping one non-empty stripped line per line."""
+  # Remove timestmp.
+  ret = remove_date(rev)
+  # Strip HTML format.
+  ret = strip_html(ret)
+  # Change format for better diff
+  lines = [line.strip() for line in ret.splitlines()]
+  ret = '\n'.join([line for line in lines if line]) + '\n'
+  if ret == '\n':
+    return ''
+  return ret
+
+
+def clean(rev):
+  """Remove user, file and contribution links and signature leftovers."""
+  return post_clean(remove_links(rev))
+
+
+def content_clean(rev):
+  """Fully clean a comment, also stripping MediaWiki and HTML markup."""
+  ret = remove_date(rev)
+  ret = remove_links_and_blocks(ret)
+  ret = strip_mw(ret)
+  ret = strip_html(ret)
+  return post_clean(ret)
+
+
+cached_clean = cache.memoize(clean)
+cached_content_clean = cache.memoize(content_clean)
+
+
+def _map(cleaner, texts, pool, processes, chunksize):
+  """Applies cleaner to texts, in a process pool if asked to."""
+  if pool is None and (processes is None or processes > 1) and len(texts) > 1:
+    pool = multiprocessing.Pool(processes)
+    try:
+      return pool.map(cleaner, texts, chunksize)
+    finally:
+      pool.close()
+      pool.join()
+  if pool is not None:
+    return pool.map(cleaner, texts, chunksize)
+  return [cleaner(text) for text in texts]
+
+
+def clean_batch(texts, cleaner=clean, pool=None, processes=1,
+                chunksize=DEFAULT_CHUNKSIZE, cache=None):  # pylint: disable=redefined-outer-name
+  """Cleans a batch of texts.
+
+  Args:
+    texts: list of strings to clean.
+    cleaner: the cleaning function to apply; must be a module level function
+      when a process pool is used.
+    pool: an optional multiprocessing pool to fan the work out to.
+    processes: number of worker processes to start when no pool is given. With
+      the default of one, texts are cleaned in this process.
+    chunksize: number of texts sent to a worker at a time.
+    cache: an optional CleanCache. Cached texts are not sent to the cleaner,
+      and each distinct text in the batch is cleaned once.
+
+  Returns:
+    The list of cleaned texts, in the same order as texts.
+  """
+  texts = list(texts)
+  if cache is None:
+    return _map(cleaner, texts, pool, processes, chunksize)
+  ret = [None] * len(texts)
+  missing = collections.OrderedDict()
+  for ind, text in enumerate(texts):
+    key = clean_cache.content_key(cleaner, text)
+    if key in missing:
+      missing[key].append(ind)
+      continue
+    cleaned = cache.lookup(key)
+    if cleaned is None:
+      missing[key] = [ind]
+    else:
+      ret[ind] = cleaned
+  cleaned_texts = _map(cleaner, [texts[inds[0]] for inds in missing.values()],
+                       pool, processes, chunksize)
+  for (key, inds), cleaned in zip(missing.items(), cleaned_texts):
+    cache.store(key, cleaned)
+    for ind in inds:
+      ret[ind] = cleaned
+  return ret
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Tests for comment_clean."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils.utils import comment_clean
+
+SIGNED_COMMENT = (
+    ':I agree -- it is fine. [[User:Foo|Foo]] ([[User talk:Foo|talk]]) '
+    '([[Special:Contributions/Foo|contribs]]) 12:01, 3 May 2007 (UTC)\n')
+
+
+class CommentCleanTest(unittest.TestCase):
+
+  def test_clean(self):
+    self.assertEqual(
+        comment_clean.clean(SIGNED_COMMENT),
+        ':I agree  it is fine.    12:01, 3 May 2007 (UTC)\n')
+    self.assertEqual(
+        comment_clean.clean('See [[Image:x.jpg]] and [[Foo]] :)'),
+        'See  and [[Foo]] )')
+    self.assertEqual(
+        comment_clean.clean('—Preceding unsigned comment added by   •'
+                            ' ok'), ' ok')
+
+  def test_clean_adjacent_links(self):
+    # The talk links are removed with their parentheses once the user links
+    # before them are gone.
+    self.assertEqual(
+        comment_clean.clean('([[User:A]][[User talk:f|g]])'), '')
+    self.assertEqual(
+        comment_clean.clean('Hi ([[User:A|A]][[User talk:A|talk]])'), 'Hi ')
+    # Each kind of talk link takes a closing parenthesis in turn.
+    self.assertEqual(
+        comment_clean.clean(
+            '([[Special:Contributions/A|c]][[user_talk:B]][[User talk:A]]))'),
+        '')
+    self.assertEqual(
+        comment_clean.content_clean(
+            'x ([[File:a.png]]<!-- {{blocked}} -->[[User talk:A]])'),
+        'x ([BLOCKING_ACTION]')
+
+  def test_clean_nested_links(self):
+    # The image link is removed first, so the user link around it goes too.
+    self.assertEqual(comment_clean.clean('[[User:A|[[Image:x.png]]]] hi'),
+                     ' hi')
+    self.assertEqual(
+        comment_clean.content_clean(
+            '[[File:a.png|[[User:B|B]] <!-- {{blocked}} -->]] x'),
+        ' [BLOCKING_ACTION]]] x')
+
+  def test_content_clean(self):
+    self.assertEqual(
+        comment_clean.content_clean(
+            "'''Note''' <!-- {{blocked}} --> see <b>[[Foo|bar]]</b> "
+            '[[User:X|X]] 12:01, 3 May 2007 (UTC)'),
+        "'''Note''' [BLOCKING_ACTION] see bar  ")
+
+  def test_clean_html(self):
+    self.assertEqual(
+        comment_clean.clean_html(
+            '== Title ==\n\n\n  <small>Hi</small> 12:01, 3 May 2007 (UTC)\n\n'),
+        '== Title ==\nHi\n')
+    self.assertEqual(comment_clean.clean_html(' \n<br/>\n'), '')
+
+  def test_clean_batch(self):
+    texts = [SIGNED_COMMENT, 'plain', '[[File:a.png]]b']
+    expected = [comment_clean.clean(t) for t in texts]
+    self.assertEqual(comment_clean.clean_batch(texts), expected)
+    self.assertEqual(
+        comment_clean.clean_batch(texts, processes=2, chunksize=1), expected)
+    self.assertEqual(
+        comment_clean.clean_batch(texts, cleaner=comment_clean.content_clean),
+        [comment_clean.content_clean(t) for t in texts])
+    self.assertEqual(comment_clean.clean_batch([]), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
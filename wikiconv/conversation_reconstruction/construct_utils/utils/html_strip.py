@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Streaming HTML tag stripping.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Produces the same text as `BeautifulSoup(text, 'html.parser').get_text()`
+without building a parse tree.
+
+The markup found on MediaWiki talk pages is mostly plain text with a handful of
+well-formed inline tags, comments and entities. The streaming stripper handles
+exactly that subset, reproducing BeautifulSoup's behaviour of dropping tags and
+comments, decoding entities and collapsing whitespace-only strings between
+tags. Whenever it meets a construct whose treatment depends on parser details
+(raw text elements such as <script>, declarations, malformed tags, end tags
+other than </pre> inside a <pre> element, unusual character references) it
+gives up and the text is handed to BeautifulSoup instead, so the result never
+depends on which path was taken.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import re
+import string
+
+import bs4
+import six
+from six.moves import html_entities
+
+# Characters BeautifulSoup considers whitespace when deciding whether a string
+# between two tags is strippable.
+_ASCII_SPACES = ' \n\t\x0c\r'
+
+_START_TAG = re.compile(r'<([a-zA-Z][-a-zA-Z0-9:_]*)'
+                        r'(?:[ \t\n\r\x0c]+[^ \t\n\r\x0c"\'<>/=]+'
+                        r'(?:[ \t\n\r\x0c]*=[ \t\n\r\x0c]*'
+                        r'(?:"[^"]*"|\'[^\']*\'|[^ \t\n\r\x0c"\'=<>`]+))?)*'
+                        r'[ \t\n\r\x0c]*(/?)>')
+_END_TAG = re.compile(r'</([a-zA-Z][-a-zA-Z0-9:_]*)[ \t\n\r\x0c]*>')
+_COMMENT = re.compile(r'<!--(?!-?>)(?:[^-]|-(?!-))*-->')
+_ENTITY_REF = re.compile(r'&([a-zA-Z][-.a-zA-Z0-9]*)(?=[^a-zA-Z0-9])')
+_CHAR_REF = re.compile(r'&#(?:([0-9]+)|[xX]([0-9a-fA-F]+));')
+
+# Elements whose content is not parsed as markup, or whose strings are of a
+# special type that `get_text()` may skip. Their handling differs between
+# BeautifulSoup and Python versions.
+_FALLBACK_TAGS = frozenset([
+    'iframe', 'listing', 'noembed', 'noframes', 'noscript', 'plaintext', 'rp',
+    'rt', 'script', 'style', 'template', 'textarea', 'title', 'xmp'
+])
+# Elements inside which BeautifulSoup keeps whitespace-only strings verbatim.
+_PRESERVE_WHITESPACE_TAGS = frozenset(['pre'])
+
+# The HTML 4 entities that every BeautifulSoup release decodes the same way.
+# A few, such as &lang;, were redefined by HTML 5 and are left out.
+_ENTITIES = {
+    name: six.unichr(codepoint)
+    for name, codepoint in six.iteritems(html_entities.name2codepoint)
+    if getattr(html_entities, 'html5', {}).get(
+        name + ';', six.unichr(codepoint)) == six.unichr(codepoint)
+}
+# Every name that some BeautifulSoup release might decode as an entity.
+_KNOWN_ENTITY_NAMES = frozenset(
+    [name.rstrip(';') for name in getattr(html_entities, 'html5', {})] +
+    list(_ENTITIES))
+
+_unknown_entity_format = None
+
+
+class _Unsupported(Exception):
+  """Raised when the streaming stripper cannot guarantee equivalence."""
+
+
+def _soup_strip(text):
+  """Strips HTML using BeautifulSoup, the reference implementation."""
+  try:
+    text = bs4.BeautifulSoup(text, 'html.parser').get_text()
+  except:  # pylint: disable=bare-except
+    pass
+  return text
+
+
+def _get_unknown_entity_format():
+  """Returns how BeautifulSoup renders an entity reference it doesn't know.
+
+  Depending on the release, `&foo` is either kept as it is or gets a
+  semicolon appended, so the format is probed once from the installed version.
+  """
+  global _unknown_entity_format
+  if _unknown_entity_format is None:
+    probe = _soup_strip('&zqxj ')
+    _unknown_entity_format = probe[:-1].replace('zqxj', '%s')
+  return _unknown_entity_format
+
+
+def _is_plain_char(codepoint):
+  """Tests if a numeric character reference decodes to itself everywhere."""
+  return (32 <= codepoint < 127 or 160 <= codepoint < 0xd800 or
+          0xe000 <= codepoint < 0xfdd0 or 0xfdf0 <= codepoint < 0xfffe)
+
+
+def _flush(data, pieces, preserve_whitespace):
+  """Appends the pending string between two tags to pieces."""
+  chunk = ''.join(data)
+  del data[:]
+  if not chunk:
+    return
+  if not preserve_whitespace and not chunk.strip(_ASCII_SPACES):
+    chunk = '\n' if '\n' in chunk else ' '
+  pieces.append(chunk)
+
+
+def _stream_strip(text):
+  """Strips HTML in a single pass, raising _Unsupported when unsure."""
+  pieces = []
+  data = []
+  pre_depth = 0
+  pos = 0
+  length = len(text)
+  # str.find is much faster than a regular expression scan for the next '<' or
+  # '&', which matters on long pages with little markup.
+  next_tag = text.find('<')
+  next_ref = text.find('&')
+  while True:
+    if next_tag != -1 and next_tag < pos:
+      next_tag = text.find('<', pos)
+    if next_ref != -1 and next_ref < pos:
+      next_ref = text.find('&', pos)
+    if next_tag == -1 and next_ref == -1:
+      data.append(text[pos:])
+      break
+    if next_ref == -1 or (next_tag != -1 and next_tag < next_ref):
+      start = next_tag
+    else:
+      start = next_ref
+    if start > pos:
+      data.append(text[pos:start])
+    if start + 1 >= length:
+      # A trailing '<' or '&' is handled differently by each parser version.
+      raise _Unsupported()
+    if text[start] == '<':
+      following = text[start + 1]
+      if following in string.ascii_letters:
+        tag = _START_TAG.match(text, start)
+        if not tag:
+          raise _Unsupported()
+        name = tag.group(1).lower()
+        if name in _FALLBACK_TAGS:
+          raise _Unsupported()
+        _flush(data, pieces, pre_depth)
+        if name in _PRESERVE_WHITESPACE_TAGS and not tag.group(2):
+          pre_depth += 1
+        pos = tag.end()
+      elif following == '/':
+        tag = _END_TAG.match(text, start)
+        if not tag:
+          raise _Unsupported()
+        name = tag.group(1).lower()
+        if name in _FALLBACK_TAGS:
+          raise _Unsupported()
+        if pre_depth and name not in _PRESERVE_WHITESPACE_TAGS:
+          # An end tag may close the <pre> elements it is nested in,
+          # depending on the elements open around them.
+          raise _Unsupported()
+        _flush(data, pieces, pre_depth)
+        if name in _PRESERVE_WHITESPACE_TAGS and pre_depth:
+          pre_depth -= 1
+        pos = tag.end()
+      elif following == '!':
+        comment = _COMMENT.match(text, start)
+        if not comment:
+          raise _Unsupported()
+        _flush(data, pieces, pre_depth)
+        pos = comment.end()
+      elif following == '?':
+        raise _Unsupported()
+      else:
+        data.append('<')
+        pos = start + 1
+    else:
+      following = text[start + 1]
+      if following == '#':
+        ref = _CHAR_REF.match(text, start)
+        if not ref:
+          raise _Unsupported()
+        if ref.group(1) is not None:
+          codepoint = int(ref.group(1))
+        else:
+          codepoint = int(ref.group(2), 16)
+        if not _is_plain_char(codepoint):
+          raise _Unsupported()
+        data.append(six.unichr(codepoint))
+        pos = ref.end()
+      elif following in string.ascii_letters:
+        ref = _ENTITY_REF.match(text, start)
+        if not ref:
+          raise _Unsupported()
+        name = ref.group(1)
+        if name in _ENTITIES:
+          data.append(_ENTITIES[name])
+        elif name in _KNOWN_ENTITY_NAMES:
+          raise _Unsupported()
+        else:
+          data.append(_get_unknown_entity_format() % name)
+        pos = ref.end()
+        if text.startswith(';', pos):
+          pos += 1
+      else:
+        data.append('&')
+        pos = start + 1
+  _flush(data, pieces, pre_depth)
+  return ''.join(pieces)
+
+
+def fast_strip_html(text):
+  """Strips HTML without falling back.
+
+  Args:
+    text: the markup to strip.
+
+  Returns:
+    The text content, or None if the markup needs BeautifulSoup.
+  """
+  try:
+    return _stream_strip(text)
+  except _Unsupported:
+    return None
+
+
+def strip_html(text, verify=False):
+  """Strips HTML tags, comments and entities from text.
+
+  Args:
+    text: the markup to strip.
+    verify: if True, also run BeautifulSoup and prefer its output whenever the
+      two disagree.
+
+  Returns:
+    The same string as `BeautifulSoup(text, 'html.parser').get_text()`.
+  """
+  ret = fast_strip_html(text)
+  if ret is None:
+    return _soup_strip(text)
+  if verify:
+    expected = _soup_strip(text)
+    if ret != expected:
+      logging.warning('HTML stripping mismatch on input: %r', text[:200])
+      return expected
+  return ret
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Tests for html_strip."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import unittest
+
+import bs4
+from wikiconv.conversation_reconstruction.construct_utils.utils import html_strip
+
+CORPUS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testdata',
+    'html_strip_corpus.json')
+
+
+def soup_text(text):
+  return bs4.BeautifulSoup(text, 'html.parser').get_text()
+
+
+class HtmlStripTest(unittest.TestCase):
+
+  def test_corpus_matches_beautifulsoup(self):
+    with io.open(CORPUS, encoding='utf-8') as f:
+      corpus = [json.loads(line) for line in f]
+    for record in corpus:
+      self.assertEqual(
+          html_strip.strip_html(record['text']), soup_text(record['text']),
+          record['source'])
+    # Every revision of the reconstruction testdata takes the streaming path.
+    for record in corpus:
+      if record['source'] != 'handwritten':
+        self.assertIsNotNone(
+            html_strip.fast_strip_html(record['text']), record['source'])
+
+  def test_strips_tags_and_comments(self):
+    self.assertEqual(
+        html_strip.fast_strip_html(
+            '<small>Hi <span style="color:red">there</span></small>'
+            '<!-- Template:Unsigned -->\n'), 'Hi there\n')
+
+  def test_collapses_whitespace_between_tags(self):
+    self.assertEqual(
+        html_strip.fast_strip_html('<b>x</b>  \n <i>y</i> '), 'x\ny ')
+    self.assertEqual(
+        html_strip.fast_strip_html('<pre>  </pre>  <b>x</b>'), '   x')
+
+  def test_decodes_entities(self):
+    self.assertEqual(
+        html_strip.fast_strip_html('a &amp; b &lt;3 &#65;&#x42;'), 'a & b <3 AB')
+    self.assertEqual(
+        html_strip.fast_strip_html('?title=Foo&action=edit x'),
+        soup_text('?title=Foo&action=edit x'))
+
+  def test_keeps_stray_angle_brackets(self):
+    self.assertEqual(html_strip.fast_strip_html('a < b, I <3 it'),
+                     'a < b, I <3 it')
+
+  def test_falls_back_on_unsupported_markup(self):
+    for text in [
+        '<script>var x = "<b>";</script>', '<!DOCTYPE html>x', '<?php ?>',
+        '<b class="x', '&#150;', '&check;', 'x &',
+        '<div><pre>B</div> <b>\t</b>', '<pre>B  B</P>\t'
+    ]:
+      self.assertIsNone(html_strip.fast_strip_html(text), text)
+      self.assertEqual(html_strip.strip_html(text), soup_text(text))
+
+  def test_verify(self):
+    text = '<b>bold</b> &amp; plain'
+    self.assertEqual(
+        html_strip.strip_html(text, verify=True), soup_text(text))
+
+
+if __name__ == '__main__':
+  unittest.main()
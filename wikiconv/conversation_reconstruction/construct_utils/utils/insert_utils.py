@@ -20,9 +20,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
 import copy
 import re
 
+import six
+
 
 def get_section_tokens(tokens, line):
   """Get section tokens."""
@@ -153,6 +156,58 @@ def get_indentation(tokens):
   return cnt
 
 
+def join_tokens(tokens):
+  """Joins tokens, returning text that is already joined as is."""
+  if isinstance(tokens, six.string_types):
+    return tokens
+  return ''.join(tokens)
+
+
+class TokenLocator(object):
+  """Locates many old positions, as locate_new_token_pos(pos, ops) does.
+
+  The operations are indexed once, so that each position is located with a
+  binary search instead of sorting and scanning the whole diff. Positions
+  after a deleted block are shifted by the same lookup as any other position.
+  """
+
+  def __init__(self, ops):
+    ops = sorted(ops, key=lambda k: (k['name'] != 'equal', k['a1']))
+    # Equal operations, by start, with their end and new start.
+    self._equal_starts = []
+    self._equals = []
+    # Deleted ranges, by start.
+    self._delete_starts = []
+    self._delete_ends = []
+    # Old end of the last insertion or deletion ending there -> its new end.
+    self._ends = {}
+    for op in ops:
+      if op['name'] == 'equal':
+        self._equal_starts.append(op['a1'])
+        self._equals.append((op['a1'], op['a2'], op['b1']))
+      else:
+        if op['name'] == 'delete':
+          self._delete_starts.append(op['a1'])
+          self._delete_ends.append(op['a2'])
+        self._ends[op['a2']] = op['b2']
+
+  def locate(self, old_pos):
+    """Returns the new position of old_pos, see locate_new_token_pos."""
+    new_pos = 0
+    # Equal operations ending at or after old_pos, in order.
+    ind = bisect.bisect_right(self._equal_starts, old_pos)
+    first = ind
+    while first > 0 and self._equals[first - 1][1] >= old_pos:
+      first -= 1
+    for a1, _, b1 in self._equals[first:ind]:
+      if not new_pos:
+        new_pos = b1 + old_pos - a1
+    ind = bisect.bisect_right(self._delete_starts, old_pos) - 1
+    if ind >= 0 and old_pos < self._delete_ends[ind]:
+      raise ValueError('locate_new_token_pos : Token has been deleted')
+    return self._ends.get(old_pos, new_pos)
+
+
 def locate_new_token_pos(old_pos, ops, errorchoice='raise_error'):
   """Locates new token pos."""
   new_pos = 0
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Tests for insert_utils."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils import conversation_constructor
+from wikiconv.conversation_reconstruction.construct_utils.utils import insert_utils
+
+OLD_TEXT = ('== Archived ==\n:First comment.\n::A reply.\n== Current ==\n'
+            ':Kept comment.\n')
+NEW_TEXT = '{{Archive box}}\n== Current ==\n:Kept comment, edited.\n:New.\n'
+
+
+class InsertUtilsTest(unittest.TestCase):
+
+  def test_token_locator(self):
+    ops = conversation_constructor.compute_diff(OLD_TEXT, NEW_TEXT)
+    locator = insert_utils.TokenLocator(ops)
+    located = 0
+    for pos in range(len(OLD_TEXT) + 1):
+      try:
+        expected = insert_utils.locate_new_token_pos(pos, ops)
+      except ValueError:
+        with self.assertRaises(ValueError):
+          locator.locate(pos)
+        continue
+      self.assertEqual(locator.locate(pos), expected)
+      located += 1
+    self.assertGreater(located, 0)
+    self.assertLess(located, len(OLD_TEXT) + 1)
+
+  def test_join_tokens(self):
+    text = 'some text'
+    self.assertIs(insert_utils.join_tokens(text), text)
+    self.assertEqual(insert_utils.join_tokens(['some', ' ', 'text']), text)
+
+
+if __name__ == '__main__':
+  unittest.main()
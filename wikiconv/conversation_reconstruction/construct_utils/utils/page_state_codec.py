@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""Compact encoding of reconstruction page states.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Page states are carried from one run of the reconstruction pipeline to the
+next as lines of text. As JSON, every run parses and re-serializes all of them,
+including offsets as stringified keys, one author list per action and the full
+text of every deleted comment, even though most pages have no new revisions.
+
+An encoded page state is a single line:
+
+  wcps<version> TAB <page id as JSON> TAB <name>:<base64 data> TAB ...
+
+Each named section is zlib compressed and decoded only when it is accessed, so
+a page can be keyed and passed through without decoding anything. Action ids
+are interned in the `ids` section and referred to by index; offsets, indices
+and indentations are packed as little-endian 32 bit integers, offsets as
+deltas; authors are interned so that actions sharing an author share a tuple.
+
+Both formats are accepted by `loads`, which returns the page state in the form
+used by ConversationConstructor: int offsets, tuple action values and lists of
+author tuples. While processing, authors are kept as sets; `dumps` turns them
+back into lists for JSON.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import base64
+import json
+import struct
+import zlib
+
+import six
+
+MAGIC = 'wcps'
+VERSION = 1
+FORMATS = ('json', 'binary')
+
+# Page state keys with their own section; everything else goes into `meta`.
+_MAPPED_SECTIONS = ('conversation_id', 'ancestor_id')
+_SECTIONS = ('actions', 'authors', 'deleted_comments') + _MAPPED_SECTIONS
+_PREFIX = '%s%d\t' % (MAGIC, VERSION)
+_INT = struct.Struct('<I')
+
+
+def _pack_ints(values):
+  return struct.pack('<%di' % len(values), *values)
+
+
+def _unpack_ints(data):
+  return struct.unpack('<%di' % (len(data) // 4), data)
+
+
+def _json_bytes(value):
+  return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _json_value(data):
+  return json.loads(data.decode('utf-8'))
+
+
+def is_encoded(line):
+  """Tests if a page state line is in the binary encoding."""
+  return line.startswith(MAGIC)
+
+
+def encode(page_state):
+  """Encodes a page state dictionary as a single line of text."""
+  page_state = dict(page_state)
+  page = dict(page_state.pop('page_state', None) or {})
+  actions = page.pop('actions', None)
+  sections = []
+  ids = []
+  id_index = {}
+
+  def intern_id(action_id):
+    if action_id not in id_index:
+      id_index[action_id] = len(ids)
+      ids.append(action_id)
+    return id_index[action_id]
+
+  if actions is not None:
+    values = []
+    last = 0
+    for offset in sorted(int(pos) for pos in actions):
+      action = actions[offset] if offset in actions else actions[str(offset)]
+      if tuple(action) == (-1, -1):
+        values.extend((offset - last, -1, -1))
+      else:
+        values.extend((offset - last, intern_id(action[0]), action[1]))
+      last = offset
+    sections.append(('actions', _pack_ints(values)))
+  for name in _MAPPED_SECTIONS:
+    if name in page_state:
+      mapping = page_state.pop(name)
+      values = []
+      for key, value in six.iteritems(mapping):
+        values.extend((intern_id(key), intern_id(value)))
+      sections.append((name, _pack_ints(values)))
+  if 'authors' in page_state:
+    authors = []
+    author_index = {}
+    values = []
+    for action_id, action_authors in six.iteritems(page_state.pop('authors')):
+      values.extend((intern_id(action_id), len(action_authors)))
+      for author in action_authors:
+        author = tuple(author)
+        if author not in author_index:
+          author_index[author] = len(authors)
+          authors.append(author)
+        values.append(author_index[author])
+    table = _json_bytes(authors)
+    sections.append(('authors', _INT.pack(len(table)) + table +
+                     _pack_ints(values)))
+  if 'deleted_comments' in page_state:
+    sections.append(('deleted_comments',
+                     _json_bytes(page_state.pop('deleted_comments'))))
+  page_state['page_state'] = page
+  sections = [('meta', _json_bytes(page_state)), ('ids', _json_bytes(ids))
+             ] + sections
+  return _PREFIX + '\t'.join(
+      [json.dumps(page_state.get('page_id'))] + [
+          '%s:%s' % (name, base64.b64encode(zlib.compress(data)).decode('ascii'))
+          for name, data in sections
+      ])
+
+
+class EncodedPageState(object):
+  """A page state in the binary encoding, decoded section by section."""
+
+  def __init__(self, line):
+    if not line.startswith(_PREFIX):
+      raise ValueError('Unsupported page state encoding: %r' % line[:10])
+    self.line = line
+    fields = line[len(_PREFIX):].rstrip('\n').split('\t')
+    self.page_id = json.loads(fields[0])
+    self._raw = dict(field.split(':', 1) for field in fields[1:])
+    self._decoded = {}
+
+  def _data(self, name):
+    return zlib.decompress(base64.b64decode(self._raw[name]))
+
+  def sections(self):
+    return list(self._raw)
+
+  def section(self, name):
+    """Returns the decoded value of a section, decoding it on first access."""
+    if name not in self._decoded:
+      self._decoded[name] = getattr(self, '_decode_' + name)()
+    return self._decoded[name]
+
+  def _decode_meta(self):
+    return _json_value(self._data('meta'))
+
+  def _decode_ids(self):
+    return _json_value(self._data('ids'))
+
+  def _decode_actions(self):
+    ids = self.section('ids')
+    values = _unpack_ints(self._data('actions'))
+    actions = {}
+    offset = 0
+    for pos in range(0, len(values), 3):
+      offset += values[pos]
+      if values[pos + 1] == -1:
+        actions[offset] = (-1, -1)
+      else:
+        actions[offset] = (ids[values[pos + 1]], values[pos + 2])
+    return actions
+
+  def _decode_mapping(self, name):
+    ids = self.section('ids')
+    values = _unpack_ints(self._data(name))
+    return {
+        ids[values[pos]]: ids[values[pos + 1]]
+        for pos in range(0, len(values), 2)
+    }
+
+  def _decode_conversation_id(self):
+    return self._decode_mapping('conversation_id')
+
+  def _decode_ancestor_id(self):
+    return self._decode_mapping('ancestor_id')
+
+  def _decode_authors(self):
+    ids = self.section('ids')
+    data = self._data('authors')
+    table_end = _INT.size + _INT.unpack_from(data)[0]
+    authors = [
+        tuple(author) for author in _json_value(data[_INT.size:table_end])
+    ]
+    values = _unpack_ints(data[table_end:])
+    ret = {}
+    pos = 0
+    while pos < len(values):
+      count = values[pos + 1]
+      ret[ids[values[pos]]] = [
+          authors[ind] for ind in values[pos + 2:pos + 2 + count]
+      ]
+      pos += 2 + count
+    return ret
+
+  def _decode_deleted_comments(self):
+    return _json_value(self._data('deleted_comments'))
+
+  def decode(self):
+    """Returns the full page state dictionary."""
+    page_state = dict(self.section('meta'))
+    page_state['page_state'] = dict(page_state['page_state'])
+    if 'actions' in self._raw:
+      page_state['page_state']['actions'] = self.section('actions')
+    for name in _SECTIONS:
+      if name != 'actions' and name in self._raw:
+        page_state[name] = self.section(name)
+    return page_state
+
+
+def normalize(page_state):
+  """Converts a page state parsed from JSON to the form used for processing."""
+  page_state['page_state']['actions'] = {
+      int(pos): tuple(val)
+      for pos, val in six.iteritems(page_state['page_state']['actions'])
+  }
+  authors = {}
+  for action_id, action_authors in six.iteritems(page_state['authors']):
+    authors[action_id] = [tuple(author) for author in action_authors]
+  page_state['authors'] = authors
+  return page_state
+
+
+def loads(line):
+  """Decodes a page state line in either format."""
+  if is_encoded(line):
+    return EncodedPageState(line).decode()
+  page_state = json.loads(line)
+  if page_state is None:
+    return None
+  return normalize(page_state)
+
+
+def dumps(page_state, page_state_format='json'):
+  """Serializes a page state dictionary in the given format."""
+  if page_state is None:
+    # Pages without a state yet are written as JSON null in either format.
+    return json.dumps(page_state)
+  if page_state_format == 'binary':
+    return encode(page_state)
+  if page_state_format == 'json':
+    if 'authors' in page_state:
+      # Author sets are kept as sets while processing.
+      page_state = dict(page_state)
+      page_state['authors'] = {
+          action_id: list(authors)
+          for action_id, authors in six.iteritems(page_state['authors'])
+      }
+    return json.dumps(page_state)
+  raise ValueError('Unknown page state format: %s' % page_state_format)
+
+
+def index_by_page_id(line):
+  """Pairs a page state line with its page id, leaving it undecoded.
+
+  Args:
+    line: a page state in either format.
+
+  Returns:
+    A tuple of the page id and the line.
+  """
+  if is_encoded(line):
+    return (EncodedPageState(line).page_id, line)
+  return (json.loads(line)['page_id'], line)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Tests for page_state_codec."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+
+PAGE_STATE = {
+    'rev_id': 332251990,
+    'timestamp': '2001-09-12T18:22:34Z',
+    'page_id': '28031',
+    'page_state': {
+        'page_id': '28031',
+        'page_title': 'Talk:Prostitution',
+        'actions': {
+            0: ('332251982.0.0', 0),
+            51: ('332251990.1.0', 1),
+            90: (-1, -1)
+        }
+    },
+    'deleted_comments': [['Deleted comment about ümlauts.', '332251985.0.1', 2,
+                          1000212154]],
+    'conversation_id': {
+        '332251982.0.0': '332251982.0.0',
+        '332251990.1.0': '332251982.0.0',
+        '332251985.0.1': '332251982.0.0'
+    },
+    'ancestor_id': {
+        '332251982.0.0': '332251982.0.0',
+        '332251990.1.0': '332251990.1.0',
+        '332251985.0.1': '332251985.0.1'
+    },
+    'authors': {
+        '332251982.0.0': [(8083618, 'Anders Torlind')],
+        '332251990.1.0': [(8083618, 'Anders Torlind'), (None, '127.0.0.1')],
+        '332251985.0.1': [(None, '127.0.0.1')]
+    }
+}
+
+
+class PageStateCodecTest(unittest.TestCase):
+
+  def test_round_trip(self):
+    line = page_state_codec.encode(PAGE_STATE)
+    self.assertTrue(page_state_codec.is_encoded(line))
+    self.assertNotIn('\n', line)
+    self.assertEqual(page_state_codec.loads(line), PAGE_STATE)
+
+  def test_json_compatible(self):
+    line = json.dumps(PAGE_STATE)
+    self.assertFalse(page_state_codec.is_encoded(line))
+    self.assertEqual(page_state_codec.loads(line), PAGE_STATE)
+    self.assertEqual(page_state_codec.loads(page_state_codec.encode(
+        json.loads(line))), PAGE_STATE)
+    self.assertEqual(
+        page_state_codec.dumps(PAGE_STATE, 'json'), json.dumps(PAGE_STATE))
+    with self.assertRaises(ValueError):
+      page_state_codec.dumps(PAGE_STATE, 'xml')
+
+  def test_interns_authors(self):
+    authors = page_state_codec.loads(
+        page_state_codec.encode(PAGE_STATE))['authors']
+    self.assertIs(authors['332251990.1.0'][1], authors['332251985.0.1'][0])
+
+  def test_lazy_sections(self):
+    line = page_state_codec.encode(PAGE_STATE)
+    self.assertEqual(page_state_codec.index_by_page_id(line), ('28031', line))
+    encoded = page_state_codec.EncodedPageState(line)
+    self.assertEqual(encoded.page_id, '28031')
+    self.assertEqual(encoded._decoded, {})
+    self.assertEqual(encoded.section('deleted_comments'),
+                     PAGE_STATE['deleted_comments'])
+    self.assertEqual(sorted(encoded._decoded), ['deleted_comments'])
+
+  def test_partial_page_state(self):
+    page_state = {'page_state': {'actions': {}}, 'authors': {}}
+    self.assertEqual(
+        page_state_codec.loads(page_state_codec.encode(page_state)),
+        page_state)
+
+  def test_no_page_state(self):
+    for page_state_format in ('json', 'binary'):
+      line = page_state_codec.dumps(None, page_state_format)
+      self.assertEqual(line, 'null')
+      self.assertIsNone(page_state_codec.loads(line))
+
+  def test_rejects_other_versions(self):
+    with self.assertRaises(ValueError):
+      page_state_codec.EncodedPageState('wcps9\t1\tmeta:')
+
+
+if __name__ == '__main__':
+  unittest.main()
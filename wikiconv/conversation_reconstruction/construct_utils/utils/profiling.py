@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Opt-in profiling of the reconstruction of selected pages.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+A Profiler selects pages by id. For a selected page it hands out a
+PageProfile, and for every other page None, so instrumented code guards its
+stages with `stage(profile, name)`, which costs a function call when profiling
+is off.
+
+A PageProfile attributes wall time, and optionally the memory allocated as
+traced by tracemalloc, to the stages of ConversationConstructor.process. Time
+is exclusive: a stage entered from another one is not counted in the outer
+stage. A page can also be profiled with cProfile, whose statistics are written
+in the format of pstats, which snakeviz, gprof2dot or flameprof turn into
+call graphs and flame graphs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import cProfile
+import json
+import logging
+import marshal
+import timeit
+
+import six
+
+try:
+  import tracemalloc  # pylint: disable=g-import-not-at-top
+except ImportError:
+  tracemalloc = None
+
+STAGES = ('clean_html', 'diff', 'insert', 'postprocess', 'clean_dict')
+
+
+def log_sink(summary):
+  """Logs the summary of a page profile as a single line of JSON."""
+  logging.info('PROFILE %s', json.dumps(summary, sort_keys=True))
+
+
+def stats_filename(page_id):
+  """Returns the name of the file of the cProfile statistics of a page."""
+  return 'cprofile-page-%s.prof' % page_id
+
+
+class _NoStage(object):
+
+  def __enter__(self):
+    return None
+
+  def __exit__(self, *unused_exc_info):
+    return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(profile, name):
+  """Returns a context manager profiling a stage, if profile is not None."""
+  if profile is None:
+    return _NO_STAGE
+  return profile.stage(name)
+
+
+class _Stage(object):
+
+  def __init__(self, profile, name):
+    self._profile = profile
+    self._name = name
+
+  def __enter__(self):
+    self._profile.enter(self._name)
+
+  def __exit__(self, *unused_exc_info):
+    self._profile.exit()
+    return False
+
+
+class PageProfile(object):
+  """The profile of the reconstruction of a page.
+
+  Attributes:
+    page_id: the id of the page.
+    revisions: the number of revisions profiled.
+    seconds: dictionary of the wall time of each stage.
+    allocated_bytes: dictionary of the net memory allocated by each stage, or
+      None if memory is not traced.
+    calls: dictionary of the number of times each stage was entered.
+  """
+
+  def __init__(self, page_id, trace_memory=False, cprofile=False):
+    self.page_id = page_id
+    self.revisions = 0
+    self.seconds = dict.fromkeys(STAGES, 0.0)
+    self.allocated_bytes = (
+        dict.fromkeys(STAGES, 0) if trace_memory and tracemalloc else None)
+    self.calls = dict.fromkeys(STAGES, 0)
+    self._cprofile = cProfile.Profile() if cprofile else None
+    self._stack = []
+    self._mark_time = None
+    self._mark_memory = None
+
+  def _charge(self):
+    """Charges the time and memory since the last mark to the current stage."""
+    now = timeit.default_timer()
+    memory = (
+        tracemalloc.get_traced_memory()[0]
+        if self.allocated_bytes is not None else None)
+    if self._stack:
+      self.seconds[self._stack[-1]] += now - self._mark_time
+      if memory is not None:
+        self.allocated_bytes[self._stack[-1]] += memory - self._mark_memory
+    self._mark_time = now
+    self._mark_memory = memory
+
+  def enter(self, name):
+    self._charge()
+    self._stack.append(name)
+    self.calls[name] += 1
+
+  def exit(self):
+    self._charge()
+    self._stack.pop()
+
+  def stage(self, name):
+    return _Stage(self, name)
+
+  def start_revision(self):
+    self.revisions += 1
+    if self._cprofile:
+      self._cprofile.enable()
+
+  def stop_revision(self):
+    if self._cprofile:
+      self._cprofile.disable()
+
+  def stats(self):
+    """Returns the cProfile statistics in the pstats format, or None."""
+    if not self._cprofile:
+      return None
+    self._cprofile.create_stats()
+    return marshal.dumps(self._cprofile.stats)
+
+  def summary(self):
+    """Returns the profile as a dictionary of JSON types."""
+    return {
+        'page_id': self.page_id,
+        'revisions': self.revisions,
+        'stages': {
+            name: {
+                'seconds': self.seconds[name],
+                'calls': self.calls[name],
+                'allocated_bytes': (None if self.allocated_bytes is None else
+                                    self.allocated_bytes[name])
+            } for name in STAGES
+        }
+    }
+
+
+class Profiler(object):
+  """Selects the pages to profile.
+
+  Attributes:
+    page_ids: set of page ids to profile, or None for all pages.
+    trace_memory: whether to trace the memory allocated by each stage.
+    cprofile_page_ids: set of page ids to also profile with cProfile.
+  """
+
+  def __init__(self,
+               page_ids=None,
+               trace_memory=False,
+               cprofile_page_ids=(),
+               sink=log_sink):
+    """Constructor.
+
+    Args:
+      page_ids: iterable of the page ids to profile, or None for all pages.
+      trace_memory: whether to trace the memory allocated by each stage with
+        tracemalloc, which slows the reconstruction down severalfold. Tracing
+        starts with the first profiled page and is left on.
+      cprofile_page_ids: iterable of the page ids to also profile with
+        cProfile. They are profiled even if not in page_ids.
+      sink: function called with the summary of each finished profile. It must
+        be picklable for the profiler to be shipped to pipeline workers.
+    """
+    self.page_ids = (
+        None if page_ids is None else set(six.text_type(p) for p in page_ids))
+    self.trace_memory = trace_memory
+    self.cprofile_page_ids = set(six.text_type(p) for p in cprofile_page_ids)
+    self.sink = sink
+
+  def is_profiled(self, page_id):
+    page_id = six.text_type(page_id)
+    return ((self.page_ids is None or page_id in self.page_ids) or
+            page_id in self.cprofile_page_ids)
+
+  def profile(self, page_id):
+    """Returns a PageProfile for the page if it is selected, or None."""
+    if not self.is_profiled(page_id):
+      return None
+    if self.trace_memory and tracemalloc and not tracemalloc.is_tracing():
+      tracemalloc.start()
+    return PageProfile(page_id, self.trace_memory,
+                       six.text_type(page_id) in self.cprofile_page_ids)
+
+  def finish(self, profile):
+    """Emits the summary of a profile to the sink, and returns it."""
+    summary = profile.summary()
+    self.sink(summary)
+    return summary
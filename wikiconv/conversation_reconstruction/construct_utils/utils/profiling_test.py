@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Tests for profiling."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import marshal
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils.utils import profiling
+
+
+class ProfilingTest(unittest.TestCase):
+
+  def tearDown(self):
+    if profiling.tracemalloc:
+      profiling.tracemalloc.stop()
+
+  def test_selection(self):
+    profiler = profiling.Profiler(page_ids=[12, '34'], cprofile_page_ids=[56])
+    self.assertTrue(profiler.is_profiled('12'))
+    self.assertTrue(profiler.is_profiled(34))
+    self.assertTrue(profiler.is_profiled('56'))
+    self.assertFalse(profiler.is_profiled('78'))
+    self.assertIsNone(profiler.profile('78'))
+    self.assertIsNone(profiler.profile('12').stats())
+    self.assertTrue(profiling.Profiler().is_profiled('78'))
+
+  def test_no_profile(self):
+    with profiling.stage(None, 'diff') as stage:
+      self.assertIsNone(stage)
+
+  def test_exclusive_stages(self):
+    profile = profiling.Profiler(trace_memory=True).profile('12')
+    with profiling.stage(profile, 'postprocess'):
+      with profiling.stage(profile, 'clean_dict'):
+        allocation = [0] * 100000
+      with profiling.stage(profile, 'clean_dict'):
+        pass
+    del allocation
+    summary = profile.summary()
+    self.assertEqual(summary['stages']['postprocess']['calls'], 1)
+    self.assertEqual(summary['stages']['clean_dict']['calls'], 2)
+    self.assertEqual(summary['stages']['diff']['calls'], 0)
+    self.assertEqual(summary['stages']['diff']['seconds'], 0)
+    self.assertGreater(summary['stages']['clean_dict']['seconds'], 0)
+    if profiling.tracemalloc:
+      self.assertGreater(summary['stages']['clean_dict']['allocated_bytes'],
+                         700000)
+      self.assertLess(summary['stages']['postprocess']['allocated_bytes'],
+                      100000)
+
+  def test_finish(self):
+    summaries = []
+    profiler = profiling.Profiler(
+        trace_memory=True, cprofile_page_ids=['12'], sink=summaries.append)
+    profile = profiler.profile('12')
+    profile.start_revision()
+    with profiling.stage(profile, 'insert'):
+      sorted(range(1000), key=lambda x: -x)
+    profile.stop_revision()
+    self.assertEqual(profiler.finish(profile), summaries[0])
+    self.assertEqual(summaries[0]['page_id'], '12')
+    self.assertEqual(summaries[0]['revisions'], 1)
+    if profiling.tracemalloc:
+      self.assertIsNotNone(
+          summaries[0]['stages']['insert']['allocated_bytes'])
+    stats = marshal.loads(profile.stats())
+    self.assertTrue(
+        any(function == 'sorted' or 'sorted' in function
+            for (_, _, function) in stats))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""Index of deleted comments used to detect comment restorations.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+A restored comment is a previously deleted comment that is added back to the
+page verbatim. The index finds such comments inside added text with the same
+leftmost-longest, non-overlapping semantics as `noaho.NoAho.findall_long`.
+
+Instead of an Aho-Corasick automaton, which has to be rebuilt pattern by
+pattern whenever a page state is loaded, deleted comments are grouped by their
+first few characters (the anchor). A position of the added text can only start
+a restoration if the anchor found there is in the index, and the candidates of
+an anchor are kept longest first, so the first candidate that matches is the
+longest one. Adding and removing a comment only touches its anchor group, and
+`records` serializes the index in anchor order so that `from_records` reloads
+it with a single sort instead of re-adding patterns one at a time.
+
+Deleted comments are only worth keeping while they are likely to be restored.
+A RetentionPolicy bounds the index by the age of a comment's last sighting
+(its deletion or latest restoration, in revision time), by count and by the
+bytes of comment text, evicting the least recently seen comments first. The
+index counts evictions, and additions that re-add an evicted comment verbatim
+as missed restorations, so the bounds can be chosen from data.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+import collections
+import hashlib
+import itertools
+import time
+
+import six
+
+# Number of leading characters deleted comments are grouped by. Comments
+# shorter than this are anchored on their whole text.
+ANCHOR_LENGTH = 8
+# Approximate bytes used by the bookkeeping of an indexed comment, on top of
+# its text.
+ENTRY_OVERHEAD = 300
+# Number of evicted comments remembered to detect missed restorations.
+EVICTED_MEMORY = 10000
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def parse_timestamp(timestamp):
+  """Converts a revision timestamp to seconds since the epoch."""
+  return calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
+
+
+def _encode(text):
+  # Lone surrogates can come from JSON input; they are kept rather than fail.
+  return text.encode('utf-8', 'surrogatepass')
+
+
+def _digest(text):
+  return hashlib.sha1(_encode(text)).digest()
+
+
+class RetentionPolicy(object):
+  """Bounds on the deleted comments kept as restoration candidates.
+
+  Attributes:
+    max_age: seconds of revision time after which a comment that was not seen
+      again is dropped, or None.
+    max_count: maximum number of comments kept, or None.
+    max_bytes: maximum total UTF-8 size of the comments kept, or None.
+  """
+
+  def __init__(self, max_age=None, max_count=None, max_bytes=None):
+    self.max_age = max_age
+    self.max_count = max_count
+    self.max_bytes = max_bytes
+
+  def is_bounded(self):
+    return not (self.max_age is None and self.max_count is None and
+                self.max_bytes is None)
+
+
+class RestorationIndex(object):
+  """Deleted comments, searchable within added text."""
+
+  def __init__(self, anchor_length=ANCHOR_LENGTH, policy=None):
+    self.anchor_length = anchor_length
+    self.policy = policy or RetentionPolicy()
+    # Comment text -> (action id, indentation) of the deleted comment.
+    self._payloads = {}
+    # Anchor -> texts of the comments starting with it, longest first.
+    self._groups = {}
+    # Lengths of the anchors in _groups, with the number of groups of each.
+    self._anchor_lengths = {}
+    # Comment text -> timestamp it was last seen, least recently seen first.
+    self._last_seen = collections.OrderedDict()
+    self._bytes = 0
+    # Digests of evicted comments, oldest first.
+    self._evicted = collections.OrderedDict()
+    self.evictions = 0
+    self.missed_restorations = 0
+
+  @classmethod
+  def from_records(cls,
+                   records,
+                   anchor_length=ANCHOR_LENGTH,
+                   policy=None,
+                   default_timestamp=None):
+    """Loads an index from serialized records.
+
+    As with repeated calls to add, a later record replaces an earlier one with
+    the same text. The texts are last seen in the order of their timestamps
+    and, among equal timestamps, of the records, so the index evicts them in
+    the order it did before `records`.
+
+    Args:
+      records: iterable of (text, action id, indentation[, last seen])
+        sequences, the last seen timestamp being in seconds since the epoch.
+      anchor_length: see ANCHOR_LENGTH.
+      policy: an optional RetentionPolicy.
+      default_timestamp: the last seen timestamp of records without one.
+
+    Returns:
+      The RestorationIndex.
+    """
+    index = cls(anchor_length, policy)
+    last_seen = collections.OrderedDict()
+    for record in records:
+      index._payloads[record[0]] = (record[1], int(record[2]))
+      last_seen.pop(record[0], None)
+      last_seen[record[0]] = (
+          record[3] if len(record) > 3 and record[3] is not None else
+          default_timestamp)
+    texts = sorted(index._payloads, key=index._sort_key)
+    for anchor, group in itertools.groupby(texts, key=index._anchor):
+      index._groups[anchor] = list(group)
+      index._anchor_lengths[len(anchor)] = (
+          index._anchor_lengths.get(len(anchor), 0) + 1)
+    index._last_seen = collections.OrderedDict(
+        sorted(
+            six.iteritems(last_seen),
+            key=lambda item: -1 if item[1] is None else item[1]))
+    index._bytes = sum(len(_encode(text)) for text in index._payloads)
+    return index
+
+  def records(self):
+    """Returns the index as (text, action id, indentation, last seen) tuples.
+
+    The tuples are in the order the texts were last seen, oldest first.
+    """
+    return [(text,) + self._payloads[text] + (last_seen,)
+            for text, last_seen in six.iteritems(self._last_seen)]
+
+  def _anchor(self, text):
+    return text[:self.anchor_length]
+
+  def _sort_key(self, text):
+    return (text[:self.anchor_length], -len(text))
+
+  def __len__(self):
+    return len(self._payloads)
+
+  def __contains__(self, text):
+    return text in self._payloads
+
+  def __getitem__(self, text):
+    return self._payloads[text]
+
+  def action_ids(self):
+    """Returns the ids of the deleted actions in the index."""
+    return [payload[0] for payload in self._payloads.values()]
+
+  def add(self, text, payload, timestamp=None):
+    """Adds a deleted comment, replacing the payload of an identical one.
+
+    Args:
+      text: the text of the deleted comment, must not be empty.
+      payload: the (action id, indentation) pair reported on a match.
+      timestamp: when the comment was deleted, in seconds since the epoch.
+    """
+    if not text:
+      raise ValueError('Cannot index an empty comment.')
+    self._last_seen.pop(text, None)
+    self._last_seen[text] = timestamp
+    if text not in self._payloads:
+      self._bytes += len(_encode(text))
+      anchor = self._anchor(text)
+      group = self._groups.get(anchor)
+      if group is None:
+        self._groups[anchor] = [text]
+        self._anchor_lengths[len(anchor)] = (
+            self._anchor_lengths.get(len(anchor), 0) + 1)
+      else:
+        # Keep the group longest first.
+        pos = 0
+        while pos < len(group) and len(group[pos]) >= len(text):
+          pos += 1
+        group.insert(pos, text)
+    self._payloads[text] = payload
+
+  def remove(self, text):
+    """Removes a deleted comment, returning its payload or None if absent."""
+    payload = self._payloads.pop(text, None)
+    if payload is None:
+      return None
+    del self._last_seen[text]
+    self._bytes -= len(_encode(text))
+    anchor = self._anchor(text)
+    group = self._groups[anchor]
+    group.remove(text)
+    if not group:
+      del self._groups[anchor]
+      self._anchor_lengths[len(anchor)] -= 1
+      if not self._anchor_lengths[len(anchor)]:
+        del self._anchor_lengths[len(anchor)]
+    return payload
+
+  def touch(self, text, timestamp):
+    """Marks an indexed comment as seen again, e.g. when it is restored."""
+    if text in self._last_seen:
+      del self._last_seen[text]
+      self._last_seen[text] = timestamp
+
+  def _evict_oldest(self):
+    """Evicts the least recently seen comment, returning its payload."""
+    text = next(iter(self._last_seen))
+    payload = self.remove(text)
+    self._evicted[_digest(text)] = True
+    if len(self._evicted) > EVICTED_MEMORY:
+      self._evicted.popitem(last=False)
+    self.evictions += 1
+    return payload
+
+  def enforce(self, timestamp):
+    """Evicts the least recently seen comments until the policy holds.
+
+    Args:
+      timestamp: the current revision time, in seconds since the epoch.
+
+    Returns:
+      The list of payloads of the evicted comments.
+    """
+    policy = self.policy
+    if not policy.is_bounded():
+      return []
+    evicted = []
+    while self._last_seen:
+      last_seen = next(iter(six.itervalues(self._last_seen)))
+      if not ((policy.max_count is not None and
+               len(self._payloads) > policy.max_count) or
+              (policy.max_bytes is not None and
+               self._bytes > policy.max_bytes) or
+              (policy.max_age is not None and last_seen is not None and
+               timestamp is not None and
+               timestamp - last_seen > policy.max_age)):
+        break
+      evicted.append(self._evict_oldest())
+    return evicted
+
+  def memory_usage(self):
+    """Estimates the bytes held by the index."""
+    return self._bytes + ENTRY_OVERHEAD * len(self._payloads)
+
+  def shrink(self, max_bytes):
+    """Evicts the least recently seen comments until memory_usage fits.
+
+    Args:
+      max_bytes: the number of bytes the index may use.
+
+    Returns:
+      The list of payloads of the evicted comments.
+    """
+    evicted = []
+    while self._last_seen and self.memory_usage() > max_bytes:
+      evicted.append(self._evict_oldest())
+    return evicted
+
+  def note_addition(self, text):
+    """Counts text as a missed restoration if it was evicted before.
+
+    Only additions consisting of exactly one evicted comment are detected, so
+    the count is a lower bound.
+
+    Args:
+      text: the added text.
+
+    Returns:
+      True if the addition restores an evicted comment.
+    """
+    if not self._evicted:
+      return False
+    digest = _digest(text)
+    if digest not in self._evicted:
+      return False
+    del self._evicted[digest]
+    self.missed_restorations += 1
+    return True
+
+  def findall_long(self, text):
+    """Finds deleted comments in text.
+
+    Args:
+      text: the added text to search.
+
+    Yields:
+      (start, end, payload) tuples for the leftmost longest non-overlapping
+      occurrences of indexed comments, in order.
+    """
+    groups = self._groups
+    if not groups:
+      return
+    candidates = set()
+    for length in self._anchor_lengths:
+      candidates.update(
+          pos for pos in range(len(text) - length + 1)
+          if text[pos:pos + length] in groups)
+    end = 0
+    for pos in sorted(candidates):
+      if pos < end:
+        continue
+      best = None
+      for length in self._anchor_lengths:
+        group = groups.get(text[pos:pos + length])
+        if group is None:
+          continue
+        for candidate in group:
+          if best is not None and len(candidate) <= len(best):
+            break
+          if text.startswith(candidate, pos):
+            best = candidate
+            break
+      if best is not None:
+        end = pos + len(best)
+        yield pos, end, self._payloads[best]
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Tests for restoration_index."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils.utils import restoration_index
+
+FIRST = 'I think this section should go.'
+SECOND = 'I think this section should go. Agreed, it is not neutral.'
+THIRD = 'Please see the talk page archive.'
+
+
+class RestorationIndexTest(unittest.TestCase):
+
+  def make_index(self):
+    index = restoration_index.RestorationIndex()
+    index.add(FIRST, ('1.0.0', 0))
+    index.add(SECOND, ('2.0.0', 1))
+    index.add(THIRD, ('3.0.0', 2))
+    return index
+
+  def test_findall_long(self):
+    index = self.make_index()
+    text = 'x ' + SECOND + THIRD + ' ' + FIRST
+    self.assertEqual(
+        list(index.findall_long(text)),
+        [(2, 2 + len(SECOND), ('2.0.0', 1)),
+         (2 + len(SECOND), 2 + len(SECOND + THIRD), ('3.0.0', 2)),
+         (len(text) - len(FIRST), len(text), ('1.0.0', 0))])
+    self.assertEqual(list(index.findall_long('nothing to see here')), [])
+    self.assertEqual(list(index.findall_long('')), [])
+
+  def test_leftmost_match_wins(self):
+    index = restoration_index.RestorationIndex()
+    index.add('abcdefghijkl', ('a', 0))
+    index.add('cdefghijklmnopqrst', ('c', 0))
+    self.assertEqual(
+        list(index.findall_long('xxabcdefghijklmnopqrst')),
+        [(2, 14, ('a', 0))])
+
+  def test_short_comments(self):
+    index = restoration_index.RestorationIndex()
+    index.add('abc', ('a', 0))
+    index.add('abcdefghijkl', ('b', 0))
+    self.assertEqual(
+        list(index.findall_long('abc abcdefghijkl abc')),
+        [(0, 3, ('a', 0)), (4, 16, ('b', 0)), (17, 20, ('a', 0))])
+
+  def test_add_replaces_payload(self):
+    index = self.make_index()
+    index.add(FIRST, ('4.0.0', 3))
+    self.assertEqual(len(index), 3)
+    self.assertEqual(index[FIRST], ('4.0.0', 3))
+    self.assertEqual(list(index.findall_long(FIRST)),
+                     [(0, len(FIRST), ('4.0.0', 3))])
+
+  def test_remove(self):
+    index = self.make_index()
+    self.assertEqual(index.remove(SECOND), ('2.0.0', 1))
+    self.assertIsNone(index.remove(SECOND))
+    self.assertNotIn(SECOND, index)
+    # The shorter comment sharing the anchor is still found.
+    self.assertEqual(list(index.findall_long(SECOND)),
+                     [(0, len(FIRST), ('1.0.0', 0))])
+    index.remove(FIRST)
+    index.remove(THIRD)
+    self.assertEqual(len(index), 0)
+    self.assertEqual(list(index.findall_long(SECOND + THIRD)), [])
+
+  def test_records_round_trip(self):
+    index = self.make_index()
+    records = json.loads(json.dumps(index.records()))
+    loaded = restoration_index.RestorationIndex.from_records(records)
+    self.assertEqual(loaded.records(), index.records())
+    self.assertEqual(sorted(loaded.action_ids()), ['1.0.0', '2.0.0', '3.0.0'])
+    text = THIRD + SECOND
+    self.assertEqual(
+        list(loaded.findall_long(text)), list(index.findall_long(text)))
+
+  def test_from_records_keeps_last_duplicate(self):
+    index = restoration_index.RestorationIndex.from_records([
+        (FIRST, '1.0.0', '0'), (THIRD, '3.0.0', 2), (FIRST, '5.0.0', 1)
+    ])
+    self.assertEqual(len(index), 2)
+    self.assertEqual(index[FIRST], ('5.0.0', 1))
+
+  def test_lone_surrogate(self):
+    text = 'A comment cut in the middle of a pair \ud83d, kept as is.'
+    index = restoration_index.RestorationIndex(
+        policy=restoration_index.RetentionPolicy(max_bytes=10000))
+    index.add(text, ('1.0.0', 0))
+    loaded = restoration_index.RestorationIndex.from_records(index.records())
+    self.assertEqual(loaded[text], ('1.0.0', 0))
+    self.assertEqual(index.remove(text), ('1.0.0', 0))
+    self.assertEqual(len(index), 0)
+
+  def test_evicts_least_recently_seen(self):
+    index = restoration_index.RestorationIndex(
+        policy=restoration_index.RetentionPolicy(max_count=2))
+    index.add(FIRST, ('1.0.0', 0), 10)
+    index.add(SECOND, ('2.0.0', 1), 20)
+    index.touch(FIRST, 25)
+    index.add(THIRD, ('3.0.0', 2), 30)
+    self.assertEqual(index.enforce(30), [('2.0.0', 1)])
+    self.assertEqual(sorted(index.action_ids()), ['1.0.0', '3.0.0'])
+    self.assertEqual(index.evictions, 1)
+
+  def test_evicts_by_age_and_bytes(self):
+    index = restoration_index.RestorationIndex(
+        policy=restoration_index.RetentionPolicy(max_age=100))
+    index.add(FIRST, ('1.0.0', 0), 0)
+    index.add(THIRD, ('3.0.0', 2), 50)
+    self.assertEqual(index.enforce(100), [])
+    self.assertEqual(index.enforce(101), [('1.0.0', 0)])
+    index = restoration_index.RestorationIndex(
+        policy=restoration_index.RetentionPolicy(max_bytes=len(SECOND)))
+    index.add(FIRST, ('1.0.0', 0), 0)
+    index.add(SECOND, ('2.0.0', 1), 1)
+    self.assertEqual(index.enforce(1), [('1.0.0', 0)])
+    self.assertEqual(index.enforce(1), [])
+
+  def test_shrink(self):
+    index = self.make_index()
+    usage = index.memory_usage()
+    self.assertEqual(index.shrink(usage), [])
+    self.assertEqual(index.shrink(usage - 1), [('1.0.0', 0)])
+    self.assertLess(index.memory_usage(), usage)
+    self.assertEqual(len(index.shrink(0)), 2)
+    self.assertEqual(index.memory_usage(), 0)
+    self.assertEqual(index.evictions, 3)
+
+  def test_counts_missed_restorations(self):
+    index = restoration_index.RestorationIndex(
+        policy=restoration_index.RetentionPolicy(max_count=1))
+    index.add(FIRST, ('1.0.0', 0), 0)
+    index.add(THIRD, ('3.0.0', 2), 1)
+    index.enforce(1)
+    self.assertFalse(index.note_addition(THIRD))
+    self.assertTrue(index.note_addition(FIRST))
+    self.assertFalse(index.note_addition(FIRST))
+    self.assertEqual(index.missed_restorations, 1)
+
+  def test_from_records_restores_recency(self):
+    records = [(FIRST, '1.0.0', 0, 30), (SECOND, '2.0.0', 1, 10),
+               (THIRD, '3.0.0', 2)]
+    index = restoration_index.RestorationIndex.from_records(
+        records,
+        policy=restoration_index.RetentionPolicy(max_count=1),
+        default_timestamp=20)
+    self.assertEqual(index.enforce(30), [('2.0.0', 1), ('3.0.0', 2)])
+    self.assertEqual(index.records(), [(FIRST, '1.0.0', 0, 30)])
+
+  def test_records_keep_recency(self):
+    index = restoration_index.RestorationIndex()
+    index.add(THIRD, ('3.0.0', 2), 10)
+    index.add(FIRST, ('1.0.0', 0), 10)
+    index.add(SECOND, ('2.0.0', 1), 5)
+    index.touch(THIRD, 10)
+    records = index.records()
+    self.assertEqual([record[1] for record in records],
+                     ['1.0.0', '2.0.0', '3.0.0'])
+    loaded = restoration_index.RestorationIndex.from_records(
+        records, policy=restoration_index.RetentionPolicy(max_count=1))
+    # Equal timestamps are evicted in the order they were last seen.
+    self.assertEqual(loaded.enforce(10), [('2.0.0', 1), ('1.0.0', 0)])
+
+  def test_parse_timestamp(self):
+    self.assertEqual(
+        restoration_index.parse_timestamp('1970-01-02T00:00:01Z'), 86401)
+
+  def test_rejects_empty_comment(self):
+    with self.assertRaises(ValueError):
+      restoration_index.RestorationIndex().add('', ('1.0.0', 0))
+
+
+if __name__ == '__main__':
+  unittest.main()
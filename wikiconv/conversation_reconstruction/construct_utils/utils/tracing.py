@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Structured tracing of the reconstruction of selected revisions.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+A Tracer selects revisions by page id and by a range of revision ids. For a
+selected revision it hands out a Trace, and for every other revision None, so
+instrumented code guards each event with `if trace:` and pays nothing else
+when tracing is off: no payload is formatted and no statistic is gathered.
+
+Events are dictionaries naming the event, the page and the revision. Field
+values that are callables are only called when the event is emitted, so costly
+payloads can also be deferred to the sink. By default events are logged as
+JSON at INFO level, which allows tracing a single page without turning on
+debug logging for the whole worker.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import logging
+import resource
+
+import six
+
+
+def max_rss_kb():
+  """Returns the maximum resident set size of this process, in KB."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def log_sink(record):
+  """Logs a trace event as a single line of JSON."""
+  logging.info('TRACE %s', json.dumps(record, sort_keys=True, default=repr))
+
+
+def parse_rev_id_range(value):
+  """Parses a 'MIN:MAX' revision id range; either bound may be omitted.
+
+  Args:
+    value: the range, or a single revision id.
+
+  Returns:
+    A tuple of the minimum and maximum revision ids, None when unbounded.
+  """
+  if ':' not in value:
+    return int(value), int(value)
+  low, high = value.split(':', 1)
+  return (int(low) if low else None, int(high) if high else None)
+
+
+class Trace(object):
+  """Emits the events of a single traced revision."""
+
+  def __init__(self, sink, page_id, rev_id):
+    self._sink = sink
+    self.page_id = page_id
+    self.rev_id = rev_id
+
+  def event(self, name, **fields):
+    """Emits an event, calling the fields that are callables.
+
+    Args:
+      name: name of the event.
+      **fields: the payload of the event.
+    """
+    record = {
+        key: value() if callable(value) else value
+        for key, value in six.iteritems(fields)
+    }
+    record['event'] = name
+    record['page_id'] = self.page_id
+    record['rev_id'] = self.rev_id
+    self._sink(record)
+
+
+class Tracer(object):
+  """Selects the revisions to trace.
+
+  Attributes:
+    page_ids: set of page ids to trace, or None for all pages.
+    min_rev_id: the lowest revision id to trace, or None.
+    max_rev_id: the highest revision id to trace, or None.
+  """
+
+  def __init__(self,
+               page_ids=None,
+               min_rev_id=None,
+               max_rev_id=None,
+               sink=log_sink):
+    """Constructor.
+
+    Args:
+      page_ids: iterable of the page ids to trace, or None for all pages.
+      min_rev_id: the lowest revision id to trace, or None.
+      max_rev_id: the highest revision id to trace, or None.
+      sink: function called with each event. It must be picklable for the
+        tracer to be shipped to pipeline workers.
+    """
+    self.page_ids = (
+        None if page_ids is None else set(six.text_type(p) for p in page_ids))
+    self.min_rev_id = min_rev_id
+    self.max_rev_id = max_rev_id
+    self.sink = sink
+
+  def is_traced(self, page_id, rev_id):
+    if self.page_ids is not None and six.text_type(
+        page_id) not in self.page_ids:
+      return False
+    rev_id = int(rev_id)
+    if self.min_rev_id is not None and rev_id < self.min_rev_id:
+      return False
+    if self.max_rev_id is not None and rev_id > self.max_rev_id:
+      return False
+    return True
+
+  def trace(self, page_id, rev_id):
+    """Returns a Trace for the revision if it is selected, or None."""
+    if not self.is_traced(page_id, rev_id):
+      return None
+    return Trace(self.sink, page_id, rev_id)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Tests for tracing."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from wikiconv.conversation_reconstruction.construct_utils.utils import tracing
+
+
+class TracingTest(unittest.TestCase):
+
+  def test_selection(self):
+    tracer = tracing.Tracer(page_ids=[12, '34'], min_rev_id=100)
+    self.assertTrue(tracer.is_traced('12', 100))
+    self.assertTrue(tracer.is_traced(34, '500'))
+    self.assertFalse(tracer.is_traced('12', 99))
+    self.assertFalse(tracer.is_traced('56', 500))
+    self.assertIsNone(tracer.trace('56', 500))
+    tracer = tracing.Tracer(max_rev_id=5)
+    self.assertTrue(tracer.is_traced('56', 5))
+    self.assertFalse(tracer.is_traced('56', 6))
+
+  def test_parse_rev_id_range(self):
+    self.assertEqual(tracing.parse_rev_id_range('3:7'), (3, 7))
+    self.assertEqual(tracing.parse_rev_id_range(':7'), (None, 7))
+    self.assertEqual(tracing.parse_rev_id_range('3:'), (3, None))
+    self.assertEqual(tracing.parse_rev_id_range('3'), (3, 3))
+
+  def test_event(self):
+    events = []
+    calls = []
+
+    def payload():
+      calls.append(True)
+      return [1, 2]
+
+    trace = tracing.Tracer(sink=events.append).trace('12', 100)
+    self.assertEqual(calls, [])
+    trace.event('found', offsets=payload, length=3)
+    self.assertEqual(calls, [True])
+    self.assertEqual(events, [{
+        'event': 'found',
+        'page_id': '12',
+        'rev_id': 100,
+        'offsets': [1, 2],
+        'length': 3
+    }])
+
+  def test_log_sink(self):
+    trace = tracing.Tracer().trace('12', 100)
+    with self.assertLogs(level='INFO') as logs:
+      trace.event('found', offsets=(1, 2))
+    self.assertEqual(logs.output, [
+        'INFO:root:TRACE {"event": "found", "offsets": [1, 2], '
+        '"page_id": "12", "rev_id": 100}'
+    ])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -22,7 +22,8 @@ Run with default setting:
 
 The conversation constructor has the functionality of saving the intermediate
 page state in order to load and continue on it. This should provide a list of
-revisions that you want to test the loading functionality on.
+revisions that you want to test the loading functionality on. Revisions are
+replayed with a constructor keeping its memory within the given budget.
 
 """
 
@@ -31,15 +32,14 @@ from __future__ import division
 from __future__ import print_function
 
 import json
-import datetime
 import copy
+import itertools
 import logging
 import unittest
 import resource
 import argparse
-import copy
+from wikiconv.conversation_reconstruction.construct_utils import testing
 from wikiconv.conversation_reconstruction.construct_utils.conversation_constructor import ConversationConstructor
-from wikiconv.conversation_reconstruction.construct_utils.utils.third_party.rev_clean import clean_html
 
 default_page_ids = [14677358] #23031, 23715982, 26647, 10555, 21533114, 23715934, 476334, 14496]
 # Suggestion on test pages:
@@ -52,94 +52,59 @@ default_page_ids = [14677358] #23031, 23715982, 26647, 10555, 21533114, 23715934
 # PAGE 32094486: diff testing on REVISION 438455007.
 # DEFAULT TEST: dummy_test, test on reconstruction correctness.
 default_load_test = [493084502, 305838972]
-
-TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
-
-def merge(ps1, ps2):
-     # Merge two page states, ps1 is the later one
-     deleted_ids_ps2 = {d[1]:d for d in ps2['deleted_comments']}
-     deleted_ids_ps1 = {d[1]:d for d in ps1['deleted_comments']}
-     deleted_ids_ps2.update(deleted_ids_ps1)
-     extra_ids = [key for key in deleted_ids_ps2.keys() if not(key in deleted_ids_ps1)]
-     ret_p = copy.deepcopy(ps1)
-     ret_p['deleted_comments'] = list(deleted_ids_ps2.values())
-     conv_ids = ps2['conversation_id']
-     auth = ps2['authors']
-     ret_p['conversation_id'] = ret_p['conversation_id']
-     ret_p['authors'] = ret_p['authors']
-     for i in extra_ids:
-         ret_p['conversation_id'][i] = conv_ids[i]
-         ret_p['authors'][i] = auth[i]
-     ret_p['conversation_id'] = ret_p['conversation_id']
-     ret_p['authors'] = ret_p['authors']
-     return ret_p
+default_memory_budget_mb = 500
 
 
 class TestReconstruction(unittest.TestCase):
   def test_reconstruction(self):
-     for p in PAGES:
-        logging.info("TEST LOG: testing starts on page %s" % str(p))
-        processor = ConversationConstructor()
-        cnt = 0
-        page_state = None
-        second_last_page_state = None
-        latest_content = ""
-        ans = []
-        if not(p == "dummy_test"):
-           filename = "construct_utils/testdata/reversed_page_%d.json" % p
-        else:
-           filename = "construct_utils/testdata/%s.json" % p
-        with open(filename, "r") as f:
-          last_week = -1
-          for ind, line in enumerate(f):
-               revision = json.loads(line)
-               week = datetime.datetime.strptime(revision['timestamp'], TIMESTAMP_FORMAT).isocalendar()[1]
-               year = datetime.datetime.strptime(revision['timestamp'], TIMESTAMP_FORMAT).year
-               cnt += 1
-               if (((cnt % LOG_INTERVAL == 0 and cnt)
-                    or (last_week >= 0 and last_week != week))
-                   and not(page_state == None)):
-                 # Reload after every LOG_INTERVAL revisions to keep the low memory
-                 # usage.
-                  memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-                  logging.info("MENMORY BEFORE RELOADING : %d KB" % memory_usage)
-                  processor = ConversationConstructor()
-                  #second_last_page_state = copy.deepcopy(page_state)
-                  processor.load(page_state['deleted_comments'])  # pylint: disable=E1136
-                  del page_state['deleted_comments']  # pylint: disable=E1136,E1138
-                  page_state['deleted_comments'] = []  # pylint: disable=E1136,E1138,E1137
-                  memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-                  logging.info("MENMORY AFTER RELOADING : %d KB" % memory_usage)
-
-               if revision['rev_id'] in LOADING_TEST:
-                  if second_last_page_state:
-                     page_state_test = merge(page_state, second_last_page_state)
-                  else:
-                     page_state_test = copy.deepcopy(page_state)
-                  processor_test = ConversationConstructor()
-                  processor_test.load(page_state_test['deleted_comments'])
-                  _, actions_test, _ = \
-                     processor.process(page_state_test, latest_content, revision)
-               page_state, actions, latest_content = \
-                   processor.process(page_state, latest_content, revision)
-               memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-               self.assertLessEqual(memory_usage, memory_boundary)
-               if revision['rev_id'] in LOADING_TEST:
-                  self.assertEqual(json.dumps(actions), json.dumps(actions_test))
-               ids = []
-               for action in actions:
-                  ids.append(action['id'])
-                  ans.append("ID %s, TYPE %s, CONTENT: %s" % (action['id'], action['type'], action['content']))
-                  logging.debug("ID %s, TYPE %s, CONTENT: %s" % (action['id'], action['type'], action['content']))
-               assert(len(set(ids)) == len(actions))
-               if revision['rev_id'] == 479969745:
-                  self.assertEqual(len(actions), 2)
-               logging.info("USRLOG: revision %d processed, number %d on page %s." % (revision['rev_id'], ind, p))
-               last_week = week
-        if p == "dummy_test":
-           with open("construct_utils/testdata/%s_ans.json" % p, "r") as f:
-              standard_ans = json.load(f)
-           self.assertEqual(''.join(ans), standard_ans)
+    for p in PAGES:
+      logging.info("TEST LOG: testing starts on page %s" % str(p))
+      if not(p == "dummy_test"):
+        filename = "construct_utils/testdata/reversed_page_%d.json" % p
+      else:
+        filename = "construct_utils/testdata/%s.json" % p
+      with open(filename, "r") as f:
+        revisions = [json.loads(line) for line in f]
+      loading_actions = {}
+
+      def after_revision(ind, page_state, latest_content):
+        # The constructor keeps its memory within the budget, so the peak
+        # memory usage stays flat without reloading it.
+        memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertLessEqual(memory_usage, memory_boundary)
+        logging.info("USRLOG: revision %d processed, number %d on page %s." %
+                     (revisions[ind - 1]['rev_id'], ind - 1, p))
+        if ind < len(revisions) and revisions[ind]['rev_id'] in LOADING_TEST:
+          # A constructor loaded from the page state must go on the same way.
+          processor_test = ConversationConstructor(memory_budget=MEMORY_BUDGET)
+          processor_test.load(page_state['deleted_comments'],
+                              page_state.get('timestamp'))
+          _, actions_test, _ = processor_test.process(
+              copy.deepcopy(page_state), latest_content, dict(revisions[ind]))
+          loading_actions[revisions[ind]['rev_id']] = actions_test
+
+      _, all_actions = testing.replay(
+          revisions, ConversationConstructor(memory_budget=MEMORY_BUDGET),
+          after_revision)
+      ans = []
+      for rev_id, actions in itertools.groupby(
+          all_actions, key=lambda action: action['rev_id']):
+        actions = list(actions)
+        if rev_id in loading_actions:
+          self.assertEqual(json.dumps(actions),
+                           json.dumps(loading_actions[rev_id]))
+        ids = []
+        for action in actions:
+          ids.append(action['id'])
+          ans.append("ID %s, TYPE %s, CONTENT: %s" % (action['id'], action['type'], action['content']))
+          logging.debug("ID %s, TYPE %s, CONTENT: %s" % (action['id'], action['type'], action['content']))
+        assert(len(set(ids)) == len(actions))
+        if rev_id == 479969745:
+          self.assertEqual(len(actions), 2)
+      if p == "dummy_test":
+        with open("construct_utils/testdata/%s_ans.json" % p, "r") as f:
+          standard_ans = json.load(f)
+        self.assertEqual(''.join(ans), standard_ans)
 
 if __name__ == '__main__':
   logging.basicConfig(filename="test_debug.log", level=logging.DEBUG)
@@ -149,9 +114,11 @@ if __name__ == '__main__':
                       nargs='+', default=default_page_ids, type=int)
   parser.add_argument('-l', '--test_loading_on', dest='load_test',\
                       nargs='+', default=default_load_test, type=int)
+  parser.add_argument('-m', '--memory_budget_mb', dest='memory_budget_mb',\
+                      default=default_memory_budget_mb, type=float)
   PAGES = parser.parse_args().page_ids
   PAGES.append("dummy_test")
   LOADING_TEST = parser.parse_args().load_test
-  LOG_INTERVAL = 100
+  MEMORY_BUDGET = int(parser.parse_args().memory_budget_mb * 1024 * 1024)
   memory_boundary = 2000000 # in KB
   unittest.main()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""A content-addressed side table of the texts of actions.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+Actions carry the whole text of the comment they add, modify, delete or
+restore, so a long comment modified ten times is written out ten times, and the
+deletion of an archived section carries the whole section. When the side table
+is on, the content and cleaned content of an action longer than a minimum size
+are replaced by their SHA-1, in the content_hash and cleaned_content_hash
+fields, and the texts are written once per distinct hash, as JSON lines of
+{"hash": ..., "text": ...}, to a fixed number of shards split by hash. Next to
+every shard, an index gives the offset and length of the record of each hash.
+
+Readers resolve hashes with a ContentTable, which reads the index of a shard
+the first time one of its hashes is looked up, and then reads single records
+with a seek, keeping each shard it has read from open until it is closed.
+Only the indexes are kept in memory, so the order of the lookups does not
+matter.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import re
+
+import apache_beam as beam
+from apache_beam.io import filesystems
+from apache_beam.io.filesystem import CompressionTypes
+from apache_beam.metrics.metric import Metrics
+
+HASHED_FIELDS = ('content', 'cleaned_content')
+HASH_SUFFIX = '_hash'
+# Shorter texts stay in the actions: their hash would barely be shorter.
+DEFAULT_MIN_BYTES = 256
+DEFAULT_NUM_SHARDS = 64
+_SHARD_NAME = re.compile(r'contents-(\d+)-of-(\d+)$')
+
+
+def content_hash(text):
+  return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def shard_of(digest, num_shards):
+  return int(digest[:8], 16) % num_shards
+
+
+def shard_path(contents_dir, shard, num_shards):
+  return filesystems.FileSystems.join(
+      contents_dir, 'contents-%05d-of-%05d' % (shard, num_shards))
+
+
+def index_path(contents_dir, shard, num_shards):
+  return filesystems.FileSystems.join(
+      contents_dir, 'index-%05d-of-%05d' % (shard, num_shards))
+
+
+def externalize(action, min_bytes=DEFAULT_MIN_BYTES):
+  """Replaces the long texts of an action by their hashes.
+
+  Args:
+    action: an action, as output by ConversationConstructor.
+    min_bytes: the size of the shortest text replaced, in UTF-8 bytes.
+
+  Returns:
+    A pair of the action, updated in place, and of the list of the (hash,
+    text) pairs of the texts replaced.
+  """
+  contents = []
+  for field in HASHED_FIELDS:
+    text = action.get(field)
+    if text is None or len(text.encode('utf-8', 'surrogatepass')) < min_bytes:
+      continue
+    digest = content_hash(text)
+    del action[field]
+    action[field + HASH_SUFFIX] = digest
+    contents.append((digest, text))
+  return action, contents
+
+
+def resolve(action, lookup):
+  """Replaces the hashes of an action by their texts, in place.
+
+  Args:
+    action: an action, with or without hashed texts.
+    lookup: a function returning the text of a hash, e.g. ContentTable.get.
+
+  Returns:
+    The action.
+  """
+  for field in HASHED_FIELDS:
+    digest = action.pop(field + HASH_SUFFIX, None)
+    if digest is not None:
+      action[field] = lookup(digest)
+  return action
+
+
+class ContentTable(object):
+  """Reads the texts of a content side table, by hash.
+
+  Attributes:
+    contents_dir: the location of the side table.
+    indexes_read: the number of shard indexes read so far.
+    shards_read: the number of times a shard was opened so far.
+  """
+
+  def __init__(self, contents_dir):
+    self.contents_dir = contents_dir
+    self.indexes_read = 0
+    self.shards_read = 0
+    self._num_shards = None
+    self._indexes = {}
+    self._files = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+  def num_shards(self):
+    """Returns the number of shards of the table, from their file names."""
+    if self._num_shards is None:
+      pattern = filesystems.FileSystems.join(self.contents_dir, 'contents-*')
+      for metadata in filesystems.FileSystems.match([pattern])[0].metadata_list:
+        match = _SHARD_NAME.search(metadata.path)
+        if match:
+          self._num_shards = int(match.group(2))
+          break
+      else:
+        raise IOError('No content shards in %s.' % self.contents_dir)
+    return self._num_shards
+
+  def _index(self, shard):
+    if shard not in self._indexes:
+      path = index_path(self.contents_dir, shard, self.num_shards())
+      index = {}
+      if filesystems.FileSystems.exists(path):
+        with filesystems.FileSystems.open(path) as f:
+          for line in f.read().decode('utf-8').splitlines():
+            if line:
+              digest, offset, length = line.split(' ')
+              index[digest] = (int(offset), int(length))
+      self._indexes[shard] = index
+      self.indexes_read += 1
+    return self._indexes[shard]
+
+  def _read(self, shard, offset, length):
+    f = self._files.get(shard)
+    if f is None:
+      f = filesystems.FileSystems.open(
+          shard_path(self.contents_dir, shard, self.num_shards()),
+          compression_type=CompressionTypes.UNCOMPRESSED)
+      self._files[shard] = f
+      self.shards_read += 1
+    f.seek(offset)
+    return json.loads(f.read(length).decode('utf-8'))['text']
+
+  def get(self, digest):
+    """Returns the text of a hash, raising KeyError if it is not in the table."""
+    shard = shard_of(digest, self.num_shards())
+    offset, length = self._index(shard)[digest]
+    return self._read(shard, offset, length)
+
+  def get_many(self, digests):
+    """Returns the texts of hashes, by hash.
+
+    The records are read shard by shard, in the order they are stored.
+
+    Args:
+      digests: iterable of hashes, raising KeyError if one is not in the table.
+    """
+    by_shard = {}
+    for digest in set(digests):
+      shard = shard_of(digest, self.num_shards())
+      offset, length = self._index(shard)[digest]
+      by_shard.setdefault(shard, []).append((offset, length, digest))
+    ret = {}
+    for shard in sorted(by_shard):
+      for offset, length, digest in sorted(by_shard[shard]):
+        ret[digest] = self._read(shard, offset, length)
+    return ret
+
+  def resolve_all(self, actions):
+    """Replaces the hashes of actions by their texts, in place.
+
+    Args:
+      actions: list of actions, with or without hashed texts.
+
+    Returns:
+      The actions.
+    """
+    texts = self.get_many(
+        action[field + HASH_SUFFIX]
+        for action in actions
+        for field in HASHED_FIELDS
+        if action.get(field + HASH_SUFFIX) is not None)
+    for action in actions:
+      resolve(action, texts.__getitem__)
+    return actions
+
+  def close(self):
+    """Closes the shards opened so far; their indexes are kept."""
+    files, self._files = self._files, {}
+    for f in files.values():
+      f.close()
+
+
+class SplitContents(beam.DoFn):
+  """Beam DoFn replacing the long texts of actions by their hashes.
+
+  The actions are output as JSON, and the (hash, text) pairs of the texts
+  replaced as 'contents'.
+  """
+
+  def __init__(self, min_bytes=DEFAULT_MIN_BYTES):
+    self._min_bytes = min_bytes
+    self.externalized_contents = Metrics.counter(self.__class__,
+                                                 'externalized_contents')
+
+  def process(self, element):
+    action, contents = externalize(json.loads(element), self._min_bytes)
+    for content in contents:
+      self.externalized_contents.inc()
+      yield beam.pvalue.TaggedOutput('contents', content)
+    yield json.dumps(action)
+
+
+def _any_text(texts):
+  for text in texts:
+    return text
+  return None
+
+
+class WriteContentShard(beam.DoFn):
+  """Beam DoFn writing a shard of the content side table to a file."""
+
+  def __init__(self):
+    self.distinct_contents = Metrics.counter(self.__class__,
+                                             'distinct_contents')
+    self.content_shards_written = Metrics.counter(self.__class__,
+                                                  'content_shards_written')
+
+  def process(self, element, contents_dir, num_shards):
+    (shard, contents) = element
+    index = []
+    offset = 0
+    # The texts are written as they come, only their index is sorted.
+    with filesystems.FileSystems.create(
+        shard_path(contents_dir, shard, num_shards),
+        compression_type=CompressionTypes.UNCOMPRESSED) as f:
+      for digest, text in contents:
+        record = json.dumps({
+            'hash': digest,
+            'text': text
+        }, sort_keys=True).encode('utf-8') + b'\n'
+        f.write(record)
+        index.append((digest, offset, len(record)))
+        offset += len(record)
+        self.distinct_contents.inc()
+    with filesystems.FileSystems.create(
+        index_path(contents_dir, shard, num_shards)) as f:
+      for entry in sorted(index):
+        f.write(('%s %d %d\n' % entry).encode('utf-8'))
+    self.content_shards_written.inc()
+
+
+class WriteContents(beam.PTransform):
+  """Writes (hash, text) pairs to a side table, once per distinct hash."""
+
+  def __init__(self, contents_dir, num_shards=DEFAULT_NUM_SHARDS):
+    super(WriteContents, self).__init__()
+    self._contents_dir = contents_dir
+    self._num_shards = num_shards
+
+  def expand(self, contents):
+    num_shards = self._num_shards
+    return (contents
+            | 'dedupe_contents' >> beam.CombinePerKey(_any_text)
+            | 'key_contents_by_shard' >> beam.Map(
+                lambda content: (shard_of(content[0], num_shards), content))
+            | 'group_contents_by_shard' >> beam.GroupByKey()
+            | 'write_content_shards' >> beam.ParDo(
+                WriteContentShard(), self._contents_dir, num_shards))
@@ -0,0 +1,138 @@
+"""Tests for content_store."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import apache_beam as beam
+from apache_beam.testing import test_pipeline
+from apache_beam.testing import util
+from wikiconv.conversation_reconstruction import content_store
+
+
+class ContentStoreTest(unittest.TestCase):
+
+  def test_externalize(self):
+    long_text = u"é" * 200
+    action = {
+        "id": "1.2.3",
+        "content": long_text,
+        "cleaned_content": long_text,
+        "type": "ADDITION"
+    }
+    action, contents = content_store.externalize(dict(action), min_bytes=300)
+    digest = content_store.content_hash(long_text)
+    self.assertEqual(action, {
+        "id": "1.2.3",
+        "content_hash": digest,
+        "cleaned_content_hash": digest,
+        "type": "ADDITION"
+    })
+    self.assertEqual(contents, [(digest, long_text), (digest, long_text)])
+    self.assertEqual(
+        content_store.resolve(action, {digest: long_text}.__getitem__), {
+            "id": "1.2.3",
+            "content": long_text,
+            "cleaned_content": long_text,
+            "type": "ADDITION"
+        })
+
+  def test_short_contents_stay(self):
+    action = {"content": "short", "cleaned_content": None}
+    self.assertEqual(
+        content_store.externalize(dict(action)), (action, []))
+    self.assertEqual(
+        content_store.resolve(dict(action), lambda digest: 1 / 0), action)
+
+  def test_write_and_read(self):
+    tempdir = tempfile.mkdtemp()
+    texts = ["text %d " % i * 20 for i in range(50)]
+    pipeline = test_pipeline.TestPipeline()
+    actions = [json.dumps({"id": str(i), "content": texts[i % 10]})
+               for i in range(40)]
+    results = (
+        pipeline
+        | beam.Create(actions)
+        | beam.ParDo(content_store.SplitContents(min_bytes=10)).with_outputs(
+            "contents", main="actions"))
+    # pylint:disable=expression-not-assigned
+    results["contents"] | content_store.WriteContents(tempdir, num_shards=4)
+    util.assert_that(
+        results["actions"] | beam.Map(
+            lambda line: sorted(json.loads(line).keys())),
+        util.equal_to([["content_hash", "id"]] * 40))
+    pipeline.run()
+
+    lines = []
+    for filename in os.listdir(tempdir):
+      if filename.startswith("contents-"):
+        with open(os.path.join(tempdir, filename)) as f:
+          lines.extend(f.readlines())
+    # Each distinct content is written once.
+    self.assertEqual(len(lines), 10)
+    table = content_store.ContentTable(tempdir)
+    self.assertEqual(table.num_shards(), 4)
+    for text in texts[:10]:
+      self.assertEqual(table.get(content_store.content_hash(text)), text)
+    with self.assertRaises(KeyError):
+      table.get(content_store.content_hash(texts[10]))
+    table.close()
+    # Shards are only read when a hash they hold is looked up.
+    with content_store.ContentTable(tempdir) as table:
+      digest = content_store.content_hash(texts[0])
+      table.get(digest)
+      table.get(digest)
+      self.assertEqual(table.indexes_read, 1)
+      self.assertEqual(table.shards_read, 1)
+    shutil.rmtree(tempdir)
+
+  def test_shuffled_lookups(self):
+    tempdir = tempfile.mkdtemp()
+    texts = ["text %d " % i * 20 for i in range(500)]
+    pipeline = test_pipeline.TestPipeline()
+    # pylint:disable=expression-not-assigned
+    (pipeline
+     | beam.Create([(content_store.content_hash(text), text) for text in texts])
+     | content_store.WriteContents(tempdir, num_shards=8))
+    pipeline.run()
+
+    digests = [content_store.content_hash(text) for text in texts] * 4
+    random.Random(0).shuffle(digests)
+    with content_store.ContentTable(tempdir) as table:
+      for digest in digests:
+        self.assertEqual(
+            content_store.content_hash(table.get(digest)), digest)
+      # Each shard is opened once, whatever the order of the lookups.
+      self.assertEqual(table.shards_read, 8)
+      self.assertEqual(table.indexes_read, 8)
+    with content_store.ContentTable(tempdir) as table:
+      self.assertEqual(table.get_many(digests), {
+          content_store.content_hash(text): text for text in texts
+      })
+      self.assertEqual(table.shards_read, 8)
+      actions = [{"id": "1", "content_hash": digests[0]}, {"id": "2"}]
+      self.assertEqual(
+          table.resolve_all(actions), [{
+              "id": "1",
+              "content": table.get(digests[0])
+          }, {
+              "id": "2"
+          }])
+    shutil.rmtree(tempdir)
+
+  def test_no_shards(self):
+    tempdir = tempfile.mkdtemp()
+    with self.assertRaises(IOError):
+      content_store.ContentTable(tempdir).get("0" * 40)
+    shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""Conversations clustered into compressed shards, with a lookup index.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+The reconstruction writes actions in no particular order, so a consumer
+needing whole conversations has to group the full output first. Clustered
+output splits conversations into a fixed number of shards by a hash of their
+id. In a shard, conversations are sorted by page id and conversation id, and
+the actions of a conversation by time, revision and action id. Each
+conversation is a gzip member of its own, its actions as JSON lines, so that a
+shard is a valid gzip file and any conversation can be decompressed alone.
+Actions are grouped and compressed conversation by conversation, and a shard is
+only written out of the compressed members of its conversations.
+
+Next to every shard, an index maps the id of each of its conversations to its
+page id, the offset and length of its member and its number of actions. A
+ConversationReader reads the index of a shard the first time it is needed, and
+then fetches a conversation with a single seek.
+
+With a snapshot interval, the state of each conversation on display, see
+conversation_state, is also materialized every that many actions, to a
+snapshots file next to the shard. The index entry of a conversation lists its
+snapshots with the timestamp of the last action they include, so that
+ConversationReader.snapshot answers what a conversation looked like at a given
+time by replaying at most that many actions on top of a snapshot.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import bisect
+import gzip
+import io
+import json
+import re
+
+import apache_beam as beam
+from apache_beam.io import filesystems
+from apache_beam.io.filesystem import CompressionTypes
+from apache_beam.metrics.metric import Metrics
+from wikiconv.conversation_reconstruction import conversation_state
+from wikiconv.conversation_reconstruction import state_store
+
+DEFAULT_NUM_SHARDS = 64
+DEFAULT_SNAPSHOT_INTERVAL = 64
+_INDEX_NAME = re.compile(r'index-(\d+)-of-(\d+)$')
+
+
+def shard_of(conversation_id, num_shards):
+  return state_store.shard_of(conversation_id, num_shards)
+
+
+def data_path(clustered_dir, shard, num_shards):
+  return filesystems.FileSystems.join(
+      clustered_dir, 'conversations-%05d-of-%05d.gz' % (shard, num_shards))
+
+
+def index_path(clustered_dir, shard, num_shards):
+  return filesystems.FileSystems.join(
+      clustered_dir, 'index-%05d-of-%05d' % (shard, num_shards))
+
+
+def snapshots_path(clustered_dir, shard, num_shards):
+  return filesystems.FileSystems.join(
+      clustered_dir, 'snapshots-%05d-of-%05d.gz' % (shard, num_shards))
+
+
+def action_order(action):
+  return (action['timestamp'], int(action['rev_id']), action['id'])
+
+
+def compress(records):
+  """Returns a gzip member of records, e.g. the actions of a conversation."""
+  buf = io.BytesIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+    for record in records:
+      f.write(json.dumps(record, sort_keys=True).encode('utf-8') + b'\n')
+  return buf.getvalue()
+
+
+def decompress(data):
+  """Returns the records of a gzip member."""
+  with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+    return [
+        json.loads(line) for line in f.read().decode('utf-8').splitlines()
+    ]
+
+
+def snapshot_members(actions, snapshot_interval):
+  """Materializes the states of a conversation every so many actions.
+
+  Args:
+    actions: the actions of the conversation, in order.
+    snapshot_interval: the number of actions between snapshots.
+
+  Returns:
+    The list of the [timestamp, actions, member] of the snapshots, where member
+    is the gzip member of the state after that many actions. The state after
+    the last action is not materialized.
+  """
+  ret = []
+  state = conversation_state.ConversationState()
+  for action in actions[:-1]:
+    state.apply(action)
+    if state.actions % snapshot_interval == 0:
+      ret.append([state.timestamp, state.actions, compress([state.to_dict()])])
+  return ret
+
+
+class ClusterConversation(beam.DoFn):
+  """Beam DoFn compressing the actions of a conversation, keyed by shard.
+
+  The actions are sorted and compressed into a gzip member, along with the
+  snapshots of the conversation, so that writing a shard only has to lay out
+  the members of its conversations.
+  """
+
+  def __init__(self):
+    self.conversation_snapshots = Metrics.counter(self.__class__,
+                                                  'conversation_snapshots')
+
+  def process(self, element, num_shards, snapshot_interval=0):
+    ((page_id, conversation_id), lines) = element
+    actions = sorted((json.loads(line) for line in lines), key=action_order)
+    snapshots = None
+    if snapshot_interval:
+      snapshots = snapshot_members(actions, snapshot_interval)
+      self.conversation_snapshots.inc(len(snapshots))
+    yield (shard_of(conversation_id, num_shards),
+           (page_id, conversation_id, compress(actions), len(actions),
+            snapshots))
+
+
+def _conversation_key(conversation):
+  return conversation[:2]
+
+
+class WriteClusteredShard(beam.DoFn):
+  """Beam DoFn writing a shard of compressed conversations and its index."""
+
+  def __init__(self):
+    self.clustered_conversations = Metrics.counter(self.__class__,
+                                                   'clustered_conversations')
+    self.clustered_shard_bytes = Metrics.distribution(self.__class__,
+                                                      'clustered_shard_bytes')
+
+  def process(self, element, clustered_dir, num_shards, snapshot_interval=0):
+    (shard, conversations) = element
+    offset = 0
+    snapshots_offset = 0
+    snapshots_file = None
+    if snapshot_interval:
+      snapshots_file = filesystems.FileSystems.create(
+          snapshots_path(clustered_dir, shard, num_shards),
+          compression_type=CompressionTypes.UNCOMPRESSED)
+    with filesystems.FileSystems.create(
+        data_path(clustered_dir, shard, num_shards),
+        compression_type=CompressionTypes.UNCOMPRESSED) as data, \
+        filesystems.FileSystems.create(
+            index_path(clustered_dir, shard, num_shards)) as index:
+      for page_id, conversation_id, member, actions, snapshots in sorted(
+          conversations, key=_conversation_key):
+        data.write(member)
+        entry = {
+            'conversation_id': conversation_id,
+            'page_id': page_id,
+            'offset': offset,
+            'length': len(member),
+            'actions': actions
+        }
+        if snapshots_file is not None:
+          entry['snapshots'] = []
+          for timestamp, snapshot_actions, snapshot in snapshots:
+            snapshots_file.write(snapshot)
+            entry['snapshots'].append(
+                [timestamp, snapshot_actions, snapshots_offset, len(snapshot)])
+            snapshots_offset += len(snapshot)
+        index.write(json.dumps(entry, sort_keys=True).encode('utf-8') + b'\n')
+        offset += len(member)
+        self.clustered_conversations.inc()
+    if snapshots_file is not None:
+      snapshots_file.close()
+    self.clustered_shard_bytes.update(offset)
+
+
+def _key_by_conversation(line):
+  action = json.loads(line)
+  return (action['page_id'], action['conversation_id']), line
+
+
+class WriteClustered(beam.PTransform):
+  """Writes actions, as JSON lines, clustered by conversation.
+
+  The actions are grouped by conversation first, and each conversation is
+  compressed on its own, so that the shards only gather compressed members.
+  """
+
+  def __init__(self,
+               clustered_dir,
+               num_shards=DEFAULT_NUM_SHARDS,
+               snapshot_interval=0):
+    super(WriteClustered, self).__init__()
+    self._clustered_dir = clustered_dir
+    self._num_shards = num_shards
+    self._snapshot_interval = snapshot_interval
+
+  def expand(self, actions):
+    return (actions
+            | 'key_actions_by_conversation' >> beam.Map(_key_by_conversation)
+            | 'group_actions_by_conversation' >> beam.GroupByKey()
+            | 'cluster_conversations' >> beam.ParDo(
+                ClusterConversation(), self._num_shards,
+                self._snapshot_interval)
+            | 'group_conversations_by_shard' >> beam.GroupByKey()
+            | 'write_clustered_shards' >> beam.ParDo(
+                WriteClusteredShard(), self._clustered_dir, self._num_shards,
+                self._snapshot_interval))
+
+
+class ConversationReader(object):
+  """Fetches conversations from clustered output.
+
+  Attributes:
+    clustered_dir: the location of the clustered output.
+    indexes_read: the number of shard indexes read so far.
+    replayed_actions: the number of actions replayed by snapshot queries so
+      far.
+  """
+
+  def __init__(self, clustered_dir, contents=None):
+    """Constructor.
+
+    Args:
+      clustered_dir: the location of the clustered output.
+      contents: an optional content_store.ContentTable resolving the hashed
+        contents of the actions read.
+    """
+    self.clustered_dir = clustered_dir
+    self.indexes_read = 0
+    self.replayed_actions = 0
+    self._contents = contents
+    self._num_shards = None
+    self._indexes = {}
+
+  def num_shards(self):
+    """Returns the number of shards of the output, from their file names."""
+    if self._num_shards is None:
+      pattern = filesystems.FileSystems.join(self.clustered_dir, 'index-*')
+      for metadata in filesystems.FileSystems.match([pattern])[0].metadata_list:
+        match = _INDEX_NAME.search(metadata.path)
+        if match:
+          self._num_shards = int(match.group(2))
+          break
+      else:
+        raise IOError('No conversation index in %s.' % self.clustered_dir)
+    return self._num_shards
+
+  def _index(self, shard):
+    if shard not in self._indexes:
+      path = index_path(self.clustered_dir, shard, self.num_shards())
+      index = {}
+      if filesystems.FileSystems.exists(path):
+        with filesystems.FileSystems.open(path) as f:
+          for line in f.read().decode('utf-8').splitlines():
+            if line:
+              entry = json.loads(line)
+              index[entry['conversation_id']] = entry
+      self._indexes[shard] = index
+      self.indexes_read += 1
+    return self._indexes[shard]
+
+  def entry(self, conversation_id):
+    """Returns the index entry of a conversation, or None if there is none."""
+    return self._index(shard_of(conversation_id, self.num_shards())).get(
+        conversation_id)
+
+  def _resolve(self, records):
+    if self._contents is not None:
+      self._contents.resolve_all(records)
+    return records
+
+  def _read(self, f, entry, resolve=True):
+    f.seek(entry['offset'])
+    actions = decompress(f.read(entry['length']))
+    return self._resolve(actions) if resolve else actions
+
+  def _open(self, shard, path=data_path):
+    return filesystems.FileSystems.open(
+        path(self.clustered_dir, shard, self.num_shards()),
+        compression_type=CompressionTypes.UNCOMPRESSED)
+
+  def _entries_by_shard(self, conversation_ids):
+    """Returns the index entries of conversations by shard, in file order."""
+    by_shard = {}
+    for conversation_id in set(conversation_ids):
+      by_shard.setdefault(shard_of(conversation_id, self.num_shards()),
+                          []).append(conversation_id)
+    ret = {}
+    for shard, shard_ids in by_shard.items():
+      index = self._index(shard)
+      entries = [
+          index[conversation_id]
+          for conversation_id in shard_ids
+          if conversation_id in index
+      ]
+      if entries:
+        ret[shard] = sorted(entries, key=lambda entry: entry['offset'])
+    return ret
+
+  def read(self, conversation_id):
+    """Returns the actions of a conversation in order, raising KeyError."""
+    entry = self.entry(conversation_id)
+    if entry is None:
+      raise KeyError(conversation_id)
+    with self._open(shard_of(conversation_id, self.num_shards())) as f:
+      return self._read(f, entry)
+
+  def read_many(self, conversation_ids):
+    """Yields the (id, actions) of conversations, shard by shard.
+
+    Each shard is opened once, and its conversations are read in the order
+    they are stored. Conversations not in the output are skipped.
+
+    Args:
+      conversation_ids: iterable of conversation ids.
+    """
+    by_shard = self._entries_by_shard(conversation_ids)
+    for shard in sorted(by_shard):
+      with self._open(shard) as f:
+        for entry in by_shard[shard]:
+          yield entry['conversation_id'], self._read(f, entry)
+
+  def _state_at(self, entry, actions, timestamp, open_snapshots):
+    """Returns the state of a conversation after its actions up to timestamp.
+
+    Args:
+      entry: the index entry of the conversation.
+      actions: its actions in order, with their contents unresolved.
+      timestamp: the time of the state.
+      open_snapshots: a function returning the snapshots file of the shard.
+    """
+    snapshots = entry.get('snapshots') or []
+    i = bisect.bisect_right([snapshot[0] for snapshot in snapshots], timestamp)
+    if i:
+      _, _, offset, length = snapshots[i - 1]
+      f = open_snapshots()
+      f.seek(offset)
+      state = conversation_state.ConversationState.from_dict(
+          decompress(f.read(length))[0])
+    else:
+      state = conversation_state.ConversationState()
+    for action in actions[state.actions:]:
+      if action['timestamp'] > timestamp:
+        break
+      state.apply(action)
+      self.replayed_actions += 1
+    return state
+
+  def _tree(self, state):
+    tree = state.tree()
+    nodes = list(tree)
+    for node in nodes:
+      nodes.extend(node['replies'])
+    self._resolve(nodes)
+    return tree
+
+  def snapshot(self, conversation_id, timestamp):
+    """Returns a conversation as it was displayed at a time.
+
+    Args:
+      conversation_id: the id of the conversation, raising KeyError if it is
+        not in the output.
+      timestamp: the time, in the format of the timestamps of actions, e.g.
+        '2019-01-31T12:00:00Z'.
+
+    Returns:
+      The comment tree of the conversation after its actions up to timestamp,
+      see ConversationState.tree.
+    """
+    return dict(self.snapshots([(conversation_id,
+                                 timestamp)]))[(conversation_id, timestamp)]
+
+  def snapshots(self, queries):
+    """Yields conversations as they were displayed at times, shard by shard.
+
+    Each shard, and its snapshots file, is opened once, and each conversation
+    read once for all the times it is queried at.
+
+    Args:
+      queries: iterable of (conversation id, timestamp) pairs.
+
+    Yields:
+      ((conversation id, timestamp), comment tree) pairs. Conversations not in
+      the output raise KeyError.
+    """
+    timestamps = {}
+    for conversation_id, timestamp in queries:
+      timestamps.setdefault(conversation_id, set()).add(timestamp)
+    by_shard = self._entries_by_shard(timestamps)
+    found = set(entry['conversation_id']
+                for entries in by_shard.values()
+                for entry in entries)
+    for conversation_id in timestamps:
+      if conversation_id not in found:
+        raise KeyError(conversation_id)
+    for shard in sorted(by_shard):
+      snapshots = []
+
+      def open_snapshots(shard=shard, snapshots=snapshots):
+        if not snapshots:
+          snapshots.append(self._open(shard, snapshots_path))
+        return snapshots[0]
+
+      try:
+        with self._open(shard) as f:
+          for entry in by_shard[shard]:
+            conversation_id = entry['conversation_id']
+            actions = self._read(f, entry, resolve=False)
+            for timestamp in sorted(timestamps[conversation_id]):
+              state = self._state_at(entry, actions, timestamp, open_snapshots)
+              yield (conversation_id, timestamp), self._tree(state)
+      finally:
+        for snapshots_file in snapshots:
+          snapshots_file.close()
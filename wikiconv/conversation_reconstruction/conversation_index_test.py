@@ -0,0 +1,154 @@
+"""Tests for conversation_index."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import apache_beam as beam
+from apache_beam.testing import test_pipeline
+from wikiconv.conversation_reconstruction import conversation_index
+from wikiconv.conversation_reconstruction import conversation_state
+
+
+def action(conversation_id, rev_id, action_id, page_id="1"):
+  return {
+      "conversation_id": conversation_id,
+      "page_id": page_id,
+      "rev_id": rev_id,
+      "id": action_id,
+      "timestamp": "2019-01-01T00:00:%02dZ" % (rev_id % 60),
+      "content": "comment %s" % action_id
+  }
+
+
+class ConversationIndexTest(unittest.TestCase):
+
+  def test_compress(self):
+    actions = [action("1.0.0", 1, "1.0.0"), action("1.0.0", 2, "2.5.0")]
+    self.assertEqual(
+        conversation_index.decompress(conversation_index.compress(actions)),
+        actions)
+
+  def test_cluster_conversation(self):
+    actions = [action("1.0.0", rev_id, "%d.0.0" % rev_id)
+               for rev_id in (3, 1, 2)]
+    for a in actions:
+      a.update(type="ADDITION", replyTo_id=None)
+    [(shard, (page_id, conversation_id, member, count, snapshots))] = list(
+        conversation_index.ClusterConversation().process(
+            (("1", "1.0.0"), [json.dumps(a) for a in actions]), 4, 2))
+    self.assertEqual(shard, conversation_index.shard_of("1.0.0", 4))
+    self.assertEqual((page_id, conversation_id, count), ("1", "1.0.0", 3))
+    self.assertEqual(
+        [a["rev_id"] for a in conversation_index.decompress(member)],
+        [1, 2, 3])
+    # The state after the last action is not materialized.
+    self.assertEqual([snapshot[:2] for snapshot in snapshots],
+                     [["2019-01-01T00:00:02Z", 2]])
+
+  def test_write_and_read(self):
+    tempdir = tempfile.mkdtemp()
+    actions = []
+    for conversation in range(20):
+      conversation_id = "%d.0.0" % conversation
+      # Actions arrive out of order.
+      for rev_id in (30, 10, 20):
+        actions.append(
+            action(conversation_id, rev_id + conversation,
+                   "%d.%d.0" % (rev_id + conversation, conversation),
+                   page_id=str(conversation % 3)))
+    pipeline = test_pipeline.TestPipeline()
+    # pylint:disable=expression-not-assigned
+    (pipeline
+     | beam.Create([json.dumps(a) for a in actions])
+     | conversation_index.WriteClustered(tempdir, num_shards=4))
+    pipeline.run()
+
+    reader = conversation_index.ConversationReader(tempdir)
+    self.assertEqual(reader.num_shards(), 4)
+    conversation = reader.read("7.0.0")
+    self.assertEqual([a["rev_id"] for a in conversation], [17, 27, 37])
+    self.assertEqual(reader.entry("7.0.0")["page_id"], "1")
+    self.assertEqual(reader.entry("7.0.0")["actions"], 3)
+    with self.assertRaises(KeyError):
+      reader.read("21.0.0")
+
+    fetched = dict(reader.read_many(["%d.0.0" % i for i in range(25)]))
+    self.assertEqual(len(fetched), 20)
+    self.assertEqual(fetched["7.0.0"], conversation)
+    self.assertEqual(reader.indexes_read, 4)
+
+    # Each shard is a gzip file of all its conversations.
+    lines = []
+    for shard in range(4):
+      with gzip.open(
+          conversation_index.data_path(tempdir, shard, 4), "rb") as f:
+        lines.extend(f.read().decode("utf-8").splitlines())
+    self.assertEqual(len(lines), 60)
+    self.assertEqual(
+        sorted(os.listdir(tempdir))[0], "conversations-00000-of-00004.gz")
+    shutil.rmtree(tempdir)
+
+  def test_snapshots(self):
+    tempdir = tempfile.mkdtemp()
+    actions = []
+    for conversation in range(3):
+      conversation_id = "%d.0.0" % conversation
+      for rev_id in range(1, 41):
+        a = action(conversation_id, rev_id, "%d.%d.0" % (rev_id, conversation))
+        a["type"] = "CREATION" if rev_id == 1 else "ADDITION"
+        a["replyTo_id"] = (None if rev_id == 1 else "%d.%d.0" %
+                           (rev_id // 2, conversation))
+        actions.append(a)
+      # The first comment is modified, and its replies stay attached to it.
+      a = action(conversation_id, 50, "50.%d.0" % conversation)
+      a.update(type="MODIFICATION", parent_id="2.%d.0" % conversation,
+               replyTo_id="1.%d.0" % conversation)
+      actions.append(a)
+    pipeline = test_pipeline.TestPipeline()
+    # pylint:disable=expression-not-assigned
+    (pipeline
+     | beam.Create([json.dumps(a) for a in actions])
+     | conversation_index.WriteClustered(
+         tempdir, num_shards=2, snapshot_interval=8))
+    pipeline.run()
+
+    reader = conversation_index.ConversationReader(tempdir)
+    self.assertEqual(len(reader.entry("1.0.0")["snapshots"]), 5)
+    queries = [(conversation_id, a["timestamp"])
+               for conversation_id in ("0.0.0", "1.0.0", "2.0.0")
+               for a in actions[:41:5]]
+    snapshots = dict(reader.snapshots(queries))
+    self.assertEqual(set(snapshots), set(queries))
+    for (conversation_id, timestamp), tree in snapshots.items():
+      state = conversation_state.ConversationState()
+      for a in reader.read(conversation_id):
+        if a["timestamp"] <= timestamp:
+          state.apply(a)
+      self.assertEqual(tree, state.tree())
+    # Queries only replay the actions after the latest snapshot.
+    self.assertLess(reader.replayed_actions, 8 * len(queries))
+    self.assertEqual(reader.indexes_read, 2)
+    tree = reader.snapshot("1.0.0", "2019-01-01T00:00:59Z")
+    self.assertEqual(tree[0]["replies"][0]["id"], "50.1.0")
+    self.assertEqual(tree[0]["replies"][0]["replies"][0]["id"], "4.1.0")
+    with self.assertRaises(KeyError):
+      reader.snapshot("9.0.0", "2019-01-01T00:00:59Z")
+    shutil.rmtree(tempdir)
+
+  def test_no_index(self):
+    tempdir = tempfile.mkdtemp()
+    with self.assertRaises(IOError):
+      conversation_index.ConversationReader(tempdir).read("1.0.0")
+    shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""The visible state of a conversation, built from its actions.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+A ConversationState applies the actions of a conversation in order and keeps
+the comments on display:
+
+- CREATION and ADDITION add a comment.
+- MODIFICATION and REARRANGEMENT replace the comment of their parent_id by a
+  comment with their own id, in the same place.
+- DELETION takes the comment of its parent_id off display, and RESTORATION
+  puts it back, with the id and content of the restoration.
+
+Replies are attached to the comment they reply to, following the ids that
+comment took through modifications and restorations. A reply to a comment no
+longer on display is shown at the top level. States are serialized to JSON
+so that they can be materialized every so many actions, and queries only
+replay the actions since the latest materialized state.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+COMMENT_FIELDS = ('id', 'ancestor_id', 'type', 'content', 'cleaned_content',
+                  'content_hash', 'cleaned_content_hash', 'user_id',
+                  'user_text', 'authors', 'timestamp', 'rev_id', 'indentation',
+                  'replyTo_id')
+
+
+def _comment(action, reply_to):
+  comment = {
+      field: action[field] for field in COMMENT_FIELDS if field in action
+  }
+  comment['replyTo_id'] = reply_to
+  return comment
+
+
+class ConversationState(object):
+  """The comments of a conversation on display after some of its actions.
+
+  Attributes:
+    comments: dictionary of the comments on display, by id.
+    actions: the number of actions applied.
+    timestamp: the timestamp of the last action applied, or None.
+  """
+
+  def __init__(self):
+    self.comments = {}
+    self.actions = 0
+    self.timestamp = None
+    self._positions = {}
+    self._deleted = {}
+    self._aliases = {}
+    self._next_position = 0
+
+  def _add(self, comment, position=None):
+    if position is None:
+      position = self._next_position
+      self._next_position += 1
+    self.comments[comment['id']] = comment
+    self._positions[comment['id']] = position
+
+  def _remove(self, comment_id):
+    return (self.comments.pop(comment_id, None),
+            self._positions.pop(comment_id, None))
+
+  def apply(self, action):
+    """Applies an action, in the order of conversation_index.action_order."""
+    action_type = action['type']
+    if action_type in ('CREATION', 'ADDITION'):
+      self._add(_comment(action, action['replyTo_id']))
+    elif action_type in ('MODIFICATION', 'REARRANGEMENT'):
+      old, position = self._remove(action['parent_id'])
+      reply_to = action['replyTo_id']
+      if action_type == 'REARRANGEMENT' and old is not None:
+        reply_to = old['replyTo_id']
+      self._aliases[action['parent_id']] = action['id']
+      self._add(_comment(action, reply_to), position)
+    elif action_type == 'DELETION':
+      old, position = self._remove(action['parent_id'])
+      if old is not None:
+        self._deleted[action['parent_id']] = (old, position)
+    elif action_type == 'RESTORATION':
+      old, position = self._deleted.pop(action['parent_id'], (None, None))
+      self._aliases[action['parent_id']] = action['id']
+      self._add(
+          _comment(action, old['replyTo_id'] if old is not None else None),
+          position)
+    self.actions += 1
+    self.timestamp = action['timestamp']
+
+  def current_id(self, comment_id):
+    """Returns the id a comment took through modifications and restorations."""
+    seen = set()
+    while comment_id in self._aliases and comment_id not in seen:
+      seen.add(comment_id)
+      comment_id = self._aliases[comment_id]
+    return comment_id
+
+  def tree(self):
+    """Returns the comments on display as a tree.
+
+    Returns:
+      The list of the top level comments, in the order they appear. Each
+      comment is a dictionary of its fields, with the list of its replies as
+      'replies'.
+    """
+    nodes = {
+        comment_id: dict(comment, replies=[])
+        for comment_id, comment in self.comments.items()
+    }
+    roots = []
+    for comment_id in sorted(self.comments, key=self._positions.get):
+      reply_to = self.comments[comment_id]['replyTo_id']
+      parent = (
+          self.current_id(reply_to) if reply_to is not None else None)
+      if parent in nodes and parent != comment_id:
+        nodes[parent]['replies'].append(nodes[comment_id])
+      else:
+        roots.append(nodes[comment_id])
+    return roots
+
+  def to_dict(self):
+    """Returns the state as a dictionary of JSON types."""
+    return {
+        'comments': [[
+            self.comments[comment_id], self._positions[comment_id]
+        ] for comment_id in sorted(self.comments, key=self._positions.get)],
+        'deleted': [[comment_id, comment, position] for comment_id, (
+            comment, position) in sorted(self._deleted.items())],
+        'aliases': self._aliases,
+        'next_position': self._next_position,
+        'actions': self.actions,
+        'timestamp': self.timestamp
+    }
+
+  @classmethod
+  def from_dict(cls, data):
+    state = cls()
+    for comment, position in data['comments']:
+      state._add(comment, position)
+    for comment_id, comment, position in data['deleted']:
+      state._deleted[comment_id] = (comment, position)
+    state._aliases = dict(data['aliases'])
+    state._next_position = data['next_position']
+    state.actions = data['actions']
+    state.timestamp = data['timestamp']
+    return state
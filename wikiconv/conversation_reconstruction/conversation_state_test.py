@@ -0,0 +1,95 @@
+"""Tests for conversation_state."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import unittest
+
+from wikiconv.conversation_reconstruction import conversation_state
+
+
+def action(action_type, action_id, timestamp, parent_id=None, reply_to=None,
+           content=""):
+  return {
+      "type": action_type,
+      "id": action_id,
+      "parent_id": parent_id,
+      "replyTo_id": reply_to,
+      "timestamp": timestamp,
+      "content": content,
+      "user_text": "User"
+  }
+
+
+ACTIONS = [
+    action("CREATION", "1.0.0", "t01", content="== Topic =="),
+    action("ADDITION", "2.0.0", "t02", reply_to="1.0.0", content="First"),
+    action("ADDITION", "3.0.0", "t03", reply_to="2.0.0", content="Reply"),
+    action("ADDITION", "4.0.0", "t04", reply_to="1.0.0", content="Second"),
+    action("MODIFICATION", "5.0.0", "t05", parent_id="2.0.0",
+           reply_to="1.0.0", content="First, edited"),
+    action("DELETION", "6.0.0", "t06", parent_id="4.0.0", content="Second"),
+    action("ADDITION", "7.0.0", "t07", reply_to="3.0.0", content="Reply 2"),
+    action("RESTORATION", "8.0.0", "t08", parent_id="4.0.0", content="Second"),
+]
+
+
+def shape(tree):
+  return [(node["id"], node["content"], shape(node["replies"]))
+          for node in tree]
+
+
+class ConversationStateTest(unittest.TestCase):
+
+  def replay(self, until):
+    state = conversation_state.ConversationState()
+    for a in ACTIONS:
+      if a["timestamp"] > until:
+        break
+      state.apply(a)
+    return state
+
+  def test_tree(self):
+    self.assertEqual(
+        shape(self.replay("t04").tree()),
+        [("1.0.0", "== Topic ==", [("2.0.0", "First", [("3.0.0", "Reply", [])]),
+                                   ("4.0.0", "Second", [])])])
+    # The modified comment keeps its place and its replies.
+    self.assertEqual(
+        shape(self.replay("t05").tree()),
+        [("1.0.0", "== Topic ==",
+          [("5.0.0", "First, edited", [("3.0.0", "Reply", [])]),
+           ("4.0.0", "Second", [])])])
+    self.assertEqual(
+        shape(self.replay("t06").tree()),
+        [("1.0.0", "== Topic ==",
+          [("5.0.0", "First, edited", [("3.0.0", "Reply", [])])])])
+    # The restored comment is back in its place, with the restoration's id.
+    self.assertEqual(
+        shape(self.replay("t08").tree()),
+        [("1.0.0", "== Topic ==",
+          [("5.0.0", "First, edited",
+            [("3.0.0", "Reply", [("7.0.0", "Reply 2", [])])]),
+           ("8.0.0", "Second", [])])])
+
+  def test_orphan_reply(self):
+    state = conversation_state.ConversationState()
+    state.apply(action("ADDITION", "2.0.0", "t02", reply_to="1.0.0"))
+    self.assertEqual(shape(state.tree()), [("2.0.0", "", [])])
+
+  def test_serialization(self):
+    state = self.replay("t06")
+    restored = conversation_state.ConversationState.from_dict(
+        json.loads(json.dumps(state.to_dict())))
+    self.assertEqual(restored.actions, 6)
+    self.assertEqual(restored.timestamp, "t06")
+    for a in ACTIONS[6:]:
+      state.apply(a)
+      restored.apply(a)
+    self.assertEqual(restored.tree(), state.tree())
+
+
+if __name__ == "__main__":
+  unittest.main()
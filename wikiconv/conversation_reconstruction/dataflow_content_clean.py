@@ -22,6 +22,9 @@ Run with:
    --output=OutputStorage --jobname=YourJobName --project=YourCloudProject\
    --bucket=YourCloudBucket
 
+Add --input_contents=ContentSideTable when the conversations were
+reconstructed with --content_shards, to resolve the hashed contents of actions.
+
 """
 from __future__ import absolute_import
 import argparse
@@ -33,7 +36,10 @@ import urllib2
 import traceback
 import sys
 import multiprocessing
-from wikiconv.conversation_reconstruction.construct_utils.utils.third_party.clean import content_clean
+from wikiconv.conversation_reconstruction import content_store
+from wikiconv.conversation_reconstruction.construct_utils.utils import clean_cache
+from wikiconv.conversation_reconstruction.construct_utils.utils import comment_clean
+from wikiconv.conversation_reconstruction.construct_utils.utils.comment_clean import content_clean
 
 import apache_beam as beam
 from apache_beam.metrics.metric import Metrics
@@ -66,20 +72,34 @@ def run(known_args, pipeline_args):
   with beam.Pipeline(options=pipeline_options) as p:
     results, error_log = (
         p | beam.io.ReadFromText(known_args.input)
-        | beam.ParDo(FormatClean()).with_outputs('error_log', main='results'))
+        | beam.ParDo(FormatClean(known_args.input_contents)).with_outputs(
+            'error_log', main='results'))
     results | 'WriteResult' >> beam.io.WriteToText(known_args.output)
     error_log | 'WriteErrorLog' >> beam.io.WriteToText(known_args.error_log)
 
 
 class FormatClean(beam.DoFn):
 
-  def __init__(self):
+  def __init__(self, contents_dir=None):
+    self.contents_dir = contents_dir
+    self.contents = None
     self.processed_records = Metrics.counter(self.__class__,
                                              'processed_records')
     self.parsing_errors = Metrics.counter(self.__class__, 'parsing_errors')
+    self.clean_cache_hits = Metrics.counter(self.__class__, 'clean_cache_hits')
+    self.clean_cache_misses = Metrics.counter(self.__class__,
+                                              'clean_cache_misses')
     self.schema = 'ancestor_id,authors,cleaned_content,content,conversation_id,id,indentation,page_id,page_title,parent_id,replyTo_id,rev_id,timestamp,type,user_id,user_text'
     self.fields = self.schema.split(',')
 
+  def start_bundle(self):
+    if self.contents_dir and self.contents is None:
+      self.contents = content_store.ContentTable(self.contents_dir)
+
+  def finish_bundle(self):
+    if self.contents is not None:
+      self.contents.close()
+
   def clean_schema(self, x):
     res = {}
     for f in self.fields:
@@ -92,6 +112,20 @@ class FormatClean(beam.DoFn):
   def process(self, element):
     """Convert nested array field to array; clean the wikipedia webpage format."""
     element = json.loads(element)
+    if self.contents is not None:
+      # Texts are read from the side table with a seek, by their index.
+      content_store.resolve(element, self.contents.get)
+    # Contents that were cleaned before skip the dry run.
+    key = clean_cache.content_key(content_clean, element['content'])
+    cleaned = comment_clean.cache.lookup(key)
+    if cleaned is not None:
+      self.clean_cache_hits.inc()
+      self.processed_records.inc()
+      element['cleaned_content'] = cleaned
+      for res in self.format(element):
+        yield res
+      return
+    self.clean_cache_misses.inc()
     # Dry run of format cleanning in case of unexpected error.
     p = multiprocessing.Process(
         target=content_clean, name='subprocess', args=((element['content']),))
@@ -107,6 +141,11 @@ class FormatClean(beam.DoFn):
       self.processed_records.inc()
       # MediaWiki formats cleaned only in the case of a success run of subprocess.
       element['cleaned_content'] = content_clean(element['content'])
+      comment_clean.cache.store(key, element['cleaned_content'])
+    for res in self.format(element):
+      yield res
+
+  def format(self, element):
     # Avoid nested arrays.
     temp = [
         u'{userid}:{username}'.format(
@@ -130,6 +169,10 @@ if __name__ == '__main__':
       '--error_log',
       dest='error_log',
       help='Cloud storage location to write error log.')
+  parser.add_argument(
+      '--input_contents',
+      dest='input_contents',
+      help='Location of the content side table of the input, if any.')
   parser.add_argument('--jobname', dest='jobname', help='The dataflow jobname.')
   parser.add_argument(
       '--testmode',
@@ -47,18 +47,23 @@ from __future__ import absolute_import
 import argparse
 import json
 import logging
-from os import path
 import sys
-import time
 
 import apache_beam as beam
-from apache_beam.io import filesystems
 from apache_beam.metrics.metric import Metrics
 from apache_beam.metrics.metric import MetricsFilter
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.options.pipeline_options import SetupOptions
+from wikiconv.conversation_reconstruction import content_store
+from wikiconv.conversation_reconstruction import conversation_index
+from wikiconv.conversation_reconstruction import job_summary
+from wikiconv.conversation_reconstruction import state_store
 from wikiconv.conversation_reconstruction.construct_utils import reconstruct_conversation
-import six
+from wikiconv.conversation_reconstruction.construct_utils import revision_loader
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+from wikiconv.conversation_reconstruction.construct_utils.utils import profiling
+from wikiconv.conversation_reconstruction.construct_utils.utils import restoration_index
+from wikiconv.conversation_reconstruction.construct_utils.utils import tracing
 
 # The max cumulative size of a page's revisions to be considered to try and
 # keep in memory when processing.
@@ -69,14 +74,43 @@ CUMULATIVE_REVISION_SIZE_THERESHOLD = 250 * 1024 * 1024
 SAVE_TO_MEMORY = 0
 SAVE_TO_STORAGE = 1
 
-# Number of times to DataFlow should retry a failed worker.
-RETRY_LIMIT = 10
+# The max cumulative size of the revisions in a segment file of a page that is
+# saved to storage.
+REVISION_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# The outputs of ReconstructConversation, main output first.
+RECONSTRUCTION_OUTPUTS = ('reconstruction_results', 'page_states',
+                          'last_revision', 'error_log', 'page_stats')
 
 # Custom logging level so we don't have to read all the info messages, but we
 # see our printed summary statistics.
 LOG_LEVEL_OUTPUT_INFO = 25
 
 
+class GiantPages(object):
+  """How the pages with the largest histories are scheduled.
+
+  Pages whose revisions add up to more than min_bytes are read from storage and
+  reconstructed in a branch of their own. They are reshuffled ahead of it, so
+  that each of them is a work item of its own rather than being fused behind
+  smaller pages, and are reconstructed with more processes and threads.
+
+  Attributes:
+    min_bytes: the cumulative size of the revisions of a giant page.
+    prepare_processes: number of processes cleaning and diffing the revisions
+      of a giant page ahead of their reconstruction.
+    fetch_threads: number of revisions of a giant page read concurrently.
+  """
+
+  def __init__(self,
+               min_bytes,
+               prepare_processes=0,
+               fetch_threads=revision_loader.DEFAULT_THREADS):
+    self.min_bytes = min_bytes
+    self.prepare_processes = prepare_processes
+    self.fetch_threads = fetch_threads
+
+
 def page_indexed_metadata_of_revstring(rev_string):
   record_size = len(rev_string)
   record = json.loads(rev_string)
@@ -88,6 +122,12 @@ def page_indexed_metadata_of_revstring(rev_string):
   })
 
 
+def revision_order(rev_string):
+  """Returns the key sorting revisions in the order they are processed."""
+  record = json.loads(rev_string)
+  return (record['timestamp'], int(record['rev_id']))
+
+
 def index_by_page_id(s):
   """Pair a dict with a page_id key, pair the page_id with the dict.
 
@@ -131,11 +171,11 @@ def get_distributions_metric(result, counter_name):
     return None
 
 
-# TODO(ldixon): pull these into a class, and output to JSON as a job
-# summary for better debugging.
 def print_metrics(result):
   """Print metrics we might be interested in.
 
+  All the metrics are also in the job summary, see job_summary.
+
   Args:
     result: dataflow result.
   """
@@ -163,9 +203,67 @@ def print_metrics(result):
               cumulative_page_rev_size_distr.mean)
   logging.log(LOG_LEVEL_OUTPUT_INFO, '* cumulative_page_rev_size_distr.sum: %d',
               cumulative_page_rev_size_distr.sum)
-
-
-def run(locations, run_pipeline_args, storage_client):
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* deleted_comment_evictions: %d',
+              get_counter_metric(result, 'deleted_comment_evictions') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* missed_restorations: %d',
+              get_counter_metric(result, 'missed_restorations') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* skipped_revisions: %d',
+              get_counter_metric(result, 'skipped_revisions') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* reused_cleanings: %d',
+              get_counter_metric(result, 'reused_cleanings') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* segmented_pages: %d',
+              get_counter_metric(result, 'segmented_pages') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* segment_fallbacks: %d',
+              get_counter_metric(result, 'segment_fallbacks') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* giant_pages_count: %d',
+              get_counter_metric(result, 'giant_pages_count') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* externalized_contents: %d',
+              get_counter_metric(result, 'externalized_contents') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* distinct_contents: %d',
+              get_counter_metric(result, 'distinct_contents') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* clustered_conversations: %d',
+              get_counter_metric(result, 'clustered_conversations') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* conversation_snapshots: %d',
+              get_counter_metric(result, 'conversation_snapshots') or 0)
+  logging.log(LOG_LEVEL_OUTPUT_INFO, '* state_shards_written: %d',
+              get_counter_metric(result, 'state_shards_written') or 0)
+  for name in ('revision_fetch_latency_ms', 'revision_wait_latency_ms'):
+    latency_distr = get_distributions_metric(result, name)
+    if latency_distr and latency_distr.count:
+      logging.log(LOG_LEVEL_OUTPUT_INFO, '* %s.mean: %d', name,
+                  latency_distr.mean)
+      logging.log(LOG_LEVEL_OUTPUT_INFO, '* %s.max: %d', name,
+                  latency_distr.max)
+  for stage in profiling.STAGES:
+    for name in ('profile_%s_ms' % stage, 'profile_%s_allocated_kb' % stage):
+      profile_distr = get_distributions_metric(result, name)
+      if profile_distr and profile_distr.count:
+        logging.log(LOG_LEVEL_OUTPUT_INFO, '* %s.sum: %d', name,
+                    profile_distr.sum)
+        logging.log(LOG_LEVEL_OUTPUT_INFO, '* %s.max: %d', name,
+                    profile_distr.max)
+
+
+def run(locations,
+        run_pipeline_args,
+        storage_client,
+        retention=None,
+        page_state_format='json',
+        memory_budget=None,
+        tracer=None,
+        prepare_processes=0,
+        snapshot_interval=None,
+        segment_processes=0,
+        fetch_threads=revision_loader.DEFAULT_THREADS,
+        state_shards=None,
+        profiler=None,
+        summary_top_k=job_summary.DEFAULT_TOP_K,
+        giant_pages=None,
+        content_shards=None,
+        content_min_bytes=content_store.DEFAULT_MIN_BYTES,
+        conversation_shards=None,
+        conversation_snapshot_interval=(
+            conversation_index.DEFAULT_SNAPSHOT_INTERVAL)):
   """Main entry point; runs the reconstruction pipeline.
 
   Args:
@@ -173,6 +271,43 @@ def run(locations, run_pipeline_args, storage_client):
     run_pipeline_args: flags for PipelineOptions, detailing how to run the job.
       See https://cloud.google.com/dataflow/pipelines/specifying-exec-params
     storage_client: if not None contains the cloud storage client.
+    retention: an optional restoration_index.RetentionPolicy for the deleted
+      comments kept in page states.
+    page_state_format: 'json' or 'binary', the format of output page states.
+      Input page states may be in either format.
+    memory_budget: an optional number of bytes the reconstruction of a page may
+      use for its state, see ConversationConstructor.
+    tracer: an optional tracing.Tracer selecting the revisions to trace.
+    prepare_processes: number of worker processes cleaning and diffing the
+      revisions of a page ahead of their reconstruction, 0 to do it inline.
+    snapshot_interval: if set, pages with more revisions than this get a
+      snapshot every snapshot_interval revisions in locations.output_snapshots.
+    segment_processes: if set with locations.input_snapshots, the number of
+      worker processes reconstructing pages in segments between the snapshots
+      of an earlier run.
+    fetch_threads: number of revisions of big pages read concurrently.
+    state_shards: if set, the output state is written to a store with this
+      many shards, see state_store. The number of shards of a sharded input
+      state takes precedence.
+    profiler: an optional profiling.Profiler selecting the pages to profile.
+      The cProfile statistics of pages are written to
+      locations.output_profiles.
+    summary_top_k: the number of slowest and largest pages listed in the job
+      summary written to locations.output_job_summary.
+    giant_pages: an optional GiantPages, routing the pages with the largest
+      histories to a branch of their own.
+    content_shards: if set, the texts of actions of at least content_min_bytes
+      are replaced by their hashes, and written once per distinct hash to a
+      side table of this many shards in locations.output_contents, see
+      content_store.
+    content_min_bytes: the size of the shortest text of an action written to
+      the side table.
+    conversation_shards: if set, the actions are also written clustered by
+      conversation to this many compressed shards with an index in
+      locations.output_clustered, see conversation_index.
+    conversation_snapshot_interval: the number of actions between the
+      snapshots of clustered conversations answering ConversationReader.snapshot
+      queries, 0 for none.
   """
   run_pipeline_args.extend([
       '--staging_location={dataflow_staging}'.format(
@@ -185,82 +320,186 @@ def run(locations, run_pipeline_args, storage_client):
   # by adding them as command line arguments/config.
   # See: https://cloud.google.com/dataflow/faq#how-do-i-handle-nameerrors
   pipeline_options.view_as(SetupOptions).save_main_session = True
+  input_manifest = state_store.read_manifest(locations.input_state)
+  if input_manifest:
+    if state_shards and state_shards != input_manifest['num_shards']:
+      logging.warning('Keeping the %d shards of the input state.',
+                      input_manifest['num_shards'])
+    state_shards = input_manifest['num_shards']
 
   with beam.Pipeline(options=pipeline_options) as p:
     # Find which revisions are from pages with histories so long we'll need to
     # process them on disk instead of in memory.
     # TODO(ldixon): probably better to simply extend the meta-data with a mark
     # for its part of a big page.
-    rev_marks = (
+    revision_metadata = (
         p
         | 'input_revisions-for-metadata' >> beam.io.ReadFromText(
             locations.input_revisions)
         |
-        'metadata_of_revstring' >> beam.Map(page_indexed_metadata_of_revstring)
+        'metadata_of_revstring' >> beam.Map(page_indexed_metadata_of_revstring))
+    rev_marks = (
+        revision_metadata
         | beam.GroupByKey()
-        | beam.ParDo(MarkRevisionsOfBigPages()))
+        | beam.ParDo(
+            MarkRevisionsOfBigPages(
+                giant_pages.min_bytes if giant_pages else None)).with_outputs(
+                    'giant_pages', main='rev_marks'))
+    giant_page_ids = rev_marks['giant_pages']
+    rev_marks = rev_marks['rev_marks']
     raw_revision_ids = (
         p
         | 'input_revisions' >> beam.io.ReadFromText(locations.input_revisions)
         | 'input_revisions-by-rev_id' >> beam.Map(index_by_rev_id))
-    revs_with_marks_by_id = (
+    revs_in_memory, revs_to_storage = (
         {
             'metadata': rev_marks,
             'raw': raw_revision_ids
         }
         | 'GroupbyRevID' >> beam.CoGroupByKey()
+        | beam.ParDo(KeyRevisionsBySegment()).with_outputs(
+            'to_storage', main='in_memory'))
+    revs_in_storage = (
+        revs_to_storage
+        | 'GroupBySegment' >> beam.GroupByKey()
         | 'output_revs_with_marks' >> beam.ParDo(
             WriteToStorage(), locations.output_revs_with_marks))
-    last_revisions = (
-        p
-        | 'input_last_revisions' >> beam.io.ReadFromText(
-            locations.input_last_revisions)
-        | 'input_last_revisions-by-page_id' >> beam.Map(index_by_page_id))
-    page_state = (
-        p
-        |
-        'input_page_states' >> beam.io.ReadFromText(locations.input_page_states)
-        | 'input_page_states-by-page_id' >> beam.Map(index_by_page_id))
-    error_log = (
-        p
-        | 'input_error_logs' >> beam.io.ReadFromText(locations.input_error_logs)
-        | 'input_error_logs-by-page_id' >> beam.Map(index_by_page_id))
+    revs_with_marks_by_id = ((revs_in_memory, revs_in_storage)
+                             | 'FlattenRevisions' >> beam.Flatten())
+    if input_manifest:
+      # Only read the shards of the pages with new revisions.
+      touched_shards = (
+          revision_metadata
+          | 'touched_pages' >> beam.Keys()
+          | 'shard_of_touched_pages' >> beam.Map(state_store.shard_of,
+                                                 state_shards)
+          | 'touched_shards' >> beam.Distinct())
+      input_state = (
+          touched_shards
+          | 'input_state' >> state_store.ReadState(input_manifest))
+      last_revisions = input_state['last_revisions']
+      page_state = input_state['page_states']
+      error_log = input_state['error_logs']
+    else:
+      last_revisions = (
+          p
+          | 'input_last_revisions' >> beam.io.ReadFromText(
+              locations.input_last_revisions)
+          | 'input_last_revisions-by-page_id' >> beam.Map(index_by_page_id))
+      page_state = (
+          p
+          | 'input_page_states' >> beam.io.ReadFromText(
+              locations.input_page_states)
+          | 'input_page_states-by-page_id' >> beam.Map(
+              page_state_codec.index_by_page_id))
+      error_log = (
+          p
+          |
+          'input_error_logs' >> beam.io.ReadFromText(locations.input_error_logs)
+          | 'input_error_logs-by-page_id' >> beam.Map(index_by_page_id))
+      if state_shards:
+        # All the state was read, so all of it is written to shards.
+        touched_shards = p | 'all_shards' >> beam.Create(
+            list(range(state_shards)))
 
     # Main Pipeline
-    reconstruction_results, page_states, last_rev_output, error_log = (
+    pages = (
         {
             'to_be_processed': revs_with_marks_by_id,
             'last_revision': last_revisions,
             'page_state': page_state,
-            'error_log': error_log
+            'error_log': error_log,
+            'giant': giant_page_ids
         }
         # Join information based on page_id.
-        | 'GroupBy_page_id' >> beam.CoGroupByKey()
-        | beam.ParDo(
-            reconstruct_conversation.ReconstructConversation(storage_client),
-            locations.output_revs_with_marks).with_outputs(
-                'page_states',
-                'last_revision',
-                'error_log',
-                main='reconstruction_results'))
+        | 'GroupBy_page_id' >> beam.CoGroupByKey())
+    branches = [(pages, prepare_processes, fetch_threads, '')]
+    if giant_pages:
+      pages, giant = (
+          pages
+          | 'route_giant_pages' >> beam.ParDo(RouteGiantPages()).with_outputs(
+              'giant', main='pages'))
+      branches = [(pages, prepare_processes, fetch_threads, ''),
+                  (giant | 'reshuffle_giant_pages' >> beam.Reshuffle(),
+                   giant_pages.prepare_processes, giant_pages.fetch_threads,
+                   'giant_pages-')]
+    outputs = []
+    for branch, branch_prepare_processes, branch_fetch_threads, prefix in (
+        branches):
+      outputs.append(
+          branch
+          | prefix + 'ReconstructConversation' >> beam.ParDo(
+              reconstruct_conversation.ReconstructConversation(
+                  storage_client, retention, page_state_format, memory_budget,
+                  tracer, branch_prepare_processes,
+                  locations.output_snapshots if snapshot_interval else None,
+                  snapshot_interval, locations.input_snapshots,
+                  segment_processes, branch_fetch_threads, profiler,
+                  locations.output_profiles),
+              locations.output_revs_with_marks).with_outputs(
+                  *RECONSTRUCTION_OUTPUTS[1:],
+                  main=RECONSTRUCTION_OUTPUTS[0]))
+    if len(outputs) == 1:
+      (reconstruction_results, page_states, last_rev_output, error_log,
+       page_stats) = [outputs[0][tag] for tag in RECONSTRUCTION_OUTPUTS]
+    else:
+      (reconstruction_results, page_states, last_rev_output, error_log,
+       page_stats) = [
+           [output[tag] for output in outputs]
+           | 'flatten_%s' % tag >> beam.Flatten()
+           for tag in RECONSTRUCTION_OUTPUTS
+       ]
     # Main Result
     # pylint:disable=expression-not-assigned
+    if content_shards:
+      reconstruction_results, contents = (
+          reconstruction_results
+          | 'split_contents' >> beam.ParDo(
+              content_store.SplitContents(content_min_bytes)).with_outputs(
+                  'contents', main='actions'))
+      contents | 'output_contents' >> content_store.WriteContents(
+          locations.output_contents, content_shards)
     reconstruction_results | 'output_conversations' >> beam.io.WriteToText(
         locations.output_conversations)
+    if conversation_shards:
+      reconstruction_results | 'output_clustered' >> (
+          conversation_index.WriteClustered(locations.output_clustered,
+                                            conversation_shards,
+                                            conversation_snapshot_interval))
+
+    page_stats | 'output_page_summary' >> job_summary.WritePageSummary(
+        locations.output_page_summary, summary_top_k)
 
     # Saving intermediate results to separate locations.
-    page_states | 'output_page_states' >> beam.io.WriteToText(
-        locations.output_page_states)
-    last_rev_output | 'output_last_revisions' >> beam.io.WriteToText(
-        locations.output_last_revisions)
-    error_log | 'output_error_logs' >> beam.io.WriteToText(
-        locations.output_error_logs)
+    if state_shards:
+      {
+          'page_states': page_states,
+          'last_revisions': last_rev_output,
+          'error_logs': error_log,
+          'touched_shards': touched_shards
+      } | 'output_state' >> state_store.WriteState(locations.output_state,
+                                                   state_shards)
+    else:
+      page_states | 'output_page_states' >> beam.io.WriteToText(
+          locations.output_page_states)
+      last_rev_output | 'output_last_revisions' >> beam.io.WriteToText(
+          locations.output_last_revisions)
+      error_log | 'output_error_logs' >> beam.io.WriteToText(
+          locations.output_error_logs)
 
     result = p.run()
     result.wait_until_finish()
     if (not hasattr(result, 'has_job')  # direct runner
         or result.has_job):  # not just a template creation
+      if state_shards:
+        state_store.finalize(
+            locations.output_state, input_manifest or
+            state_store.new_manifest(state_shards))
+      job_summary.finalize(locations.output_job_summary,
+                           locations.output_page_summary, result)
       print_metrics(result)
+      logging.log(LOG_LEVEL_OUTPUT_INFO, 'Job summary written to %s',
+                  locations.output_job_summary)
 
 
 # TODO(ldixon): Instead of requiring the history of a page's revisions'
@@ -270,7 +509,15 @@ def run(locations, run_pipeline_args, storage_client):
 class MarkRevisionsOfBigPages(beam.DoFn):
   """A DoFn that paritions pages with large sized revisions into buckets."""
 
-  def __init__(self):
+  def __init__(self, giant_page_bytes=None):
+    """Constructor.
+
+    Args:
+      giant_page_bytes: if set, the ids of the pages whose revisions add up to
+        more than this are output as 'giant_pages', and their revisions are
+        saved to storage.
+    """
+    self._giant_page_bytes = giant_page_bytes
     self.very_long_page_histories_count = Metrics.counter(
         self.__class__, 'very_long_page_histories_count')
     self.pages_count = Metrics.counter(self.__class__, 'pages_count')
@@ -281,7 +528,7 @@ class MarkRevisionsOfBigPages(beam.DoFn):
         self.__class__, 'cumulative_page_rev_size_distr')
 
   def process(self, element):
-    _, metadata = element
+    page_id, metadata = element
     flag = SAVE_TO_MEMORY
     metadata = list(metadata)
     # Update metrics.
@@ -296,55 +543,93 @@ class MarkRevisionsOfBigPages(beam.DoFn):
     for s in metadata:
       revision_size_sum += s['record_size']
     self.cumulative_page_rev_size_distr.update(revision_size_sum)
-    if revision_size_sum > CUMULATIVE_REVISION_SIZE_THERESHOLD:
+    threshold = CUMULATIVE_REVISION_SIZE_THERESHOLD
+    if self._giant_page_bytes is not None:
+      threshold = min(threshold, self._giant_page_bytes)
+      if revision_size_sum > self._giant_page_bytes:
+        yield beam.pvalue.TaggedOutput('giant_pages', (page_id, True))
+    if revision_size_sum > threshold:
       flag = SAVE_TO_STORAGE
       self.very_long_page_histories_count.inc()
+    if flag == SAVE_TO_MEMORY:
+      for rev in metadata:
+        yield (rev['rev_id'], (flag, None))
+      return
+    # Split the revisions of the page, in the order they are processed, into
+    # segments written to the same file.
+    metadata.sort(key=lambda rev: (rev['timestamp'], int(rev['rev_id'])))
+    segment = 0
+    segment_size = 0
     for rev in metadata:
-      yield (rev['rev_id'], flag)
+      if segment_size and segment_size + rev['record_size'] > (
+          REVISION_SEGMENT_SIZE):
+        segment += 1
+        segment_size = 0
+      segment_size += rev['record_size']
+      yield (rev['rev_id'], (flag, segment))
 
 
-class WriteToStorage(beam.DoFn):
-  """Beam DoFn for writing dictionaries to memory or files."""
+class RouteGiantPages(beam.DoFn):
+  """Beam DoFn routing the giant pages to the 'giant' output.
+
+  The other pages, joined by page id, are passed on as the main output.
+  """
 
   def __init__(self):
-    self.revisions_to_storage = Metrics.counter(self.__class__,
-                                                'revisions_to_storage')
-    self.write_retries = Metrics.counter(self.__class__, 'write_retries')
+    self.giant_pages_count = Metrics.counter(self.__class__,
+                                             'giant_pages_count')
 
-  def process(self, element, outputdir):
-    (rev_id, data) = element
-    metadata = data['metadata'][0]
+  def process(self, element):
+    (_, data) = element
+    if data['giant']:
+      self.giant_pages_count.inc()
+      yield beam.pvalue.TaggedOutput('giant', element)
+    else:
+      yield element
+
+
+class KeyRevisionsBySegment(beam.DoFn):
+  """Beam DoFn keying the revisions of big pages by their segment.
+
+  Revisions of other pages are passed on, parsed, as the main output.
+  """
+
+  def process(self, element):
+    (_, data) = element
+    flag, segment = data['metadata'][0]
     raw = data['raw'][0]
-    if metadata == SAVE_TO_MEMORY:
-      logging.info('USERLOG: Write to memory.')
+    if flag == SAVE_TO_MEMORY:
       ret = json.loads(raw)
-      page_id = ret['page_id']
       ret['rev_id'] = int(ret['rev_id'])
+      yield (ret['page_id'], ret)
     else:
-      element = json.loads(raw)
-      page_id = element['page_id']
-      rev_id = element['rev_id']
-      self.revisions_to_storage.inc()
-      # Creates writing path given the week, year pair
-      write_path = path.join(outputdir, page_id, rev_id)
-      # Writes to storage
-      logging.info('USERLOG: Write to path %s.', write_path)
-      wait_time = 1
-      for _ in range(RETRY_LIMIT):
-        try:
-          with filesystems.FileSystems.create(write_path) as outputfile:
-            if six.PY3:
-              outputfile.write(json.dumps(element).encode('utf-8'))
-            else:
-              json.dump(element, outputfile)
-        except RuntimeError:
-          self.write_retries.inc()
-          time.sleep(wait_time)
-          wait_time *= 2
-        else:
-          break
-      ret = {'timestamp': element['timestamp'], 'rev_id': int(rev_id)}
-    yield (page_id, ret)
+      yield beam.pvalue.TaggedOutput('to_storage',
+                                     ((json.loads(raw)['page_id'], segment),
+                                      raw))
+
+
+class WriteToStorage(beam.DoFn):
+  """Beam DoFn writing a segment of the revisions of a big page to a file.
+
+  Outputs the metadata of the revisions, with their location in the file.
+  """
+
+  def __init__(self):
+    self.revisions_to_storage = Metrics.counter(self.__class__,
+                                                'revisions_to_storage')
+    self.segments_to_storage = Metrics.counter(self.__class__,
+                                               'segments_to_storage')
+
+  def process(self, element, outputdir):
+    ((page_id, segment), raws) = element
+    records = sorted(raws, key=revision_order)
+    logging.info('USERLOG: Write segment %d of page %s.', segment, page_id)
+    # The file is written at once: when the write fails, the bundle is retried.
+    for metadata in revision_loader.write_segment(outputdir, page_id, segment,
+                                                  records):
+      yield (page_id, metadata)
+    self.revisions_to_storage.inc(len(records))
+    self.segments_to_storage.inc()
 
 
 class Locations(object):
@@ -357,6 +642,8 @@ class Locations(object):
 
   def __init__(self, loc_known_args):
     self.input_revisions = loc_known_args.input_revisions
+    self.input_state = loc_known_args.input_state
+    self.output_state = loc_known_args.output_state
     self.input_last_revisions = (
         loc_known_args.input_state + '/last_revisions/last_rev*')
     self.input_page_states = (
@@ -364,6 +651,7 @@ class Locations(object):
     # TODO(ldixon): why do we take in errors? remove?
     self.input_error_logs = (
         loc_known_args.input_state + '/error_logs/error_log*')
+    self.input_snapshots = getattr(loc_known_args, 'input_snapshots', None)
 
     self.dataflow_staging = (
         loc_known_args.output_state + '/dataflow_tmp/staging/')
@@ -377,9 +665,16 @@ class Locations(object):
         loc_known_args.output_state + '/last_revisions/last_rev')
     self.output_error_logs = (
         loc_known_args.output_state + '/error_logs/error_log')
+    self.output_snapshots = loc_known_args.output_state + '/snapshots'
+    self.output_profiles = loc_known_args.output_state + '/profiles'
+    self.output_page_summary = (
+        loc_known_args.output_state + '/job_summary/page_summary.json')
+    self.output_job_summary = loc_known_args.output_state + '/job_summary.json'
 
     self.output_conversations = (
         loc_known_args.output_conversations + '/conversations')
+    self.output_contents = loc_known_args.output_conversations + '/contents'
+    self.output_clustered = loc_known_args.output_conversations + '/clustered'
 
 
 def main(argv):
@@ -401,10 +696,208 @@ def main(argv):
       '--output_conversations',
       dest='output_conversations',
       help='Location to output conversations.')
+  parser.add_argument(
+      '--deleted_comments_max_age_days',
+      dest='deleted_comments_max_age_days',
+      type=float,
+      help='Days after which a deleted comment that was not seen again is no '
+      'longer considered for restoration.')
+  parser.add_argument(
+      '--deleted_comments_max_count',
+      dest='deleted_comments_max_count',
+      type=int,
+      help='Maximum number of deleted comments kept per page.')
+  parser.add_argument(
+      '--deleted_comments_max_bytes',
+      dest='deleted_comments_max_bytes',
+      type=int,
+      help='Maximum total size of the deleted comments kept per page.')
+  parser.add_argument(
+      '--page_state_format',
+      dest='page_state_format',
+      choices=page_state_codec.FORMATS,
+      default='json',
+      help='Format of the output page states. The binary format is smaller, '
+      'but only read by this version of the reconstruction onwards.')
+  parser.add_argument(
+      '--page_memory_budget_mb',
+      dest='page_memory_budget_mb',
+      type=float,
+      help='Memory budget of the state kept while reconstructing a page, in '
+      'MB. Deleted comments are evicted to stay within it.')
+  parser.add_argument(
+      '--trace_page_ids',
+      dest='trace_page_ids',
+      help='Comma separated ids of the pages whose reconstruction is traced.')
+  parser.add_argument(
+      '--trace_rev_ids',
+      dest='trace_rev_ids',
+      help='Range MIN:MAX of the revision ids whose reconstruction is traced; '
+      'either bound may be omitted.')
+  parser.add_argument(
+      '--profile_page_ids',
+      dest='profile_page_ids',
+      help='Comma separated ids of the pages whose reconstruction is profiled, '
+      'or "all". The time spent in each stage is exported as distributions.')
+  parser.add_argument(
+      '--profile_memory',
+      dest='profile_memory',
+      action='store_true',
+      help='Also trace the memory allocated by each stage of the profiled '
+      'pages. Slows their reconstruction down severalfold.')
+  parser.add_argument(
+      '--cprofile_page_ids',
+      dest='cprofile_page_ids',
+      help='Comma separated ids of the pages to profile with cProfile. Their '
+      'statistics are written to the profiles directory of the output state.')
+  parser.add_argument(
+      '--prepare_processes',
+      dest='prepare_processes',
+      type=int,
+      default=0,
+      help='Number of processes per worker cleaning and diffing the revisions '
+      'of a page while earlier revisions are reconstructed. Speeds up long '
+      'pages on multi-core workers; 0 disables it.')
+  parser.add_argument(
+      '--snapshot_interval',
+      dest='snapshot_interval',
+      type=int,
+      help='Write a snapshot of pages with long histories every this many '
+      'revisions, to the snapshots directory of the output state.')
+  parser.add_argument(
+      '--input_snapshots',
+      dest='input_snapshots',
+      help='Snapshots directory of an earlier run over the same revisions. '
+      'With --segment_processes, long pages are reconstructed in segments '
+      'between these snapshots.')
+  parser.add_argument(
+      '--segment_processes',
+      dest='segment_processes',
+      type=int,
+      default=0,
+      help='Number of processes per worker reconstructing the segments of a '
+      'page in parallel; 0 disables segmented reconstruction.')
+  parser.add_argument(
+      '--revision_fetch_threads',
+      dest='revision_fetch_threads',
+      type=int,
+      default=revision_loader.DEFAULT_THREADS,
+      help='Number of revisions of pages with long histories read '
+      'concurrently from the intermediate storage.')
+  parser.add_argument(
+      '--state_shards',
+      dest='state_shards',
+      type=int,
+      help='Write the output state to this many shards by page id, with a '
+      'manifest. Later runs from a sharded state only read and write the '
+      'shards of pages with new revisions.')
+
+  parser.add_argument(
+      '--giant_page_mb',
+      dest='giant_page_mb',
+      type=float,
+      help='Pages whose revisions add up to more than this many MB are read '
+      'from storage and reconstructed in a branch of their own, each page as a '
+      'work item of its own.')
+  parser.add_argument(
+      '--giant_page_prepare_processes',
+      dest='giant_page_prepare_processes',
+      type=int,
+      help='Number of processes per worker cleaning and diffing the revisions '
+      'of giant pages, by default --prepare_processes.')
+  parser.add_argument(
+      '--giant_page_fetch_threads',
+      dest='giant_page_fetch_threads',
+      type=int,
+      help='Number of revisions of giant pages read concurrently, by default '
+      '--revision_fetch_threads.')
+  parser.add_argument(
+      '--content_shards',
+      dest='content_shards',
+      type=int,
+      help='Replace the long contents of actions by their hashes, and write '
+      'each distinct content once to a side table of this many shards next to '
+      'the conversations.')
+  parser.add_argument(
+      '--content_min_bytes',
+      dest='content_min_bytes',
+      type=int,
+      default=content_store.DEFAULT_MIN_BYTES,
+      help='Size of the shortest content written to the side table.')
+  parser.add_argument(
+      '--conversation_shards',
+      dest='conversation_shards',
+      type=int,
+      help='Also write the actions clustered by conversation to this many '
+      'compressed shards, with an index to fetch any conversation with a '
+      'single seek.')
+  parser.add_argument(
+      '--conversation_snapshot_interval',
+      dest='conversation_snapshot_interval',
+      type=int,
+      default=conversation_index.DEFAULT_SNAPSHOT_INTERVAL,
+      help='Number of actions between the snapshots of clustered '
+      'conversations, from which their state at a given time is replayed. 0 '
+      'for none.')
+  parser.add_argument(
+      '--summary_top_k',
+      dest='summary_top_k',
+      type=int,
+      default=job_summary.DEFAULT_TOP_K,
+      help='Number of the slowest and of the largest pages listed in the job '
+      'summary written next to the output state.')
 
   # All unknown flags are considered to be pipeline arguments.
   known_args, pipeline_args = parser.parse_known_args(argv)
-  run(Locations(known_args), pipeline_args, None)
+  retention = restoration_index.RetentionPolicy(
+      max_age=(known_args.deleted_comments_max_age_days * 24 * 60 * 60
+               if known_args.deleted_comments_max_age_days is not None else
+               None),
+      max_count=known_args.deleted_comments_max_count,
+      max_bytes=known_args.deleted_comments_max_bytes)
+  memory_budget = None
+  if known_args.page_memory_budget_mb is not None:
+    memory_budget = int(known_args.page_memory_budget_mb * 1024 * 1024)
+  tracer = None
+  if known_args.trace_page_ids or known_args.trace_rev_ids:
+    min_rev_id, max_rev_id = (
+        tracing.parse_rev_id_range(known_args.trace_rev_ids)
+        if known_args.trace_rev_ids else (None, None))
+    tracer = tracing.Tracer(
+        page_ids=(known_args.trace_page_ids.split(',')
+                  if known_args.trace_page_ids else None),
+        min_rev_id=min_rev_id,
+        max_rev_id=max_rev_id)
+  profiler = None
+  if known_args.profile_page_ids or known_args.cprofile_page_ids:
+    page_ids = []
+    if known_args.profile_page_ids == 'all':
+      page_ids = None
+    elif known_args.profile_page_ids:
+      page_ids = known_args.profile_page_ids.split(',')
+    profiler = profiling.Profiler(
+        page_ids=page_ids,
+        trace_memory=known_args.profile_memory,
+        cprofile_page_ids=(known_args.cprofile_page_ids.split(',')
+                           if known_args.cprofile_page_ids else ()))
+  giant_pages = None
+  if known_args.giant_page_mb is not None:
+    giant_pages = GiantPages(
+        int(known_args.giant_page_mb * 1024 * 1024),
+        (known_args.prepare_processes
+         if known_args.giant_page_prepare_processes is None else
+         known_args.giant_page_prepare_processes),
+        (known_args.revision_fetch_threads
+         if known_args.giant_page_fetch_threads is None else
+         known_args.giant_page_fetch_threads))
+  run(Locations(known_args), pipeline_args, None, retention,
+      known_args.page_state_format, memory_budget, tracer,
+      known_args.prepare_processes, known_args.snapshot_interval,
+      known_args.segment_processes, known_args.revision_fetch_threads,
+      known_args.state_shards, profiler, known_args.summary_top_k,
+      giant_pages, known_args.content_shards, known_args.content_min_bytes,
+      known_args.conversation_shards,
+      known_args.conversation_snapshot_interval)
 
 
 if __name__ == '__main__':
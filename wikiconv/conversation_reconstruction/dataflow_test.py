@@ -5,6 +5,7 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import glob
 import json
 import os
 import shutil
@@ -15,7 +16,27 @@ import apache_beam as beam
 from apache_beam.testing import test_pipeline
 from apache_beam.testing import util
 import six
+from wikiconv.conversation_reconstruction import content_store
+from wikiconv.conversation_reconstruction import conversation_index
+from wikiconv.conversation_reconstruction import conversation_state
 from wikiconv.conversation_reconstruction import dataflow_main
+from wikiconv.conversation_reconstruction import state_store
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+
+
+TESTDATA = "wikiconv/conversation_reconstruction/testdata"
+REVISIONS = os.path.join(TESTDATA, "edgecases_28_convs")
+EMPTY_STATE = os.path.join(TESTDATA, "empty_init_state")
+GOLDEN = os.path.join(TESTDATA, "golden")
+# The golden files, and the outputs of a run they hold.
+GOLDEN_OUTPUTS = (("page_states-00000-of-00001",
+                   "page_states/page_states-00000-of-00001"),
+                  ("last_rev-00000-of-00001",
+                   "last_revisions/last_rev-00000-of-00001"),
+                  ("conversations-00000-of-00001",
+                   "conversations-00000-of-00001"),
+                  ("error_log-00000-of-00001",
+                   "error_logs/error_log-00000-of-00001"))
 
 
 class FakeStorageClient(object):
@@ -36,12 +57,68 @@ def assert_json_equal(test, actual, expected):
   six.assertCountEqual(test, actual_dicts, expected_dicts)
 
 
-def assert_json_file_equal(test, actual_file, expected_file):
-  with open(actual_file) as actual:
-    actual_lines = actual.readlines()
-  with open(expected_file) as actual:
-    expected_lines = actual.readlines()
-  assert_json_equal(test, actual_lines, expected_lines)
+def read_golden(name, page_ids=None):
+  """Returns the lines of a golden file, of the given pages only if set."""
+  with open(os.path.join(GOLDEN, name)) as f:
+    return [
+        line for line in f.readlines()
+        if page_ids is None or json.loads(line)["page_id"] in page_ids
+    ]
+
+
+def assert_golden_equal(test, actual_lines, name, page_ids=None):
+  """Compares output lines with a golden file, see read_golden."""
+  if name.startswith("page_states"):
+    actual_lines = [
+        json.dumps(page_state_codec.loads(line)) for line in actual_lines
+    ]
+  assert_json_equal(test, actual_lines, read_golden(name, page_ids))
+
+
+def assert_outputs_equal(test, output_dir, page_ids=None, skip=()):
+  """Compares the outputs of a run with the golden files."""
+  for name, path in GOLDEN_OUTPUTS:
+    if name not in skip:
+      with open(os.path.join(output_dir, path)) as f:
+        assert_golden_equal(test, f.readlines(), name, page_ids)
+
+
+def page_ids_of(revisions):
+  """Returns the ids of the pages of input revisions."""
+  page_ids = set()
+  for filename in glob.glob(os.path.join(REVISIONS, revisions)):
+    with open(filename) as f:
+      page_ids.update(json.loads(line)["page_id"] for line in f)
+  return page_ids
+
+
+def run_reconstruction(output_dir,
+                       revisions="revs*",
+                       input_state=EMPTY_STATE,
+                       output_state=None,
+                       **kwargs):
+  """Runs the reconstruction of test revisions.
+
+  Args:
+    output_dir: the location of the output conversations, and of the output
+      state unless output_state is set.
+    revisions: the glob pattern of the files of revisions in REVISIONS.
+    input_state: the location of the input state.
+    output_state: the location of the output state.
+    **kwargs: arguments of dataflow_main.run.
+  """
+  known_args = collections.namedtuple("NamedTuple", [
+      "input_revisions", "input_state", "output_conversations", "output_state"
+  ])
+  known_args.input_revisions = os.path.join(REVISIONS, revisions)
+  known_args.input_state = input_state
+  known_args.output_conversations = output_dir
+  known_args.output_state = output_state or output_dir
+  dataflow_main.run(
+      dataflow_main.Locations(known_args), [
+          "--setup_file", "wikiconv/conversation_reconstruction/setup.py",
+          "--runner", "DirectRunner"
+      ], FakeStorageClient(), **kwargs)
 
 
 class DataflowTest(unittest.TestCase):
@@ -63,100 +140,254 @@ class DataflowTest(unittest.TestCase):
     pipeline = test_pipeline.TestPipeline()
     pc = beam.Create([("page_1", [{
         "record_size": 100,
-        "rev_id": "rev1-a"
+        "rev_id": "12",
+        "timestamp": 2
     }, {
         "record_size": dataflow_main.CUMULATIVE_REVISION_SIZE_THERESHOLD,
-        "rev_id": "rev1-b"
+        "rev_id": "11",
+        "timestamp": 1
+    }, {
+        "record_size": 100,
+        "rev_id": "13",
+        "timestamp": 2
     }]),
                       ("page_2", [{
                           "record_size": 100,
-                          "rev_id": "rev2-a"
+                          "rev_id": "21",
+                          "timestamp": 1
                       }, {
                           "record_size": 100,
-                          "rev_id": "rev2-b"
+                          "rev_id": "22",
+                          "timestamp": 2
                       }])])
     res = pipeline | pc | beam.ParDo(dataflow_main.MarkRevisionsOfBigPages())
     util.assert_that(
         res,
-        util.equal_to([("rev1-a", 1), ("rev1-b", 1), ("rev2-a", 0),
-                       ("rev2-b", 0)]))
+        util.equal_to([("11", (1, 0)), ("12", (1, 1)), ("13", (1, 1)),
+                       ("21", (0, None)), ("22", (0, None))]))
     pipeline.run()
 
-  def test_write_to_storage(self):
-    tempdir = tempfile.mkdtemp()
-    os.mkdir(os.path.join(tempdir, "yyy"))
+  def test_mark_revisions_of_giant_pages(self):
+    pipeline = test_pipeline.TestPipeline()
+    pc = beam.Create([("page_1", [{
+        "record_size": 100,
+        "rev_id": "11",
+        "timestamp": 1
+    }]),
+                      ("page_2", [{
+                          "record_size": 100,
+                          "rev_id": "21",
+                          "timestamp": 1
+                      }, {
+                          "record_size": 100,
+                          "rev_id": "22",
+                          "timestamp": 2
+                      }])])
+    res = (
+        pipeline
+        | pc
+        | beam.ParDo(dataflow_main.MarkRevisionsOfBigPages(150)).with_outputs(
+            "giant_pages", main="rev_marks"))
+    util.assert_that(
+        res["rev_marks"],
+        util.equal_to([("11", (0, None)), ("21", (1, 0)), ("22", (1, 0))]),
+        label="assert_rev_marks")
+    util.assert_that(
+        res["giant_pages"],
+        util.equal_to([("page_2", True)]),
+        label="assert_giant_pages")
+    pipeline.run()
+
+  def test_key_revisions_by_segment(self):
     pipeline = test_pipeline.TestPipeline()
     pc = beam.Create([
         ("rev_1", {
-            "metadata": [dataflow_main.SAVE_TO_MEMORY],
+            "metadata": [(dataflow_main.SAVE_TO_MEMORY, None)],
             "raw": [
                 '{"page_id":"xxx","rev_id":"13","timestamp":1558015201059}'
             ]
         }),
         ("rev_2", {
-            "metadata": [dataflow_main.SAVE_TO_STORAGE],
+            "metadata": [(dataflow_main.SAVE_TO_STORAGE, 3)],
             "raw": [
                 '{"page_id":"yyy","rev_id":"26","timestamp":1558015201100}'
             ]
         }),
     ])
-    res = pipeline | pc | beam.ParDo(dataflow_main.WriteToStorage(), tempdir)
+    res = pipeline | pc | beam.ParDo(
+        dataflow_main.KeyRevisionsBySegment()).with_outputs(
+            "to_storage", main="in_memory")
     util.assert_that(
-        res,
+        res["in_memory"],
         util.equal_to([(u"xxx", {
             u"timestamp": 1558015201059,
             u"page_id": u"xxx",
             u"rev_id": 13
-        }), (u"yyy", {
+        })]),
+        label="in_memory")
+    util.assert_that(
+        res["to_storage"],
+        util.equal_to([
+            (("yyy", 3),
+             '{"page_id":"yyy","rev_id":"26","timestamp":1558015201100}')
+        ]),
+        label="to_storage")
+    pipeline.run()
+
+  def test_write_to_storage(self):
+    tempdir = tempfile.mkdtemp()
+    pipeline = test_pipeline.TestPipeline()
+    pc = beam.Create([
+        (("yyy", 2), [
+            '{"page_id":"yyy","rev_id":"27","timestamp":1558015201200}',
+            '{"page_id":"yyy","rev_id":"26","timestamp":1558015201100}'
+        ]),
+    ])
+    res = pipeline | pc | beam.ParDo(dataflow_main.WriteToStorage(), tempdir)
+    util.assert_that(
+        res,
+        util.equal_to([(u"yyy", {
             "timestamp": 1558015201100,
-            "rev_id": 26
+            "rev_id": 26,
+            "segment": 2,
+            "offset": 0,
+            "length": 58
+        }), (u"yyy", {
+            "timestamp": 1558015201200,
+            "rev_id": 27,
+            "segment": 2,
+            "offset": 58,
+            "length": 58
         })]))
     pipeline.run()
-    with open(os.path.join(tempdir, "yyy", "26")) as f:
-      self.assertEqual(
-          json.loads(f.read()),
-          json.loads(
-              '{"timestamp": 1558015201100, "page_id": "yyy", "rev_id": "26"}'))
+    with open(os.path.join(tempdir, "yyy", "segment-00002")) as f:
+      self.assertEqual([json.loads(line)["rev_id"] for line in f],
+                       ["26", "27"])
+    with open(os.path.join(tempdir, "yyy", "segment-00002.index")) as f:
+      self.assertEqual([json.loads(line)["offset"] for line in f], [0, 58])
     shutil.rmtree(tempdir)
 
   def test_end_to_end(self):
-    storage_mock = FakeStorageClient()
     tempdir = tempfile.mkdtemp()
-    pipeline_args = [
-        "--setup_file", "wikiconv/conversation_reconstruction/setup.py",
-        "--runner", "DirectRunner"
-    ]
-    known_args = collections.namedtuple("NamedTuple", [
-        "input_revisions", "input_state", "output_conversations", "output_state"
-    ])
-    known_args.input_revisions = (
-        "wikiconv/conversation_reconstruction/testdata/edgecases_28_convs/revs*")
-    known_args.input_state = (
-        "wikiconv/conversation_reconstruction/testdata/empty_init_state")
-    known_args.output_conversations = tempdir
-    known_args.output_state = tempdir
-    dataflow_main.run(
-        dataflow_main.Locations(known_args), pipeline_args, storage_mock)
-
-    assert_json_file_equal(
-        self, os.path.join(tempdir, "page_states/page_states-00000-of-00001"),
-            "wikiconv/conversation_reconstruction/testdata/golden/page_states-00000-of-00001"
-        )
-
-    assert_json_file_equal(
-        self, os.path.join(tempdir, "last_revisions/last_rev-00000-of-00001"),
-            "wikiconv/conversation_reconstruction/testdata/golden/last_rev-00000-of-00001"
-        )
-
-    assert_json_file_equal(
-        self, os.path.join(tempdir, "conversations-00000-of-00001"),
-            "wikiconv/conversation_reconstruction/testdata/golden/conversations-00000-of-00001"
-        )
-
-    assert_json_file_equal(
-        self, os.path.join(tempdir, "error_logs/error_log-00000-of-00001"),
-            "wikiconv/conversation_reconstruction/testdata/golden/error_log-00000-of-00001"
-        )
+    run_reconstruction(tempdir)
+    assert_outputs_equal(self, tempdir)
+
+    with open(os.path.join(tempdir, "job_summary.json")) as f:
+      summary = json.load(f)
+    with open(os.path.join(tempdir, "conversations-00000-of-00001")) as f:
+      actions = [json.loads(line) for line in f]
+    self.assertEqual(summary["pages"], 16)
+    self.assertEqual(summary["revisions"], 28)
+    self.assertEqual(summary["actions"],
+                     dict(collections.Counter(a["type"] for a in actions)))
+    self.assertEqual(summary["error_pages"], 0)
+    self.assertEqual(sum(summary["seconds"]["histogram_ms"].values()), 16)
+    self.assertEqual(len(summary["slowest_pages"]), 16)
+    self.assertEqual(summary["largest_pages"][0]["bytes"],
+                     max(page["bytes"] for page in summary["largest_pages"]))
+    self.assertEqual(summary["metrics"]["counters"]["pages_count"], 16)
+    self.assertEqual(
+        summary["metrics"]["distributions"]["revisions_per_page_distr"]["sum"],
+        28)
+    shutil.rmtree(tempdir)
+
+  def test_giant_pages_and_side_tables(self):
+    # A run with the giant page branch, the content side table and the
+    # clustered output on. The goldens of all pages are covered by
+    # test_end_to_end, so a couple of weeks of revisions are enough.
+    tempdir = tempfile.mkdtemp()
+    revisions = "revs_date-[67]*"
+    page_ids = page_ids_of(revisions)
+    # The 6 pages whose revisions add up to over 3000 bytes are giant ones.
+    run_reconstruction(
+        tempdir,
+        revisions,
+        giant_pages=dataflow_main.GiantPages(
+            3000, prepare_processes=2, fetch_threads=2),
+        content_shards=4,
+        content_min_bytes=100,
+        conversation_shards=3)
+    assert_outputs_equal(
+        self, tempdir, page_ids, skip=("conversations-00000-of-00001",))
+
+    with open(os.path.join(tempdir, "job_summary.json")) as f:
+      summary = json.load(f)
+    self.assertEqual(summary["pages"], 10)
+    self.assertEqual(summary["giant_pages"], 6)
+    self.assertEqual(summary["metrics"]["counters"]["giant_pages_count"],
+                     summary["giant_pages"])
+    self.assertEqual(
+        summary["giant_pages"],
+        len([page for page in summary["slowest_pages"] if page["giant"]]))
+
+    with open(os.path.join(tempdir, "conversations-00000-of-00001")) as f:
+      actions = [json.loads(line) for line in f]
+    self.assertTrue(any("content_hash" in action for action in actions))
+    self.assertFalse(any("content" in action for action in actions
+                         if "content_hash" in action))
+    table = content_store.ContentTable(os.path.join(tempdir, "contents"))
+    assert_golden_equal(
+        self,
+        [json.dumps(action) for action in table.resolve_all(actions)],
+        "conversations-00000-of-00001", page_ids)
+
+    reader = conversation_index.ConversationReader(
+        os.path.join(tempdir, "clustered"), table)
+    conversation_ids = set(action["conversation_id"] for action in actions)
+    assert_golden_equal(
+        self, [
+            json.dumps(action)
+            for _, conversation in reader.read_many(conversation_ids)
+            for action in conversation
+        ], "conversations-00000-of-00001", page_ids)
+    # The latest snapshot of a conversation shows all its comments on display.
+    conversation_id = max(conversation_ids, key=lambda i: len(reader.read(i)))
+    latest = reader.read(conversation_id)[-1]["timestamp"]
+    state = conversation_state.ConversationState()
+    for action in reader.read(conversation_id):
+      state.apply(action)
+    self.assertEqual(reader.snapshot(conversation_id, latest), state.tree())
+    table.close()
+    shutil.rmtree(tempdir)
+
+  def test_sharded_state(self):
+    tempdir = tempfile.mkdtemp()
+    # The second week only has revisions of pages not seen in the first one.
+    weeks = []
+    input_state = EMPTY_STATE
+    for week, revisions in enumerate(("revs_date-[5-7]*", "revs_date-[89]*")):
+      output_state = os.path.join(tempdir, "state", str(week))
+      run_reconstruction(
+          os.path.join(tempdir, "conversations", str(week)),
+          revisions,
+          input_state=input_state,
+          output_state=output_state,
+          state_shards=8)
+      weeks.append(state_store.read_manifest(output_state))
+      input_state = output_state
+
+    first, second = weeks
+    self.assertEqual(second["num_shards"], 8)
+    touched = set(
+        str(state_store.shard_of(page_id, 8))
+        for page_id in ("22952", "24041606", "43815776", "582"))
+    carried = set(
+        shard for shard, path in second["shards"]["last_revisions"].items()
+        if path.startswith(os.path.join(tempdir, "state", "0")))
+    # Shards without new revisions refer to the files of the first week.
+    self.assertTrue(carried)
+    self.assertEqual(carried, set(first["shards"]["last_revisions"]) - touched)
+    self.assertTrue(touched.issubset(second["shards"]["last_revisions"]))
+
+    for kind, name in (("page_states", "page_states-00000-of-00001"),
+                       ("last_revisions", "last_rev-00000-of-00001"),
+                       ("error_logs", "error_log-00000-of-00001")):
+      lines = []
+      for path in second["shards"][kind].values():
+        with open(path) as f:
+          lines.extend(f.readlines())
+      assert_golden_equal(self, lines, name)
+    shutil.rmtree(tempdir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""A JSON summary of a run of the reconstruction.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+ReconstructConversation outputs the statistics of every page it reconstructs:
+its number of revisions and their size, whether they were read from storage,
+whether it went through the branch of giant pages, its actions by type, the
+time its reconstruction took and the revision it failed on, if any. They are
+combined into a page summary with the totals, a histogram of the processing
+times and the slowest and largest pages of the run. Once the run is done, the
+page summary and the metrics of the job are written as a single JSON document
+next to the output state, so that runs can be compared and stragglers found
+without reading worker logs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import heapq
+import json
+
+import apache_beam as beam
+from apache_beam.io import filesystems
+import six
+
+DEFAULT_TOP_K = 20
+
+
+def time_bucket(seconds):
+  """Returns the upper bound of the histogram bucket of a time, in ms."""
+  bucket = 1
+  while bucket < seconds * 1000:
+    bucket *= 2
+  return bucket
+
+
+def new_summary():
+  return {
+      'pages': 0,
+      'revisions': 0,
+      'bytes': 0,
+      'stored_pages': 0,
+      'giant_pages': 0,
+      'actions': {},
+      'error_pages': 0,
+      'error_page_ids': [],
+      'seconds': {
+          'sum': 0.0,
+          'min': None,
+          'max': None,
+          'histogram_ms': {}
+      },
+      'slowest_pages': [],
+      'largest_pages': []
+  }
+
+
+def _top(entries, key, top_k):
+  return heapq.nlargest(top_k, entries, key=lambda entry: (entry[key],
+                                                           entry['page_id']))
+
+
+def merge(summaries, top_k=DEFAULT_TOP_K):
+  """Merges page summaries.
+
+  Args:
+    summaries: iterable of page summaries.
+    top_k: the number of slowest and largest pages, and of error pages, kept.
+
+  Returns:
+    The merged page summary.
+  """
+  ret = new_summary()
+  seconds = ret['seconds']
+  for summary in summaries:
+    for name in ('pages', 'revisions', 'bytes', 'stored_pages', 'giant_pages',
+                 'error_pages'):
+      ret[name] += summary[name]
+    for action_type, count in six.iteritems(summary['actions']):
+      ret['actions'][action_type] = ret['actions'].get(action_type, 0) + count
+    ret['error_page_ids'] = sorted(ret['error_page_ids'] +
+                                   summary['error_page_ids'])[:top_k]
+    seconds['sum'] += summary['seconds']['sum']
+    for name, pick in (('min', min), ('max', max)):
+      if summary['seconds'][name] is not None:
+        seconds[name] = (
+            summary['seconds'][name] if seconds[name] is None else pick(
+                seconds[name], summary['seconds'][name]))
+    for bucket, count in six.iteritems(summary['seconds']['histogram_ms']):
+      seconds['histogram_ms'][bucket] = (
+          seconds['histogram_ms'].get(bucket, 0) + count)
+    ret['slowest_pages'] = _top(ret['slowest_pages'] + summary['slowest_pages'],
+                                'seconds', top_k)
+    ret['largest_pages'] = _top(ret['largest_pages'] + summary['largest_pages'],
+                                'bytes', top_k)
+  return ret
+
+
+def summarize(stats, top_k=DEFAULT_TOP_K):
+  """Returns the page summary of the statistics of a single page."""
+  summary = new_summary()
+  summary['pages'] = 1
+  summary['revisions'] = stats['revisions']
+  summary['bytes'] = stats['bytes']
+  summary['stored_pages'] = 1 if stats['stored'] else 0
+  summary['giant_pages'] = 1 if stats.get('giant') else 0
+  summary['actions'] = dict(stats['actions'])
+  if stats['error_rev_id'] is not None:
+    summary['error_pages'] = 1
+    summary['error_page_ids'] = [six.text_type(stats['page_id'])]
+  summary['seconds'] = {
+      'sum': stats['seconds'],
+      'min': stats['seconds'],
+      'max': stats['seconds'],
+      'histogram_ms': {
+          six.text_type(time_bucket(stats['seconds'])): 1
+      }
+  }
+  if top_k:
+    summary['slowest_pages'] = [{
+        'page_id': stats['page_id'],
+        'seconds': stats['seconds'],
+        'revisions': stats['revisions'],
+        'giant': bool(stats.get('giant'))
+    }]
+    summary['largest_pages'] = [{
+        'page_id': stats['page_id'],
+        'bytes': stats['bytes'],
+        'revisions': stats['revisions']
+    }]
+  return summary
+
+
+class SummarizePages(beam.CombineFn):
+  """Combines the JSON statistics of pages into a page summary."""
+
+  def __init__(self, top_k=DEFAULT_TOP_K):
+    super(SummarizePages, self).__init__()
+    self._top_k = top_k
+
+  def create_accumulator(self):
+    return new_summary()
+
+  def add_input(self, accumulator, element):
+    return merge([accumulator, summarize(json.loads(element), self._top_k)],
+                 self._top_k)
+
+  def merge_accumulators(self, accumulators):
+    return merge(accumulators, self._top_k)
+
+  def extract_output(self, accumulator):
+    return accumulator
+
+
+class WritePageSummary(beam.PTransform):
+  """Writes the page summary of the statistics of the pages of a run."""
+
+  def __init__(self, path, top_k=DEFAULT_TOP_K):
+    super(WritePageSummary, self).__init__()
+    self._path = path
+    self._top_k = top_k
+
+  def expand(self, page_stats):
+    return (page_stats
+            | 'summarize_pages' >> beam.CombineGlobally(
+                SummarizePages(self._top_k))
+            | 'page_summary_to_json' >> beam.Map(
+                lambda summary: json.dumps(summary, sort_keys=True))
+            | 'write_page_summary' >> beam.io.WriteToText(
+                self._path, shard_name_template=''))
+
+
+def collect_metrics(result):
+  """Returns the counters and distributions of a pipeline result, by name."""
+  counters = {}
+  distributions = {}
+  query_result = result.metrics().query()
+  for counter in query_result['counters']:
+    counters[counter.key.metric.name] = (
+        counters.get(counter.key.metric.name, 0) + (counter.committed or 0))
+  for distribution in query_result['distributions']:
+    data = distribution.committed
+    if not data or not data.count:
+      continue
+    name = distribution.key.metric.name
+    if name in distributions:
+      previous = distributions[name]
+      distributions[name] = {
+          'count': previous['count'] + data.count,
+          'sum': previous['sum'] + data.sum,
+          'min': min(previous['min'], data.min),
+          'max': max(previous['max'], data.max)
+      }
+    else:
+      distributions[name] = {
+          'count': data.count,
+          'sum': data.sum,
+          'min': data.min,
+          'max': data.max
+      }
+  for data in distributions.values():
+    data['mean'] = data['sum'] / data['count']
+  return {'counters': counters, 'distributions': distributions}
+
+
+def read_page_summary(path):
+  """Reads a page summary written by WritePageSummary, if there is one."""
+  if not filesystems.FileSystems.exists(path):
+    return new_summary()
+  with filesystems.FileSystems.open(path) as f:
+    return json.loads(f.read().decode('utf-8'))
+
+
+def write_summary(path, summary):
+  with filesystems.FileSystems.create(path) as f:
+    f.write(json.dumps(summary, indent=2, sort_keys=True).encode('utf-8'))
+
+
+def finalize(path, page_summary_path, result=None):
+  """Writes the summary of a run, once it is done.
+
+  Args:
+    path: the location of the summary.
+    page_summary_path: the location of the page summary written by the run.
+    result: an optional pipeline result, whose metrics are added.
+
+  Returns:
+    The summary written.
+  """
+  summary = read_page_summary(page_summary_path)
+  if result is not None:
+    summary['metrics'] = collect_metrics(result)
+  write_summary(path, summary)
+  return summary
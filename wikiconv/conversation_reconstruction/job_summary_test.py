@@ -0,0 +1,105 @@
+"""Tests for job_summary."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from wikiconv.conversation_reconstruction import job_summary
+
+
+def stats(page_id, revisions, size, seconds, error_rev_id=None):
+  return {
+      "page_id": page_id,
+      "revisions": revisions,
+      "bytes": size,
+      "stored": size > 1000,
+      "giant": size > 4000,
+      "actions": {
+          "ADDITION": revisions,
+          "DELETION": 1
+      },
+      "seconds": seconds,
+      "error_rev_id": error_rev_id
+  }
+
+
+class JobSummaryTest(unittest.TestCase):
+
+  def test_time_bucket(self):
+    self.assertEqual(job_summary.time_bucket(0), 1)
+    self.assertEqual(job_summary.time_bucket(0.001), 1)
+    self.assertEqual(job_summary.time_bucket(0.0011), 2)
+    self.assertEqual(job_summary.time_bucket(0.5), 512)
+
+  def test_merge(self):
+    pages = [
+        stats("1", 3, 100, 0.5),
+        stats("2", 10, 5000, 2.0),
+        stats("3", 1, 10, 0.01, error_rev_id=7),
+        stats("4", 5, 800, 1.0)
+    ]
+    summary = job_summary.merge(
+        [job_summary.summarize(page, 2) for page in pages[:2]] +
+        [job_summary.merge([job_summary.summarize(page, 2)
+                            for page in pages[2:]], 2)], 2)
+    self.assertEqual(summary["pages"], 4)
+    self.assertEqual(summary["revisions"], 19)
+    self.assertEqual(summary["bytes"], 5910)
+    self.assertEqual(summary["stored_pages"], 1)
+    self.assertEqual(summary["giant_pages"], 1)
+    self.assertEqual(summary["actions"], {"ADDITION": 19, "DELETION": 4})
+    self.assertEqual(summary["error_pages"], 1)
+    self.assertEqual(summary["error_page_ids"], ["3"])
+    self.assertEqual(summary["seconds"]["min"], 0.01)
+    self.assertEqual(summary["seconds"]["max"], 2.0)
+    self.assertAlmostEqual(summary["seconds"]["sum"], 3.51)
+    self.assertEqual(summary["seconds"]["histogram_ms"], {
+        "16": 1,
+        "512": 1,
+        "1024": 1,
+        "2048": 1
+    })
+    self.assertEqual([page["page_id"] for page in summary["slowest_pages"]],
+                     ["2", "4"])
+    self.assertEqual([page["page_id"] for page in summary["largest_pages"]],
+                     ["2", "4"])
+    self.assertEqual(job_summary.merge([]), job_summary.new_summary())
+
+  def test_summarize_pages(self):
+    combine = job_summary.SummarizePages(top_k=1)
+    accumulator = combine.create_accumulator()
+    for page in (stats("1", 3, 100, 0.5), stats("2", 1, 10, 0.01)):
+      accumulator = combine.add_input(accumulator, json.dumps(page))
+    summary = combine.extract_output(
+        combine.merge_accumulators([accumulator,
+                                    combine.create_accumulator()]))
+    self.assertEqual(summary["pages"], 2)
+    self.assertEqual(summary["slowest_pages"], [{
+        "page_id": "1",
+        "seconds": 0.5,
+        "revisions": 3,
+        "giant": False
+    }])
+
+  def test_finalize(self):
+    tempdir = tempfile.mkdtemp()
+    page_summary = os.path.join(tempdir, "page_summary.json")
+    path = os.path.join(tempdir, "job_summary.json")
+    self.assertEqual(
+        job_summary.finalize(path, page_summary), job_summary.new_summary())
+    summary = job_summary.summarize(stats("1", 3, 100, 0.5))
+    job_summary.write_summary(page_summary, summary)
+    self.assertEqual(job_summary.finalize(path, page_summary), summary)
+    with open(path) as f:
+      self.assertEqual(json.load(f), summary)
+    shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Google Inc.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Reconstructs conversations on one machine, without a Beam runner.
+
+Reads the same inputs as dataflow_main.py and writes the same conversations,
+page_states, last_revisions and error_logs layout, so that a production run
+can be reproduced on one large machine:
+
+```
+python -m wikiconv.conversation_reconstruction.local_main \
+  --input_state './testdata/empty_init_state' \
+  --input_revisions './testdata/edgecases_28_convs/revs*' \
+  --output_state ./tmp/ \
+  --output_conversations ./tmp/ \
+  --processes 8
+```
+
+The revisions are grouped by page with an external sort into one file, indexed
+by page. Pages are then reconstructed in a process pool, largest first so that
+the longest histories start early, by the same code as the pipeline. Each
+worker process appends its output to its own shard of each output.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import glob
+import heapq
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+from wikiconv.conversation_reconstruction import dataflow_main
+from wikiconv.conversation_reconstruction import job_summary
+from wikiconv.conversation_reconstruction import state_store
+from wikiconv.conversation_reconstruction.construct_utils import reconstruct_conversation
+from wikiconv.conversation_reconstruction.construct_utils import revision_loader
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+
+DEFAULT_SORT_BUFFER_BYTES = 256 * 1024 * 1024
+
+# Outputs of ReconstructConversation, by tag.
+OUTPUTS = ('conversations', 'page_states', 'last_revision', 'error_log')
+# State kinds of state_store, by tag.
+STATE_KINDS = {
+    'page_states': 'page_states',
+    'last_revision': 'last_revisions',
+    'error_log': 'error_logs'
+}
+
+
+class PageIndexEntry(object):
+  """The location of the revisions of a page in the sorted revisions file."""
+
+  def __init__(self, page_id, offset):
+    self.page_id = page_id
+    self.offset = offset
+    self.length = 0
+    self.revisions = 0
+
+
+def sort_key_line(raw):
+  """Returns a revision line prefixed with the key it is sorted by."""
+  revision = json.loads(raw)
+  return '%s\t%s\t%020d\t%s' % (revision['page_id'], revision['timestamp'],
+                                int(revision['rev_id']), raw)
+
+
+def write_run(lines, tmpdir):
+  lines.sort()
+  f = tempfile.NamedTemporaryFile(
+      mode='w', dir=tmpdir, suffix='.run', delete=False, encoding='utf-8')
+  with f:
+    for line in lines:
+      f.write(line + '\n')
+  return f.name
+
+
+def sort_revisions(input_files, sorted_path, tmpdir,
+                   buffer_bytes=DEFAULT_SORT_BUFFER_BYTES):
+  """Sorts revisions by page, then in processing order, with an external sort.
+
+  Args:
+    input_files: the files of ingested revisions, as JSON lines.
+    sorted_path: the file to write the sorted revisions to.
+    tmpdir: a directory for the sorted runs.
+    buffer_bytes: the size of the revisions sorted in memory at once.
+
+  Returns:
+    The PageIndexEntry of each page, in the order of the file.
+  """
+  runs = []
+  lines = []
+  size = 0
+  for filename in input_files:
+    with io.open(filename, encoding='utf-8') as f:
+      for raw in f:
+        raw = raw.rstrip('\n')
+        if not raw:
+          continue
+        lines.append(sort_key_line(raw))
+        size += len(raw)
+        if size >= buffer_bytes:
+          runs.append(write_run(lines, tmpdir))
+          lines = []
+          size = 0
+  if lines:
+    runs.append(write_run(lines, tmpdir))
+  index = []
+  run_files = [io.open(run, encoding='utf-8') for run in runs]
+  try:
+    with open(sorted_path, 'wb') as output:
+      offset = 0
+      for line in heapq.merge(*run_files):
+        page_id, _, _, raw = line.split('\t', 3)
+        data = raw.encode('utf-8')
+        if not index or index[-1].page_id != page_id:
+          index.append(PageIndexEntry(page_id, offset))
+        output.write(data)
+        index[-1].length += len(data)
+        index[-1].revisions += 1
+        offset += len(data)
+  finally:
+    for f in run_files:
+      f.close()
+    for run in runs:
+      os.remove(run)
+  return index
+
+
+def state_files(input_state, kind, legacy_pattern):
+  """Returns the files of a kind of state, in either state layout."""
+  manifest = state_store.read_manifest(input_state)
+  if manifest:
+    return sorted(manifest['shards'][kind].values())
+  return sorted(glob.glob(legacy_pattern))
+
+
+def shard_name(prefix, shard, num_shards):
+  return '%s-%05d-of-%05d' % (prefix, shard, num_shards)
+
+
+class _Worker(object):
+  """The state of a worker process, set up by init_worker."""
+  settings = None
+  outputs = None
+  dofn = None
+
+
+def init_worker(settings, shards):
+  """Sets up a worker process, assigning it a shard of each output."""
+  with shards.get_lock():
+    shard = shards.value
+    shards.value += 1
+  _Worker.settings = settings
+  _Worker.outputs = open_outputs(settings['prefixes'], shard,
+                                 settings['num_shards'])
+  _Worker.dofn = reconstruct_conversation.ReconstructConversation(
+      None,
+      settings['retention'],
+      settings['page_state_format'],
+      settings['memory_budget'],
+      prepare_processes=0)
+
+
+def open_outputs(prefixes, shard, num_shards):
+  ret = {}
+  for tag in OUTPUTS:
+    path = shard_name(prefixes[tag], shard, num_shards)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    ret[tag] = io.open(path, 'w', encoding='utf-8')
+  return ret
+
+
+def read_page(sorted_path, entry):
+  with open(sorted_path, 'rb') as f:
+    f.seek(entry.offset)
+    data = f.read(entry.length).decode('utf-8')
+  return data.splitlines()
+
+
+def split_segments(raws):
+  """Splits the sorted revisions of a big page into segments."""
+  segments = [[]]
+  size = 0
+  for raw in raws:
+    if size and size + len(raw) > dataflow_main.REVISION_SEGMENT_SIZE:
+      segments.append([])
+      size = 0
+    segments[-1].append(raw)
+    size += len(raw)
+  return segments
+
+
+def reconstruct_page(task):
+  """Reconstructs a page in a worker process.
+
+  Args:
+    task: a tuple of the PageIndexEntry of the page and its state, a
+      dictionary of lists like the ones grouped by the pipeline.
+
+  Returns:
+    A tuple of the page id, its number of revisions and its JSON statistics,
+    or None if it was not reconstructed.
+  """
+  entry, state = task
+  settings = _Worker.settings
+  raws = read_page(settings['sorted_path'], entry)
+  size = sum(len(raw) for raw in raws)
+  revisions = []
+  if size > dataflow_main.CUMULATIVE_REVISION_SIZE_THERESHOLD:
+    # Big pages are read back from segments, as in the pipeline.
+    for segment, records in enumerate(split_segments(raws)):
+      revisions.extend(
+          revision_loader.write_segment(settings['tmp_input'], entry.page_id,
+                                        segment, records))
+  else:
+    for raw in raws:
+      revision = json.loads(raw)
+      revision['rev_id'] = int(revision['rev_id'])
+      revisions.append(revision)
+  raws = None
+  data = dict(state, to_be_processed=revisions)
+  outputs = _Worker.outputs
+  stats = None
+  for output in _Worker.dofn.process((entry.page_id, data),
+                                     settings['tmp_input']):
+    if hasattr(output, 'tag') and output.tag == 'page_stats':
+      stats = output.value
+    elif hasattr(output, 'tag'):
+      outputs[output.tag].write(output.value + '\n')
+    else:
+      outputs['conversations'].write(output + '\n')
+  for f in outputs.values():
+    f.flush()
+  return entry.page_id, entry.revisions, stats
+
+
+def parse_state(tag, line):
+  if tag == 'page_states':
+    return page_state_codec.index_by_page_id(line)
+  return dataflow_main.index_by_page_id(line)
+
+
+def run(locations,
+        processes=None,
+        retention=None,
+        page_state_format='json',
+        memory_budget=None,
+        sort_buffer_bytes=DEFAULT_SORT_BUFFER_BYTES,
+        tmpdir=None,
+        summary_top_k=job_summary.DEFAULT_TOP_K):
+  """Runs the reconstruction locally.
+
+  Args:
+    locations: a dataflow_main.Locations instance.
+    processes: the number of worker processes, by default one per core.
+    retention: an optional restoration_index.RetentionPolicy.
+    page_state_format: 'json' or 'binary', the format of output page states.
+    memory_budget: an optional number of bytes the state of a page may use.
+    sort_buffer_bytes: the size of the revisions sorted in memory at once.
+    tmpdir: a directory for temporary files, by default the system's.
+    summary_top_k: the number of slowest and largest pages listed in the job
+      summary written to locations.output_job_summary.
+
+  Returns:
+    The number of pages reconstructed.
+  """
+  processes = processes or multiprocessing.cpu_count()
+  workdir = tempfile.mkdtemp(dir=tmpdir)
+  try:
+    sorted_path = os.path.join(workdir, 'revisions')
+    index = sort_revisions(
+        sorted(glob.glob(locations.input_revisions)), sorted_path, workdir,
+        sort_buffer_bytes)
+    logging.info('Sorted the revisions of %d pages.', len(index))
+    pages = set(entry.page_id for entry in index)
+    # Shard 0 holds the state of the pages without new revisions, passed
+    # through as it was read, and each worker process writes its own shard.
+    num_shards = processes + 1
+    prefixes = {
+        'conversations': locations.output_conversations,
+        'page_states': locations.output_page_states,
+        'last_revision': locations.output_last_revisions,
+        'error_log': locations.output_error_logs
+    }
+    passthrough = open_outputs(prefixes, 0, num_shards)
+    states = {}
+    for tag, pattern in (('page_states', locations.input_page_states),
+                         ('last_revision', locations.input_last_revisions),
+                         ('error_log', locations.input_error_logs)):
+      for filename in state_files(locations.input_state, STATE_KINDS[tag],
+                                  pattern):
+        with io.open(filename, encoding='utf-8') as f:
+          for line in f:
+            line = line.rstrip('\n')
+            if not line:
+              continue
+            page_id, value = parse_state(tag, line)
+            if page_id in pages:
+              states.setdefault(page_id, {
+                  'page_state': [],
+                  'last_revision': [],
+                  'error_log': []
+              })[tag if tag != 'page_states' else 'page_state'].append(value)
+            else:
+              passthrough[tag].write(line + '\n')
+    for f in passthrough.values():
+      f.close()
+
+    settings = {
+        'sorted_path': sorted_path,
+        'tmp_input': locations.output_revs_with_marks,
+        'prefixes': prefixes,
+        'num_shards': num_shards,
+        'retention': retention,
+        'page_state_format': page_state_format,
+        'memory_budget': memory_budget
+    }
+    empty_state = {'page_state': [], 'last_revision': [], 'error_log': []}
+    # Largest pages first, so that the longest histories do not start last.
+    index.sort(key=lambda entry: entry.length, reverse=True)
+    tasks = ((entry, states.pop(entry.page_id, empty_state)) for entry in index)
+    shards = multiprocessing.Value('i', 1)
+    pool = multiprocessing.Pool(processes, init_worker, (settings, shards))
+    summary = job_summary.new_summary()
+    try:
+      for done, (page_id, revisions, stats) in enumerate(
+          pool.imap_unordered(reconstruct_page, tasks), 1):
+        logging.info('Reconstructed page %s with %d revisions (%d/%d).',
+                     page_id, revisions, done, len(index))
+        if stats:
+          summary = job_summary.merge([
+              summary,
+              job_summary.summarize(json.loads(stats), summary_top_k)
+          ], summary_top_k)
+    finally:
+      pool.close()
+      pool.join()
+    job_summary.write_summary(locations.output_job_summary, summary)
+    return len(index)
+  finally:
+    shutil.rmtree(workdir)
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--input_state',
+      dest='input_state',
+      help='Location of input page state to start from.')
+  parser.add_argument(
+      '--input_revisions',
+      dest='input_revisions',
+      help='Location of the input revisions to process.')
+  parser.add_argument(
+      '--output_state',
+      dest='output_state',
+      help='Location for intermediate outputs.')
+  parser.add_argument(
+      '--output_conversations',
+      dest='output_conversations',
+      help='Location to output conversations.')
+  parser.add_argument(
+      '--processes',
+      dest='processes',
+      type=int,
+      help='Number of pages reconstructed in parallel, by default one per '
+      'core.')
+  parser.add_argument(
+      '--page_state_format',
+      dest='page_state_format',
+      choices=page_state_codec.FORMATS,
+      default='json',
+      help='Format of the output page states. The binary format is smaller, '
+      'but only read by this version of the reconstruction onwards.')
+  parser.add_argument(
+      '--page_memory_budget_mb',
+      dest='page_memory_budget_mb',
+      type=float,
+      help='Memory budget of the state kept while reconstructing a page, in '
+      'MB.')
+  parser.add_argument(
+      '--sort_buffer_mb',
+      dest='sort_buffer_mb',
+      type=float,
+      default=DEFAULT_SORT_BUFFER_BYTES / (1024 * 1024),
+      help='Size of the revisions sorted in memory at once, in MB.')
+  parser.add_argument(
+      '--tmpdir',
+      dest='tmpdir',
+      help='Directory for the sorted revisions, by default the system '
+      'temporary directory.')
+  parser.add_argument(
+      '--summary_top_k',
+      dest='summary_top_k',
+      type=int,
+      default=job_summary.DEFAULT_TOP_K,
+      help='Number of the slowest and of the largest pages listed in the job '
+      'summary.')
+  known_args = parser.parse_args(argv)
+  memory_budget = None
+  if known_args.page_memory_budget_mb is not None:
+    memory_budget = int(known_args.page_memory_budget_mb * 1024 * 1024)
+  run(
+      dataflow_main.Locations(known_args),
+      known_args.processes,
+      page_state_format=known_args.page_state_format,
+      memory_budget=memory_budget,
+      sort_buffer_bytes=int(known_args.sort_buffer_mb * 1024 * 1024),
+      tmpdir=known_args.tmpdir,
+      summary_top_k=known_args.summary_top_k)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
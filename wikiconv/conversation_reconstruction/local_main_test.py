@@ -0,0 +1,113 @@
+"""Tests for local_main."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from wikiconv.conversation_reconstruction import dataflow_main
+from wikiconv.conversation_reconstruction import dataflow_test
+from wikiconv.conversation_reconstruction import local_main
+
+if sys.version_info >= (3, 3):
+  from unittest import mock  # pylint: disable=g-import-not-at-top,g-importing-member
+else:
+  import mock  # pylint: disable=g-import-not-at-top
+
+TESTDATA = "wikiconv/conversation_reconstruction/testdata/"
+
+
+def read_lines(pattern):
+  lines = []
+  for path in sorted(glob.glob(pattern)):
+    with open(path) as f:
+      lines.extend(f.readlines())
+  return lines
+
+
+class LocalMainTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_sort_revisions(self):
+    input_files = sorted(glob.glob(TESTDATA + "edgecases_28_convs/revs*"))
+    sorted_path = os.path.join(self.tempdir, "revisions")
+    # A small buffer sorts the revisions in several runs.
+    index = local_main.sort_revisions(input_files, sorted_path, self.tempdir,
+                                      1000)
+    self.assertEqual(len(index), 16)
+    self.assertEqual(sum(entry.revisions for entry in index), 28)
+    self.assertEqual(
+        [name for name in os.listdir(self.tempdir)], ["revisions"])
+    for entry in index:
+      revisions = [
+          json.loads(raw) for raw in local_main.read_page(sorted_path, entry)
+      ]
+      self.assertEqual(len(revisions), entry.revisions)
+      self.assertEqual(set(rev["page_id"] for rev in revisions),
+                       set([entry.page_id]))
+      self.assertEqual(
+          revisions,
+          sorted(revisions, key=lambda rev: (rev["timestamp"], rev["rev_id"])))
+
+  def run_locally(self):
+    known_args = collections.namedtuple("NamedTuple", [
+        "input_revisions", "input_state", "output_conversations", "output_state"
+    ])
+    known_args.input_revisions = TESTDATA + "edgecases_28_convs/revs*"
+    known_args.input_state = TESTDATA + "empty_init_state"
+    known_args.output_conversations = self.tempdir
+    known_args.output_state = self.tempdir
+    self.assertEqual(
+        local_main.run(
+            dataflow_main.Locations(known_args), processes=2,
+            tmpdir=self.tempdir), 16)
+
+  def assert_golden_output(self):
+    for pattern, golden in (("conversations-*", "conversations"),
+                            ("last_revisions/last_rev-*", "last_rev"),
+                            ("error_logs/error_log-*", "error_log"),
+                            ("page_states/page_states-*", "page_states")):
+      dataflow_test.assert_golden_equal(
+          self, read_lines(os.path.join(self.tempdir, pattern)),
+          "%s-00000-of-00001" % golden)
+
+  def test_run(self):
+    self.run_locally()
+    self.assertEqual(
+        len(glob.glob(os.path.join(self.tempdir, "conversations-*"))), 3)
+    self.assert_golden_output()
+    with open(os.path.join(self.tempdir, "job_summary.json")) as f:
+      summary = json.load(f)
+    self.assertEqual(summary["pages"], 16)
+    self.assertEqual(summary["revisions"], 28)
+    self.assertEqual(summary["stored_pages"], 0)
+
+  def test_run_with_big_pages(self):
+    with mock.patch.object(dataflow_main, "CUMULATIVE_REVISION_SIZE_THERESHOLD",
+                           0), mock.patch.object(dataflow_main,
+                                                 "REVISION_SEGMENT_SIZE", 2000):
+      self.run_locally()
+    self.assertTrue(
+        glob.glob(
+            os.path.join(self.tempdir, "revs_with_marks", "*",
+                         "segment-00001")))
+    self.assert_golden_output()
+    with open(os.path.join(self.tempdir, "job_summary.json")) as f:
+      self.assertEqual(json.load(f)["stored_pages"], 16)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -32,7 +32,7 @@ import setuptools
 # restriction is specified.
 REQUIRED_PACKAGES = [
     'diff-match-patch==20181111', 'google-cloud-storage==1.13.0',
-    'google-apitools==0.5.26', 'NoAho==0.9.6.1', 'mwparserfromhell==0.5.1',
+    'google-apitools==0.5.26', 'mwparserfromhell==0.5.1',
     'yamlconf==0.2.3', 'mwtypes==0.3.0', 'beautifulsoup4==4.5.1'
 ]
 
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""A store of the reconstruction state, sharded by page id.
+
+Copyright 2019 Google Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not
+use this file except in compliance with the License.
+
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+
+The state a run of the reconstruction leaves for the next one is, per page, its
+page state, its last revision and its error log, if any. In a sharded store,
+each kind of state is split into a fixed number of shards by a hash of the page
+id, and a manifest at the root of the store maps every shard to the file
+holding it.
+
+A run only reads the shards of the pages it has new revisions for, and only
+writes these shards. The manifest of its output refers to the files of the
+other shards where earlier runs wrote them, so state I/O scales with the pages
+changed by a run rather than with the corpus.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+import apache_beam as beam
+from apache_beam.io import filesystems
+from apache_beam.metrics.metric import Metrics
+from wikiconv.conversation_reconstruction.construct_utils.utils import page_state_codec
+import six
+
+MANIFEST = 'manifest.json'
+UPDATES = 'manifest_updates/updates'
+KINDS = ('page_states', 'last_revisions', 'error_logs')
+
+
+def shard_of(page_id, num_shards):
+  """Returns the shard of a page, stable across runs and platforms."""
+  digest = hashlib.md5(six.text_type(page_id).encode('utf-8')).hexdigest()
+  return int(digest[:8], 16) % num_shards
+
+
+def shard_path(state_dir, kind, shard, num_shards):
+  return filesystems.FileSystems.join(
+      state_dir, 'shards', kind, 'shard-%05d-of-%05d' % (shard, num_shards))
+
+
+def index_line(kind, line):
+  """Pairs a line of state with the id of its page, leaving it undecoded."""
+  if kind == 'page_states':
+    return page_state_codec.index_by_page_id(line)
+  return (json.loads(line)['page_id'], line)
+
+
+def parse_line(kind, line):
+  """Pairs a line of state with the id of its page, as the pipeline reads it.
+
+  Page states are left undecoded; the other kinds of state are parsed.
+  """
+  if kind == 'page_states':
+    return page_state_codec.index_by_page_id(line)
+  state = json.loads(line)
+  return (state['page_id'], state)
+
+
+def read_manifest(state_dir):
+  """Returns the manifest of a store, or None if it is not sharded."""
+  path = filesystems.FileSystems.join(state_dir, MANIFEST)
+  if not filesystems.FileSystems.exists(path):
+    return None
+  with filesystems.FileSystems.open(path) as f:
+    return json.loads(f.read().decode('utf-8'))
+
+
+def new_manifest(num_shards):
+  return {'num_shards': num_shards, 'shards': {kind: {} for kind in KINDS}}
+
+
+def merge_manifest(manifest, updates):
+  """Returns a manifest updated with the shards written by a run.
+
+  Args:
+    manifest: the manifest of the input store.
+    updates: the updates output by a run. Each touched shard has an update
+      without a kind; its files are replaced by the ones written for it.
+
+  Returns:
+    The manifest of the output store.
+  """
+  merged = {
+      'num_shards': manifest['num_shards'],
+      'shards': {kind: dict(manifest['shards'][kind]) for kind in KINDS}
+  }
+  for update in updates:
+    if 'kind' not in update:
+      for kind in KINDS:
+        merged['shards'][kind].pop(six.text_type(update['shard']), None)
+  for update in updates:
+    if 'kind' in update:
+      merged['shards'][update['kind']][six.text_type(
+          update['shard'])] = update['path']
+  return merged
+
+
+def write_manifest(state_dir, manifest):
+  with filesystems.FileSystems.create(
+      filesystems.FileSystems.join(state_dir, MANIFEST)) as f:
+    f.write(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+
+
+def finalize(state_dir, manifest):
+  """Writes the manifest of the output of a run, once it is done.
+
+  Args:
+    state_dir: the output state location of the run.
+    manifest: the manifest of its input state.
+
+  Returns:
+    The manifest written.
+  """
+  updates = []
+  pattern = filesystems.FileSystems.join(state_dir, UPDATES + '*')
+  for metadata in filesystems.FileSystems.match([pattern])[0].metadata_list:
+    with filesystems.FileSystems.open(metadata.path) as f:
+      updates.extend(
+          json.loads(line)
+          for line in f.read().decode('utf-8').splitlines()
+          if line)
+  merged = merge_manifest(manifest, updates)
+  write_manifest(state_dir, merged)
+  return merged
+
+
+def shard_paths(manifest, kind, shard):
+  path = manifest['shards'][kind].get(six.text_type(shard))
+  return [path] if path else []
+
+
+class WriteShard(beam.DoFn):
+  """Beam DoFn writing a shard of state to a file."""
+
+  def __init__(self):
+    self.state_shards_written = Metrics.counter(self.__class__,
+                                                'state_shards_written')
+
+  def process(self, element, state_dir, num_shards):
+    ((kind, shard), lines) = element
+    path = shard_path(state_dir, kind, shard, num_shards)
+    with filesystems.FileSystems.create(path) as f:
+      for line in lines:
+        f.write(line.encode('utf-8') + b'\n')
+    self.state_shards_written.inc()
+    yield json.dumps({'kind': kind, 'shard': shard, 'path': path})
+
+
+class ReadState(beam.PTransform):
+  """Reads the state of the touched shards of a store, keyed by page id.
+
+  The input is the PCollection of the touched shards. The output is a
+  dictionary of the PCollection of each kind of state.
+  """
+
+  def __init__(self, manifest):
+    super(ReadState, self).__init__()
+    self._manifest = manifest
+
+  def expand(self, touched_shards):
+    manifest = self._manifest
+    ret = {}
+    for kind in KINDS:
+      ret[kind] = (
+          touched_shards
+          | 'paths_of_%s' % kind >> beam.FlatMap(
+              lambda shard, kind=kind: shard_paths(manifest, kind, shard))
+          | 'read_%s' % kind >> beam.io.ReadAllFromText()
+          | 'index_%s' % kind >> beam.Map(
+              lambda line, kind=kind: parse_line(kind, line)))
+    return ret
+
+
+class WriteState(beam.PTransform):
+  """Writes the touched shards of a store, and the updates of its manifest.
+
+  The input is a dictionary of the touched shards and of the PCollection of
+  each kind of state, as lines.
+  """
+
+  def __init__(self, state_dir, num_shards):
+    super(WriteState, self).__init__()
+    self._state_dir = state_dir
+    self._num_shards = num_shards
+
+  def expand(self, pcolls):
+    num_shards = self._num_shards
+    keyed = [
+        pcolls[kind]
+        | 'key_%s_by_shard' % kind >> beam.Map(
+            lambda line, kind=kind:
+            ((kind, shard_of(index_line(kind, line)[0], num_shards)), line))
+        for kind in KINDS
+    ]
+    written = (
+        keyed
+        | 'flatten_state' >> beam.Flatten()
+        | 'group_by_shard' >> beam.GroupByKey()
+        | 'write_shards' >> beam.ParDo(WriteShard(), self._state_dir,
+                                       num_shards))
+    touched = (
+        pcolls['touched_shards']
+        | 'touched_updates' >> beam.Map(
+            lambda shard: json.dumps({'shard': shard})))
+    return ((written, touched)
+            | 'flatten_updates' >> beam.Flatten()
+            | 'write_updates' >> beam.io.WriteToText(
+                filesystems.FileSystems.join(self._state_dir, UPDATES)))
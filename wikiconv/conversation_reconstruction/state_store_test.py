@@ -0,0 +1,72 @@
+"""Tests for state_store."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import shutil
+import tempfile
+import unittest
+
+from wikiconv.conversation_reconstruction import state_store
+
+
+class StateStoreTest(unittest.TestCase):
+
+  def test_shard_of(self):
+    shards = [state_store.shard_of(str(page_id), 16) for page_id in range(200)]
+    self.assertEqual(set(shards), set(range(16)))
+    self.assertEqual(state_store.shard_of(1234, 16),
+                     state_store.shard_of("1234", 16))
+
+  def test_merge_manifest(self):
+    manifest = state_store.new_manifest(4)
+    manifest["shards"]["page_states"] = {"0": "old/ps-0", "1": "old/ps-1"}
+    manifest["shards"]["error_logs"] = {"1": "old/el-1"}
+    merged = state_store.merge_manifest(manifest, [{
+        "shard": 1
+    }, {
+        "shard": 2
+    }, {
+        "kind": "page_states",
+        "shard": 1,
+        "path": "new/ps-1"
+    }, {
+        "kind": "page_states",
+        "shard": 2,
+        "path": "new/ps-2"
+    }])
+    self.assertEqual(merged["num_shards"], 4)
+    self.assertEqual(merged["shards"]["page_states"], {
+        "0": "old/ps-0",
+        "1": "new/ps-1",
+        "2": "new/ps-2"
+    })
+    # The error log of a touched shard is gone when none was written for it.
+    self.assertEqual(merged["shards"]["error_logs"], {})
+    self.assertEqual(manifest["shards"]["error_logs"], {"1": "old/el-1"})
+
+  def test_manifest_files(self):
+    tempdir = tempfile.mkdtemp()
+    self.assertIsNone(state_store.read_manifest(tempdir))
+    manifest = state_store.new_manifest(2)
+    state_store.write_manifest(tempdir, manifest)
+    self.assertEqual(state_store.read_manifest(tempdir), manifest)
+    shutil.rmtree(tempdir)
+
+  def test_lines(self):
+    line = json.dumps({"page_id": "12", "rev_id": 3})
+    self.assertEqual(state_store.index_line("error_logs", line), ("12", line))
+    self.assertEqual(
+        state_store.parse_line("error_logs", line), ("12", {
+            "page_id": "12",
+            "rev_id": 3
+        }))
+    page_state = json.dumps({"page_id": "12", "page_state": {"actions": {}}})
+    self.assertEqual(
+        state_store.parse_line("page_states", page_state), ("12", page_state))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,54 @@
+"""Tests for contents."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from write_utils.contents import ContentTable
+from write_utils.contents import resolve
+
+
+def write_table(contents_dir, texts, num_shards):
+  """Writes texts the way content_store.WriteContents does."""
+  records = {}
+  for text in texts:
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    records.setdefault(int(digest[:8], 16) % num_shards, []).append(
+        (digest, text))
+  for shard in range(num_shards):
+    suffix = '-%05d-of-%05d' % (shard, num_shards)
+    index = []
+    with open(os.path.join(contents_dir, 'contents' + suffix), 'wb') as f:
+      for digest, text in records.get(shard, []):
+        line = (json.dumps({'hash': digest, 'text': text}) + '\n').encode('utf-8')
+        index.append('%s %d %d\n' % (digest, f.tell(), len(line)))
+        f.write(line)
+    with open(os.path.join(contents_dir, 'index' + suffix), 'w') as f:
+      f.write(''.join(sorted(index)))
+
+
+class ContentsTest(unittest.TestCase):
+
+  def test_resolve(self):
+    tempdir = tempfile.mkdtemp()
+    texts = ['Comment number %d.' % i for i in range(20)]
+    write_table(tempdir, texts, 3)
+    table = ContentTable(tempdir)
+    digest = hashlib.sha1(texts[7].encode('utf-8')).hexdigest()
+    action = {'id': '1.0.0', 'content_hash': digest, 'cleaned_content': 'c'}
+    self.assertEqual(resolve(dict(action), table.get),
+                     {'id': '1.0.0', 'content': texts[7],
+                      'cleaned_content': 'c'})
+    with self.assertRaises(KeyError):
+      table.get(hashlib.sha1(b'missing').hexdigest())
+    table.close()
+    shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
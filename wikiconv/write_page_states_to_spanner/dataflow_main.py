@@ -25,12 +25,16 @@ Run with:
          --spanner_database=SpannerDatabaseID --spanner_table=SpannerTableID
          --spanner_table_columns_config=JsonConfigFile
          --testmode***
+         --input_contents=ContentSideTable****
          --setup_file=./setup.py
 
 Note:
   **Storage options: There are two ways to provide storage options: via input_storage or bigquery_table
   ***--testmode: optional on-off button that enables testmode of the dataflow pipeline,
               running on DirectRunner instead of DataflowRunner when turned on.
+  ****--input_contents: optional content side table of conversations
+              reconstructed with --content_shards, resolving their hashed
+              contents.
 """
 # -*- coding: utf-8 -*-
 
@@ -44,6 +48,8 @@ import apache_beam as beam
 from apache_beam.metrics.metric import Metrics
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.options.pipeline_options import SetupOptions
+from write_utils.contents import ContentTable
+from write_utils.contents import resolve
 from write_utils.write import SpannerWriter
 
 
@@ -75,10 +81,11 @@ def run(known_args, pipeline_args):
           query="SELECT * FROM %s" % known_args.bigquery_table, use_standard_sql=True)))
     # Main pipeline.
     p = (input_data | beam.ParDo(WriteToSpanner(known_args.spanner_instance, known_args.spanner_database,
-                                     known_args.spanner_table, known_args.spanner_table_columns), known_args.input_storage))
+                                     known_args.spanner_table, known_args.spanner_table_columns,
+                                     known_args.input_contents), known_args.input_storage))
 
 class WriteToSpanner(beam.DoFn):
-  def __init__(self, instance_id, database_id, table_id, table_columns):
+  def __init__(self, instance_id, database_id, table_id, table_columns, contents_dir=None):
     self.inserted_record = Metrics.counter(self.__class__, 'inserted_record')
     self.already_exists = Metrics.counter(self.__class__, 'already_exists')
     self.large_record = Metrics.counter(self.__class__, 'large_record')
@@ -86,18 +93,29 @@ class WriteToSpanner(beam.DoFn):
     self.database_id = database_id
     self.table_id = table_id
     self.table_columns = table_columns
+    self.contents_dir = contents_dir
+    self.contents = None
 
 
   def start_bundle(self):
     self.table_columns = self.table_columns
     self.writer = SpannerWriter(self.instance_id, self.database_id)
     self.writer.create_table(self.table_id, self.table_columns)
+    if self.contents_dir and self.contents is None:
+      self.contents = ContentTable(self.contents_dir)
+
+  def finish_bundle(self):
+    if self.contents is not None:
+      self.contents.close()
 
 
   def process(self, element, input_storage):
     if input_storage is not None:
       # Data from cloud storage may be json incoded.
       element = json.loads(element)
+    if self.contents is not None:
+      # Hashed contents are resolved from the side table as they come.
+      element = resolve(dict(element), self.contents.get)
     try:
        self.writer.insert_data(self.table_id, element)
        self.inserted_record.inc()
@@ -133,6 +151,10 @@ if __name__ == '__main__':
                       dest='config_file',
                       default=None,
                       help='The config file in json format to specify columns.')
+  parser.add_argument('--input_contents',
+                      dest='input_contents',
+                      default=None,
+                      help='(Optional) Content side table of the input conversations.')
   parser.add_argument('--testmode',
                       dest='testmode',
                       action='store_true',
@@ -0,0 +1,100 @@
+"""
+Copyright 2019 Google Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-------------------------------------------------------------------------------
+Resolves the hashed texts of actions from a content side table.
+
+The side table is written by conversation_reconstruction/content_store.py,
+which this package does not ship: it is a set of shards of JSON lines of
+{"hash": ..., "text": ...}, split by the first 8 hex digits of the hash, each
+with an index of "hash offset length" lines. Only what the writer needs to
+look up single texts is here.
+"""
+# -*- coding: utf-8 -*-
+
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import json
+import re
+from apache_beam.io import filesystems
+from apache_beam.io.filesystem import CompressionTypes
+
+HASHED_FIELDS = ('content', 'cleaned_content')
+HASH_SUFFIX = '_hash'
+_SHARD_NAME = re.compile(r'contents-(\d+)-of-(\d+)$')
+
+
+def resolve(action, lookup):
+  """Replaces the hashes of an action by their texts, in place."""
+  for field in HASHED_FIELDS:
+    digest = action.pop(field + HASH_SUFFIX, None)
+    if digest is not None:
+      action[field] = lookup(digest)
+  return action
+
+
+class ContentTable(object):
+  """Reads the texts of a content side table, by hash."""
+
+  def __init__(self, contents_dir):
+    self.contents_dir = contents_dir
+    self._num_shards = None
+    self._indexes = {}
+    self._files = {}
+
+  def _path(self, name, shard):
+    return filesystems.FileSystems.join(
+        self.contents_dir, '%s-%05d-of-%05d' % (name, shard, self._num_shards))
+
+  def _shard_of(self, digest):
+    if self._num_shards is None:
+      pattern = filesystems.FileSystems.join(self.contents_dir, 'contents-*')
+      for metadata in filesystems.FileSystems.match([pattern])[0].metadata_list:
+        match = _SHARD_NAME.search(metadata.path)
+        if match:
+          self._num_shards = int(match.group(2))
+          break
+      else:
+        raise IOError('No content shards in %s.' % self.contents_dir)
+    return int(digest[:8], 16) % self._num_shards
+
+  def get(self, digest):
+    """Returns the text of a hash, raising KeyError if it is not in the table."""
+    shard = self._shard_of(digest)
+    if shard not in self._indexes:
+      index = {}
+      path = self._path('index', shard)
+      if filesystems.FileSystems.exists(path):
+        with filesystems.FileSystems.open(path) as f:
+          for line in f.read().decode('utf-8').splitlines():
+            if line:
+              key, offset, length = line.split(' ')
+              index[key] = (int(offset), int(length))
+      self._indexes[shard] = index
+    offset, length = self._indexes[shard][digest]
+    if shard not in self._files:
+      self._files[shard] = filesystems.FileSystems.open(
+          self._path('contents', shard),
+          compression_type=CompressionTypes.UNCOMPRESSED)
+    f = self._files[shard]
+    f.seek(offset)
+    return json.loads(f.read(length).decode('utf-8'))['text']
+
+  def close(self):
+    """Closes the shards opened so far; their indexes are kept."""
+    files, self._files = self._files, {}
+    for f in files.values():
+      f.close()